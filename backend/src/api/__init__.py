@@ -1,17 +1,50 @@
-from flask import Flask
-from flask_pymysql import MySQL
+import time
+
+from flask import Flask, g, request
 from flask_restful import Api
 
 from api.resources import (
     DocumentListCreateResource,
     DocumentRetrieveUpdateDeleteResource,
+    BatchTrendsResource,
+    JobListResource,
+    JobResource,
+    MetricsResource,
     TrendsResource,
     TopicsResource,
     RPCResource,
+    SearchResource,
+    PhraseResource,
 )
+from api.analysis import set_default_segmenter
+from api.document_store import create_document_store
+from api.jobs import JobScheduler, JobStore
+from api.metrics import METRICS, server_timing
+from api.pool import ConnectionPool, PooledDatabase
+from api.storage import create_storage
+import config
 from config import PYMYSQL_CONNECT_ARGS, DOCUMENTS_DIR
 
+# Optional settings, which older config.py files may not define
+TOPICS_CACHE_DIR = getattr(config, 'TOPICS_CACHE_DIR', 'topics_cache')
+DB_POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 10)
+DB_POOL_TIMEOUT = getattr(config, 'DB_POOL_TIMEOUT', 30)
+STORAGE = getattr(config, 'STORAGE', 'mysql')
+SQLITE_PATH = getattr(config, 'SQLITE_PATH', 'corpalizer.db')
+JOBS_DIR = getattr(config, 'JOBS_DIR', 'jobs')
+JOB_WORKERS = getattr(config, 'JOB_WORKERS', 2)
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', True)
+PROFILING = getattr(config, 'PROFILING', False)
+DOCUMENT_STORE = getattr(config, 'DOCUMENT_STORE', 'files')
+DOCUMENT_COMPRESSION = getattr(config, 'DOCUMENT_COMPRESSION', None)
+SEARCH_REFRESH_SECONDS = getattr(config, 'SEARCH_REFRESH_SECONDS', 5)
+SNAPSHOT_DIR = getattr(config, 'SNAPSHOT_DIR', 'snapshots')
+SEGMENTER = getattr(config, 'SEGMENTER', 'pysbd')
+
 _mysql = None
+_pool = None
+_scheduler = None
+_document_store = None
 
 
 def get_mysql():
@@ -19,29 +52,87 @@ def get_mysql():
     return _mysql
 
 
+def get_pool():
+    """
+    :return: The connection pool, which background jobs check connections out of
+    """
+    global _pool
+    return _pool
+
+
+def get_scheduler():
+    """
+    :return: The JobScheduler running background jobs
+    """
+    global _scheduler
+    return _scheduler
+
+
+def get_document_store():
+    """
+    :return: The store holding the text of documents
+    """
+    global _document_store
+    return _document_store
+
+
 def create_app():
-    global _mysql
+    global _mysql, _pool, _scheduler, _document_store
     app = Flask(__name__, instance_relative_config=True)
-    app.config['pymysql_kwargs'] = PYMYSQL_CONNECT_ARGS
-    app.config['documents_dir'] = DOCUMENTS_DIR
+    app.config['topics_cache_dir'] = TOPICS_CACHE_DIR
+    app.config['search_refresh_seconds'] = SEARCH_REFRESH_SECONDS
+    app.config['snapshot_dir'] = SNAPSHOT_DIR
     api = Api(app)
 
     api.add_resource(DocumentListCreateResource, '/doc')
     api.add_resource(DocumentRetrieveUpdateDeleteResource, '/doc/<string:doc_uuid>')
+    api.add_resource(BatchTrendsResource, '/trends')
     api.add_resource(TrendsResource, '/trends/<string:granularity>/<string:term_text>')
     api.add_resource(TopicsResource, '/topics')
+    api.add_resource(SearchResource, '/search')
+    api.add_resource(PhraseResource, '/phrase')
     api.add_resource(RPCResource, '/rpc/<string:function>')
+    api.add_resource(JobListResource, '/jobs')
+    api.add_resource(JobResource, '/jobs/<string:job_id>')
+    if METRICS_ENABLED:
+        api.add_resource(MetricsResource, '/metrics')
+    METRICS.enabled = METRICS_ENABLED
+    set_default_segmenter(SEGMENTER)
 
-    mysql = MySQL()
-    mysql.init_app(app)
-    _mysql = mysql
+    storage = create_storage(STORAGE, PYMYSQL_CONNECT_ARGS, SQLITE_PATH)
+    _pool = ConnectionPool(storage, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT)
+    _mysql = PooledDatabase(_pool, app)
+    _scheduler = JobScheduler(workers=JOB_WORKERS, store=JobStore(JOBS_DIR))
+    _document_store = create_document_store(DOCUMENT_STORE, DOCUMENTS_DIR, compression=DOCUMENT_COMPRESSION)
+
+    @app.before_request
+    def before_request():
+        if METRICS.enabled:
+            g.request_start = time.perf_counter()
+            if PROFILING and 'X-Profile' in request.headers:
+                METRICS.start_profile()
 
     @app.after_request
     def after_request(response):
+        if METRICS.enabled and 'request_start' in g:
+            seconds = time.perf_counter() - g.request_start
+            rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            METRICS.observe('corpalizer_http_request_duration_seconds',
+                            (('endpoint', rule), ('method', request.method), ('status', response.status_code)), seconds)
+            profile = METRICS.stop_profile()
+            if profile is not None:
+                response.headers.add('Server-Timing', server_timing(profile, seconds))
+                response.headers.add('Timing-Allow-Origin', '*')
+
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Allow-Headers', '*')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
         response.headers.add('Referrer-Policy', 'no-referrer')
         return response
 
+    @app.teardown_request
+    def teardown_request(exception):
+        # Drops the profile of a request that failed before after_request
+        METRICS.stop_profile()
+
     return app
@@ -0,0 +1,256 @@
+"""
+Text analysis: paragraph and sentence segmentation, tokenization, stopword removal and stemming
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Lock
+import os
+import time
+
+from api.metrics import METRICS
+from api.segmenters import PYSBD, check_segmenter, create_segmenter
+
+"""
+The stopword lists bundled with the app, one file per language with one word per line, so that analysis needs no NLP
+data to be downloaded
+"""
+STOPWORDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stopwords')
+
+"""
+A term occurrence, with the character offsets of the original word within the analyzed text
+"""
+Token = namedtuple('Token', ['term', 'start', 'end'])
+
+"""
+The result of analyzing a document, as a tree of units each holding the Counter of its terms. Paragraphs also hold their
+tokens, and the start offsets of all their words, stopwords included, from which the positions of their terms are
+derived.
+Offsets are relative to the document for paragraphs, tokens and words, and relative to their paragraph for sentences.
+"""
+AnalyzedSentence = namedtuple('AnalyzedSentence', ['start', 'end', 'term_counts'])
+AnalyzedParagraph = namedtuple('AnalyzedParagraph', ['start', 'end', 'term_counts', 'sentences', 'tokens', 'words'])
+AnalyzedDocument = namedtuple('AnalyzedDocument', ['term_counts', 'paragraphs', 'tokens'])
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Adds the time spent in the block to `timings[stage]`, if `timings` is a dict, and to the stage metrics
+    """
+    if timings is None and not METRICS.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + seconds
+        METRICS.observe_stage(stage, seconds)
+
+
+def load_stopwords(language):
+    """
+    :param language: The name of the language, e.g. 'english'
+    :return: The stopwords of the language, from the bundled lists, or else from the NLTK data installed locally.
+      Nothing is ever downloaded
+    """
+    path = os.path.join(STOPWORDS_DIR, language)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return frozenset(w for w in (line.strip() for line in f) if w != '' and not w.startswith('#'))
+    from nltk.corpus import stopwords
+
+    return frozenset(stopwords.words(language))
+
+
+def break_document_into_paragraphs(doc):
+    """
+    Extracts information about paragraphs in the given document.
+    A paragraph starts at a newline character, so the paragraphs partition the document.
+    :param doc: The document text
+    :return: A list of 3-tuples, which are start and end indices of each paragraph within the given string, and the
+      paragraph text itself as the third item
+    """
+    splits = []
+    last_end = 0
+    i = doc.find('\n')
+    while i != -1:
+        splits.append((last_end, i, doc[last_end:i]))
+        last_end = i
+        i = doc.find('\n', i + 1)
+
+    splits.append((last_end, len(doc), doc[last_end:]))
+
+    return splits
+
+
+class TextAnalyzer:
+    """
+    Holds the resources needed to analyze text, so they are built once per process rather than once per call.
+    Stems are memoized in a bounded LRU cache, since the same words come up over and over.
+    NLTK and the sentence segmenters take a while to import, so they are only imported once an analyzer is built, see
+    get_analyzer.
+    """
+
+    def __init__(self, language='english', stem_cache_size=1 << 16, segmenter=PYSBD):
+        """
+        :param language: The language of the stopword list
+        :param stem_cache_size: The maximum number of memoized stems
+        :param segmenter: The name of the sentence segmenter, see segmenters.py
+        """
+        from nltk import RegexpTokenizer
+        from nltk.stem import PorterStemmer
+
+        self.stop_words = load_stopwords(language)
+        self.stemmer = PorterStemmer()
+        self.tokenizer = RegexpTokenizer(r'\w+')
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+        self.segmenter = create_segmenter(segmenter)
+
+    def tokenize(self, text, words=None):
+        """
+        Tokenizes text into stemmed terms, leaving out stopwords
+        :param text: The raw text
+        :param words: An optional list to which the start offset of every word, stopwords included, is appended
+        :return: A list of Tokens, in order
+        """
+        tokens = []
+        for start, end in self.tokenizer.span_tokenize(text):
+            if words is not None:
+                words.append(start)
+            word = text[start:end].lower()
+            if word not in self.stop_words:
+                tokens.append(Token(self.stem(word), start, end))
+        return tokens
+
+    def segment(self, paragraph):
+        """
+        Extracts information about sentences from the given paragraph
+        :param paragraph: The paragraph text
+        :return: A list of 3-tuples, which are start and end indices of each sentence within the given string, and the
+          text itself as the third item
+        """
+        return self.segmenter.segment(paragraph)
+
+    def analyze(self, text, timings=None):
+        """
+        Breaks a document down into paragraphs and sentences, and counts the terms of each of them.
+        The document is tokenized once, and the terms of each paragraph and sentence are the tokens lying within its
+        span. A word cut by a sentence boundary therefore counts towards its paragraph only.
+        :param text: The raw text of the document
+        :param timings: An optional dict to which the time spent in each stage is added
+        :return: An AnalyzedDocument
+        """
+        return self.analyze_many([text], timings)[0]
+
+    def analyze_many(self, texts, timings=None):
+        """
+        Analyzes documents like analyze, segmenting the paragraphs of all of them in one batch
+        :param texts: The list of the raw texts of the documents
+        :param timings: An optional dict to which the time spent in each stage is added
+        :return: The list of AnalyzedDocuments
+        """
+        documents = []
+        for text in texts:
+            words = []
+            with timed(timings, 'tokenize'):
+                tokens = self.tokenize(text, words)
+            documents.append((tokens, words, break_document_into_paragraphs(text)))
+        with timed(timings, 'segment'):
+            sentence_spans = iter(self.segmenter.segment_many(
+                [paragraph_text for _, _, paragraphs in documents for _, _, paragraph_text in paragraphs]))
+
+        analyses = []
+        for tokens, words, paragraph_spans in documents:
+            starts = [t.start for t in tokens]
+            ends = [t.end for t in tokens]
+            paragraphs = []
+            for start, end, _ in paragraph_spans:
+                lo, hi = bisect_left(starts, start), bisect_left(starts, end)
+                paragraph_words = words[bisect_left(words, start):bisect_left(words, end)]
+                paragraphs.append(self._analyze_paragraph(next(sentence_spans), start, end, tokens, starts, ends, lo,
+                                                          hi, paragraph_words))
+            analyses.append(AnalyzedDocument(Counter(t.term for t in tokens), paragraphs, tokens))
+        return analyses
+
+    def analyze_paragraph(self, text, start, end, timings=None):
+        """
+        Analyzes a single paragraph of a document. Words never span paragraphs, so the result is the same as the one of
+        this paragraph in the analysis of the whole document
+        :param text: The raw text of the document
+        :param start: The offset of the paragraph within the document
+        :param end: The offset of the end of the paragraph
+        :param timings: An optional dict to which the time spent in each stage is added
+        :return: An AnalyzedParagraph
+        """
+        words = []
+        with timed(timings, 'tokenize'):
+            tokens = [Token(t.term, start + t.start, start + t.end) for t in self.tokenize(text[start:end], words)]
+        with timed(timings, 'segment'):
+            sentence_spans = self.segment(text[start:end])
+        return self._analyze_paragraph(sentence_spans, start, end, tokens, [t.start for t in tokens],
+                                       [t.end for t in tokens], 0, len(tokens), [start + w for w in words])
+
+    @staticmethod
+    def _analyze_paragraph(sentence_spans, start, end, tokens, starts, ends, lo, hi, words):
+        """
+        :param sentence_spans: The sentences of the paragraph, see segment
+        :param tokens: The tokens of the document, with the lists of their start and end offsets, of which the
+          paragraph holds those from `lo` to `hi`
+        :param words: The start offsets of the words of the paragraph
+        """
+        sentences = []
+        for sentence_start, sentence_end, _ in sentence_spans:
+            s_lo = bisect_left(starts, start + sentence_start, lo, hi)
+            s_hi = bisect_right(ends, start + sentence_end, s_lo, hi)
+            sentences.append(AnalyzedSentence(sentence_start, sentence_end, Counter(t.term for t in tokens[s_lo:s_hi])))
+        return AnalyzedParagraph(start, end, Counter(t.term for t in tokens[lo:hi]), sentences, tokens[lo:hi], words)
+
+
+_default_segmenter = PYSBD
+_analyzers = {}
+_analyzers_lock = Lock()
+
+
+def set_default_segmenter(name):
+    """
+    Sets the sentence segmenter of the analyzer get_analyzer returns by default, from the SEGMENTER setting
+    :param name: The name of the segmenter, see segmenters.py
+    """
+    global _default_segmenter
+    _default_segmenter = check_segmenter(name)
+
+
+def default_segmenter():
+    """
+    :return: The name of the default sentence segmenter
+    """
+    return _default_segmenter
+
+
+def get_analyzer(segmenter=None):
+    """
+    :param segmenter: The name of the sentence segmenter, or None for the default one
+    :return: The process-wide TextAnalyzer using this segmenter, built on first use
+    """
+    segmenter = segmenter or _default_segmenter
+    analyzer = _analyzers.get(segmenter)
+    if analyzer is None:
+        with _analyzers_lock:
+            analyzer = _analyzers.get(segmenter)
+            if analyzer is None:
+                analyzer = _analyzers[segmenter] = TextAnalyzer(segmenter=segmenter)
+    return analyzer
+
+
+def warm_up():
+    """
+    Builds the process-wide TextAnalyzer and analyzes a short text with it, so that the modules, word lists and regular
+    expressions analysis needs are loaded. Processes forked afterwards share them
+    """
+    get_analyzer().analyze('The analyzer is warming up. It loads its resources once.')
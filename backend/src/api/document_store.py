@@ -0,0 +1,558 @@
+"""
+Storage of document bodies.
+
+FileDocumentStore keeps the original layout, one `{uuid}.txt` file per document. PackedDocumentStore appends documents
+to large segment files instead, so millions of documents do not cost millions of inodes and directory lookups:
+  * Each record holds the document id, its size, optionally a table of zlib compressed blocks, and the body. Deleting
+    or replacing a document appends a new record, and the most recent record of an id wins.
+  * An in-memory index maps each id to the location of its record. It is rebuilt at startup from an index file written
+    next to every full segment, and by scanning the last segment.
+  * Reads go through a memory map of the segment, so reading part of a document only touches the pages (or the
+    compressed blocks) holding it.
+  * Segments made mostly of deleted records are compacted: their live records are copied to the end of the store, and
+    the segment is removed.
+Writers of every process are serialized by a lock file, and each process catches up with the records written by the
+others before reading.
+"""
+
+import fcntl
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import RLock
+
+FILES = 'files'
+PACKED = 'packed'
+
+ZLIB = 'zlib'
+
+_SEGMENT_PATTERN = re.compile(r'^segment-(\d+)\.dat$')
+
+"""
+The record header: magic, flags, id length, number of compressed blocks, size of the uncompressed blocks, size of the
+text in bytes, size of the stored body in bytes, CRC32 of the stored body. It is followed by the id, the compressed
+length of each block, and the body.
+"""
+_HEADER = struct.Struct('<4sBBIIQQI')
+_MAGIC = b'CDS1'
+_BLOCK_LENGTH = struct.Struct('<I')
+
+_DELETED = 1
+_COMPRESSED = 2
+_ASCII = 4
+
+"""
+The index file of a segment starts with its magic and the length of the segment it describes, followed by the offset of
+each record and a copy of the record without its body
+"""
+_INDEX_HEADER = struct.Struct('<4sQ')
+_INDEX_MAGIC = b'CDI1'
+_OFFSET = struct.Struct('<Q')
+
+"""
+A parsed record header. `blocks` holds the cumulative compressed lengths of the blocks, starting at 0, or is None if the
+body is not compressed
+"""
+_Header = namedtuple('_Header', ['doc_uuid', 'flags', 'block_size', 'size', 'stored', 'crc', 'blocks', 'length'])
+
+"""
+The location of the latest record of a document. `offset` is the position of the body in the segment
+"""
+_Entry = namedtuple('_Entry', ['segment', 'record_offset', 'offset', 'header'])
+
+
+class FileDocumentStore:
+    """
+    Stores each document in its own text file
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, doc_uuid):
+        return os.path.join(self.directory, '{}.txt'.format(doc_uuid))
+
+    def get(self, doc_uuid):
+        """
+        :return: The text of the document, or None if there is no such document
+        """
+        try:
+            with open(self._path(doc_uuid), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_range(self, doc_uuid, start, end=None):
+        """
+        :param start: The offset of the first character
+        :param end: The offset after the last character, or None for the end of the document
+        :return: The characters of the document between `start` and `end`, or None if there is no such document
+        """
+        text = self.get(doc_uuid)
+        return text[start:end] if text is not None else None
+
+    def put(self, doc_uuid, text):
+        self.put_many([(doc_uuid, text)])
+
+    def put_many(self, documents):
+        """
+        :param documents: A list of (doc_uuid, text) tuples, replacing the documents with the same ids
+        """
+        for doc_uuid, text in documents:
+            with open(self._path(doc_uuid), 'w+') as f:
+                f.write(text)
+
+    def delete(self, doc_uuid):
+        self.delete_many([doc_uuid])
+
+    def delete_many(self, doc_uuids):
+        for doc_uuid in doc_uuids:
+            try:
+                os.remove(self._path(doc_uuid))
+            except FileNotFoundError:
+                pass
+
+    def garbage_ratio(self):
+        """
+        :return: The fraction of the store taken by deleted documents, which compaction would reclaim
+        """
+        return 0
+
+    def needs_compaction(self):
+        """
+        :return: Whether `compact` would reclaim space
+        """
+        return False
+
+    def compact(self, poll_cancel=None):
+        """
+        Reclaims the space of deleted documents
+        :return: The number of bytes reclaimed
+        """
+        return 0
+
+    def close(self):
+        pass
+
+
+class PackedDocumentStore(FileDocumentStore):
+    """
+    Appends documents to segment files, see the module documentation.
+    Documents stored as files by FileDocumentStore in the same directory are still read, and deleted, until they are
+    replaced, so a directory can switch to packed storage in place.
+    """
+
+    def __init__(self, directory, segment_size=64 << 20, compression=None, block_size=64 << 10, compact_threshold=0.5,
+                 fsync=False):
+        """
+        :param directory: The directory holding the segments. It is created if needed
+        :param segment_size: The size past which a new segment is started, in bytes
+        :param compression: ZLIB to compress the documents written, or None
+        :param block_size: The number of bytes of text compressed together. Reading a range decompresses the blocks
+          holding it only
+        :param compact_threshold: The fraction of a segment taken by deleted documents past which it is compacted
+        :param fsync: Whether to flush every write to disk before returning
+        """
+        super().__init__(directory)
+        if compression not in (None, ZLIB):
+            raise ValueError('unknown compression {}'.format(compression))
+        self.segment_size = segment_size
+        self.compression = compression
+        self.block_size = block_size
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+
+        self._lock = RLock()
+        self._lock_path = os.path.join(directory, 'segments.lock')
+        self._load()
+
+    # Layout
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, 'segment-{:06d}.dat'.format(segment))
+
+    def _index_path(self, segment):
+        return os.path.join(self.directory, 'segment-{:06d}.idx'.format(segment))
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_PATTERN.match(name)
+            if match is not None:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Serializes writers, within this process and across processes, and catches up with the other processes' writes
+        """
+        with self._lock:
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._refresh(repair=True)
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Index
+
+    def _load(self):
+        """
+        Rebuilds the index from the index files and segments on disk
+        """
+        with self._lock:
+            self._index = {}
+            self._maps = {}
+            self._scanned = {}
+            self._live_bytes = {}
+            self._total_bytes = {}
+            segments = self._segments()
+            self._active = segments[-1] if len(segments) > 0 else 1
+            for segment in segments:
+                if not self._load_index_file(segment):
+                    self._scan(segment)
+
+    def _load_index_file(self, segment):
+        try:
+            with open(self._index_path(segment), 'rb') as f:
+                data = f.read()
+            segment_length = os.path.getsize(self._segment_path(segment))
+        except FileNotFoundError:
+            return False
+        if len(data) < _INDEX_HEADER.size:
+            return False
+        magic, length = _INDEX_HEADER.unpack_from(data, 0)
+        if magic != _INDEX_MAGIC or length != segment_length:
+            return False
+
+        pos = _INDEX_HEADER.size
+        while pos < len(data):
+            record_offset, = _OFFSET.unpack_from(data, pos)
+            pos += _OFFSET.size
+            header = _parse_header(data, pos)
+            pos += header.length
+            self._add(_Entry(segment, record_offset, record_offset + header.length, header))
+        self._scanned[segment] = length
+        return True
+
+    def _scan(self, segment, repair=False):
+        """
+        Indexes the complete records of a segment past the point already indexed
+        :param repair: Whether to truncate an incomplete or corrupt record at the end of the segment, which a writer
+          stopped in the middle of a write leaves behind. Only safe while holding the writer lock
+        """
+        start = self._scanned.get(segment, 0)
+        try:
+            with open(self._segment_path(segment), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        pos = 0
+        while pos < len(data):
+            try:
+                header = _parse_header(data, pos)
+            except ValueError:
+                break
+            end = pos + header.length + header.stored
+            if end > len(data) or zlib.crc32(data[pos + header.length:end]) != header.crc:
+                break
+            self._add(_Entry(segment, start + pos, start + pos + header.length, header))
+            pos = end
+        self._scanned[segment] = start + pos
+
+        if repair and pos < len(data):
+            with open(self._segment_path(segment), 'r+b') as f:
+                f.truncate(start + pos)
+
+    def _add(self, entry):
+        length = entry.header.length + entry.header.stored
+        self._total_bytes[entry.segment] = self._total_bytes.get(entry.segment, 0) + length
+        self._live_bytes.setdefault(entry.segment, 0)
+        previous = self._index.pop(entry.header.doc_uuid, None)
+        if previous is not None:
+            self._live_bytes[previous.segment] -= previous.header.length + previous.header.stored
+        if not entry.header.flags & _DELETED:
+            self._index[entry.header.doc_uuid] = entry
+            self._live_bytes[entry.segment] += length
+
+    def _refresh(self, repair=False):
+        """
+        Indexes the records written since the last refresh, by this process or another one
+        """
+        with self._lock:
+            while True:
+                try:
+                    size = os.path.getsize(self._segment_path(self._active))
+                except FileNotFoundError:
+                    size = 0
+                if size != self._scanned.get(self._active, 0):
+                    self._scan(self._active, repair)
+                if not os.path.exists(self._segment_path(self._active + 1)):
+                    break
+                self._active += 1
+
+    # Reads
+
+    def _map(self, segment, end):
+        """
+        :return: A memory map of a segment covering at least `end` bytes
+        """
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            with open(self._segment_path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # A replaced map is not closed, since views of it may still be in use. It is closed once unreferenced
+            self._maps[segment] = mapped
+        return mapped
+
+    def _lookup(self, doc_uuid):
+        """
+        :return: The _Header of the record of a document and a memoryview of its stored body, or (None, None)
+        """
+        doc_uuid = str(doc_uuid)
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(doc_uuid)
+            if entry is None:
+                return None, None
+            end = entry.offset + entry.header.stored
+            try:
+                mapped = self._map(entry.segment, end)
+            except FileNotFoundError:
+                # Compacted away by another process since the last refresh
+                self._load()
+                entry = self._index.get(doc_uuid)
+                if entry is None:
+                    return None, None
+                end = entry.offset + entry.header.stored
+                mapped = self._map(entry.segment, end)
+        return entry.header, memoryview(mapped)[entry.offset:end]
+
+    @staticmethod
+    def _read(header, body, start, end):
+        """
+        :return: The bytes of the text between `start` and `end`, decompressing the blocks holding them only
+        """
+        if header.blocks is None:
+            return body[start:end]
+        if end <= start:
+            return b''
+        first, last = start // header.block_size, (end - 1) // header.block_size
+        data = b''.join(zlib.decompress(body[header.blocks[i]:header.blocks[i + 1]]) for i in range(first, last + 1))
+        offset = first * header.block_size
+        return data[start - offset:end - offset]
+
+    def get(self, doc_uuid):
+        header, body = self._lookup(doc_uuid)
+        if header is None:
+            return super().get(doc_uuid)
+        if zlib.crc32(body) != header.crc:
+            raise IOError('corrupt record for document {}'.format(doc_uuid))
+        return bytes(self._read(header, body, 0, header.size)).decode('utf-8')
+
+    def get_range(self, doc_uuid, start, end=None):
+        """
+        Offsets are in characters. For ASCII documents, they are also byte offsets, and only the range is read. Other
+        documents are decoded whole
+        """
+        header, body = self._lookup(doc_uuid)
+        if header is None:
+            return super().get_range(doc_uuid, start, end)
+        if not header.flags & _ASCII:
+            return self.get(doc_uuid)[start:end]
+        start = min(max(start, 0), header.size)
+        end = header.size if end is None else min(max(end, start), header.size)
+        return bytes(self._read(header, body, start, end)).decode('ascii')
+
+    # Writes
+
+    def _record(self, doc_uuid, text):
+        """
+        :return: The bytes of a record. A text of None makes a deletion record
+        """
+        key = str(doc_uuid).encode('utf-8')
+        if text is None:
+            return _HEADER.pack(_MAGIC, _DELETED, len(key), 0, 0, 0, 0, zlib.crc32(b'')) + key
+
+        data = text.encode('utf-8')
+        flags = _ASCII if len(data) == len(text) else 0
+        block_table = b''
+        blocks = 0
+        if self.compression == ZLIB:
+            flags |= _COMPRESSED
+            compressed = [zlib.compress(data[i:i + self.block_size]) for i in range(0, len(data), self.block_size)]
+            blocks = len(compressed)
+            block_table = b''.join(_BLOCK_LENGTH.pack(len(c)) for c in compressed)
+            body = b''.join(compressed)
+        else:
+            body = data
+        return _HEADER.pack(_MAGIC, flags, len(key), blocks, self.block_size, len(data), len(body),
+                            zlib.crc32(body)) + key + block_table + body
+
+    def _append(self, records):
+        """
+        Appends records to the active segment, starting a new one first if it is full. Must hold the writer lock
+        :param records: A list of record bytes
+        """
+        path = self._segment_path(self._active)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+            self._seal(self._active)
+            self._active += 1
+            path = self._segment_path(self._active)
+
+        with open(path, 'ab') as f:
+            f.write(b''.join(records))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self._scan(self._active)
+
+    def _seal(self, segment):
+        """
+        Writes the index file of a full segment
+        """
+        with open(self._segment_path(segment), 'rb') as f:
+            data = f.read()
+        parts = [_INDEX_HEADER.pack(_INDEX_MAGIC, len(data))]
+        pos = 0
+        while pos < len(data):
+            header = _parse_header(data, pos)
+            parts.append(_OFFSET.pack(pos) + data[pos:pos + header.length])
+            pos += header.length + header.stored
+        tmp_path = self._index_path(segment) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(parts))
+        os.replace(tmp_path, self._index_path(segment))
+
+    def put_many(self, documents):
+        records = [self._record(doc_uuid, text) for doc_uuid, text in documents]
+        with self._writing():
+            self._append(records)
+        # Files of FileDocumentStore are shadowed by the new records, and would resurface if they were deleted
+        super().delete_many(doc_uuid for doc_uuid, _ in documents)
+
+    def delete_many(self, doc_uuids):
+        doc_uuids = [str(doc_uuid) for doc_uuid in doc_uuids]
+        with self._writing():
+            records = [self._record(doc_uuid, None) for doc_uuid in doc_uuids if doc_uuid in self._index]
+            if len(records) > 0:
+                self._append(records)
+        super().delete_many(doc_uuids)
+
+    # Compaction
+
+    def garbage_ratio(self):
+        with self._lock:
+            self._refresh()
+            total = sum(self._total_bytes.get(s, 0) for s in self._scanned if s != self._active)
+            live = sum(self._live_bytes.get(s, 0) for s in self._scanned if s != self._active)
+        return (total - live) / total if total > 0 else 0
+
+    def _segments_to_compact(self):
+        with self._lock:
+            self._refresh()
+            return [s for s in sorted(self._scanned) if s != self._active and self._total_bytes.get(s, 0) > 0
+                    and 1 - self._live_bytes.get(s, 0) / self._total_bytes[s] >= self.compact_threshold]
+
+    def needs_compaction(self):
+        return len(self._segments_to_compact()) > 0
+
+    def compact(self, poll_cancel=None):
+        """
+        Copies the live records of every full segment past the compaction threshold to the end of the store, and
+        removes the segment
+        :param poll_cancel: A function returning True when compaction should stop, checked between segments
+        :return: The number of bytes reclaimed
+        """
+        reclaimed = 0
+        for segment in self._segments_to_compact():
+            if poll_cancel is not None and poll_cancel() is True:
+                break
+            with self._writing():
+                if segment not in self._scanned or segment == self._active:
+                    continue
+                reclaimed += self._compact_segment(segment)
+        return reclaimed
+
+    def _compact_segment(self, segment):
+        with open(self._segment_path(segment), 'rb') as f:
+            data = f.read()
+        oldest = min(self._scanned) == segment
+
+        records = []
+        pos = 0
+        while pos < len(data):
+            header = _parse_header(data, pos)
+            end = pos + header.length + header.stored
+            entry = self._index.get(header.doc_uuid)
+            if entry is not None and entry.segment == segment and entry.record_offset == pos:
+                records.append(data[pos:end])
+            elif header.flags & _DELETED and entry is None and not oldest:
+                # Older segments may still hold a record of the document, which the deletion has to keep shadowing
+                records.append(data[pos:end])
+            pos = end
+
+        if len(records) > 0:
+            self._append(records)
+        for path in (self._index_path(segment), self._segment_path(segment)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        reclaimed = len(data) - sum(len(r) for r in records)
+        for d in (self._scanned, self._live_bytes, self._total_bytes):
+            d.pop(segment, None)
+        self._maps.pop(segment, None)
+        return reclaimed
+
+    def close(self):
+        with self._lock:
+            self._maps = {}
+
+
+def _parse_header(data, pos):
+    """
+    :return: The _Header of the record at `pos`. Raises ValueError if there is no complete header at `pos`
+    """
+    if pos + _HEADER.size > len(data):
+        raise ValueError('truncated record header')
+    magic, flags, key_length, blocks, block_size, size, stored, crc = _HEADER.unpack_from(data, pos)
+    if magic != _MAGIC:
+        raise ValueError('bad record magic')
+    key_start = pos + _HEADER.size
+    table_start = key_start + key_length
+    header_end = table_start + blocks * _BLOCK_LENGTH.size
+    if header_end > len(data):
+        raise ValueError('truncated record header')
+    doc_uuid = bytes(data[key_start:table_start]).decode('utf-8')
+
+    block_offsets = None
+    if flags & _COMPRESSED:
+        block_offsets = [0]
+        for i in range(blocks):
+            length, = _BLOCK_LENGTH.unpack_from(data, table_start + i * _BLOCK_LENGTH.size)
+            block_offsets.append(block_offsets[-1] + length)
+        block_offsets = tuple(block_offsets)
+    return _Header(doc_uuid, flags, block_size, size, stored, crc, block_offsets, header_end - pos)
+
+
+def create_document_store(kind, directory, **kwargs):
+    """
+    :param kind: FILES or PACKED
+    :param directory: The directory holding the documents
+    :param kwargs: Options of PackedDocumentStore, ignored by FileDocumentStore
+    :return: The document store
+    """
+    if kind == FILES:
+        return FileDocumentStore(directory)
+    if kind == PACKED:
+        return PackedDocumentStore(directory, **kwargs)
+    raise ValueError('unknown document store {}'.format(kind))
@@ -0,0 +1,270 @@
+"""
+Bulk import of documents from a directory of text files or from a JSONL file.
+
+Sources are read lazily and analyzed in a process pool, and the analyzed documents are handed to a writer thread
+through a bounded queue. The writer inserts them in large batches, each in its own transaction along with the
+`imported_source` rows recording which sources it contains, so an interrupted import resumes where it stopped. The
+tfidf statistics are rebuilt once, when every source has been imported. Until then, the documents imported are flagged
+as `statistics_pending`, and deleting or updating them through the API does not touch the statistics.
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from threading import Lock, Thread
+
+from api.analysis import default_segmenter
+from api.services import analyze_documents, recompute_tfidf_scores, write_documents
+from api.sql import insert_rows
+from api.storage import Error
+
+"""
+A document to import. `key` identifies the source across runs, and `timestamp` is the date of the document, or None
+for the date of the import. Sources that cannot be read have no text, and the exception raised reading them as `error`
+"""
+Source = namedtuple('Source', ['key', 'text', 'timestamp', 'error'], defaults=(None,))
+
+"""
+Reported to the progress callback after every written batch
+"""
+ImportProgress = namedtuple('ImportProgress', ['imported', 'skipped', 'failed', 'seconds', 'documents_per_second',
+                                               'last_error'])
+
+
+def iter_directory_sources(directory):
+    """
+    Reads every file of a directory, in name order, as one document
+    :param directory: The directory path
+    :return: A generator of Sources, keyed by the absolute path of the file
+    """
+    directory = os.path.abspath(directory)
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    text = f.read()
+            except (OSError, ValueError) as e:
+                yield Source(path, None, None, e)
+            else:
+                yield Source(path, text, None)
+
+
+def iter_jsonl_sources(path):
+    """
+    Reads one document per line of a JSONL file. Each line is an object with a `content` string, and optionally an
+    `id` identifying the document and a `date` formatted as YYYY-MM-DD
+    :param path: The JSONL file path
+    :return: A generator of Sources, keyed by the absolute path of the file and the id, or the line number for lines
+      without an id
+    """
+    path = os.path.abspath(path)
+    # Lines are decoded one at a time, so that one that is not valid UTF-8 does not stop the others from being read
+    with open(path, 'rb') as f:
+        for i, line in enumerate(f):
+            key = '{}:line-{}'.format(path, i + 1)
+            try:
+                line = line.decode('utf-8')
+                if line.strip() == '':
+                    continue
+                obj = json.loads(line)
+                key = '{}:{}'.format(path, obj.get('id', 'line-{}'.format(i + 1)))
+                date = obj.get('date')
+                yield Source(key, obj['content'], datetime.strptime(date, '%Y-%m-%d') if date is not None else None)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                yield Source(key, None, None, e)
+
+
+def iter_sources(path):
+    """
+    :param path: A directory, or a JSONL file
+    :return: A generator of Sources
+    """
+    if os.path.isdir(path):
+        return iter_directory_sources(path)
+    return iter_jsonl_sources(path)
+
+
+def _analyze_batch(texts, segmenter):
+    """
+    Analysis process body
+    :return: One pair per text: (AnalyzedDocument, None), or (None, error message) for the documents that could not be
+      analyzed
+    """
+    try:
+        return [(analysis, None) for analysis in analyze_documents(texts, segmenter=segmenter)]
+    except Exception:
+        pass
+    # One document at a time, so that one that cannot be analyzed does not fail the others
+    results = []
+    for text in texts:
+        try:
+            results.append((analyze_documents([text], segmenter=segmenter)[0], None))
+        except Exception as e:
+            results.append((None, '{}: {}'.format(type(e).__name__, e)))
+    return results
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _write_batches(conn, document_store, batches, on_batch):
+    """
+    Writer thread body. Consumes lists of (Source, AnalyzedDocument) from the queue until it receives None
+    """
+    cur = conn.cursor()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+
+        documents = [(str(uuid.uuid4()), source, analysis) for source, analysis in batch]
+        try:
+            document_store.put_many([(doc_uuid, source.text) for doc_uuid, source, _ in documents])
+            write_documents([(doc_uuid, analysis, source.timestamp) for doc_uuid, source, analysis in documents], cur,
+                            update_statistics=False)
+            insert_rows(cur, 'INSERT INTO imported_source (source_key, document_id) VALUES', '(%s, %s)',
+                        [(source.key, doc_uuid) for doc_uuid, source, _ in documents])
+            conn.commit()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Error:
+                pass
+            try:
+                document_store.delete_many([doc_uuid for doc_uuid, _, _ in documents])
+            except OSError:
+                pass
+            on_batch(0, len(documents), e)
+        else:
+            on_batch(len(documents), 0, None)
+    cur.close()
+
+
+def import_corpus(path, pool, document_store, workers=None, batch_size=200, analyze_chunk_size=16,
+                  progress_callback=None, poll_cancel=None, segmenter=None):
+    """
+    Imports every document of a directory or JSONL file that has not been imported yet
+    :param path: A directory of text files, or a JSONL file
+    :param pool: The ConnectionPool the import checks a connection out of, for its whole duration
+    :param document_store: The document store the text of the documents is written to
+    :param workers: The number of analysis processes, defaults to the number of CPUs
+    :param batch_size: The number of documents written per transaction
+    :param analyze_chunk_size: The number of documents sent to an analysis process at once
+    :param progress_callback: A function called with an ImportProgress after every batch
+    :param poll_cancel: A function returning True when the import should stop. The documents already read are still
+      written, so the import can be resumed later
+    :param segmenter: The name of the sentence segmenter, or None for the default one
+    :return: The final ImportProgress
+    """
+    conn = pool.checkout()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT source_key FROM imported_source')
+        done = {x[0] for x in cur.fetchall()}
+        cur.close()
+        conn.commit()
+
+        start = time.perf_counter()
+        counts = {'imported': 0, 'skipped': 0, 'failed': 0}
+        errors = []
+
+        def progress():
+            seconds = time.perf_counter() - start
+            return ImportProgress(counts['imported'], counts['skipped'], counts['failed'], seconds,
+                                  counts['imported'] / seconds if seconds > 0 else 0,
+                                  str(errors[-1]) if len(errors) > 0 else None)
+
+        # Called by the writer thread for every batch, and by this one for the documents that cannot be read or analyzed
+        counts_lock = Lock()
+
+        def on_batch(imported, failed, error):
+            with counts_lock:
+                counts['imported'] += imported
+                counts['failed'] += failed
+                if error is not None:
+                    errors.append(error)
+                if progress_callback is not None:
+                    progress_callback(progress())
+
+        # Sources that fail are not recorded, so resuming the import tries them again
+        def pending_sources():
+            for source in iter_sources(path):
+                if poll_cancel is not None and poll_cancel() is True:
+                    return
+                if source.key in done:
+                    counts['skipped'] += 1
+                elif source.error is not None:
+                    on_batch(0, 1, '{}: {}'.format(source.key, source.error))
+                else:
+                    done.add(source.key)
+                    yield source
+
+        # Bounded on both sides: at most `max_pending` chunks are being analyzed, and at most two batches wait for the
+        # writer, so memory use does not depend on the size of the import
+        workers = workers or os.cpu_count() or 1
+        # Resolved here, since analysis processes do not necessarily share the default of this one
+        segmenter = segmenter or default_segmenter()
+        max_pending = 2 * workers
+        batches = queue.Queue(maxsize=2)
+        writer = Thread(target=_write_batches, args=(conn, document_store, batches, on_batch))
+
+        # Analysis processes are spawned rather than forked: imports run in threads of the server, and a fork copies the
+        # locks other threads hold at that moment, which the child could then wait on forever
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            writer.start()
+            try:
+                pending = deque()
+                batch = []
+
+                def collect(future, chunk):
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        on_batch(0, len(chunk), e)
+                        return
+                    for source, (analysis, error) in zip(chunk, results):
+                        if error is not None:
+                            on_batch(0, 1, '{}: {}'.format(source.key, error))
+                        else:
+                            batch.append((source, analysis))
+                    while len(batch) >= batch_size:
+                        batches.put(batch[:batch_size])
+                        del batch[:batch_size]
+
+                for chunk in _chunks(pending_sources(), analyze_chunk_size):
+                    future = executor.submit(_analyze_batch, [source.text for source in chunk], segmenter)
+                    pending.append((future, chunk))
+                    if len(pending) >= max_pending:
+                        collect(*pending.popleft())
+                while len(pending) > 0:
+                    collect(*pending.popleft())
+                if len(batch) > 0:
+                    batches.put(batch)
+            finally:
+                batches.put(None)
+                writer.join()
+
+        # Rebuilt even when nothing new was imported, in case a previous run was interrupted before this point
+        cur = conn.cursor()
+        recompute_tfidf_scores(cur)
+        cur.close()
+        conn.commit()
+    finally:
+        pool.checkin(conn)
+
+    return progress()
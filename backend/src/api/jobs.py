@@ -0,0 +1,381 @@
+"""
+Background jobs for long-running corpus operations.
+
+Jobs wait in a priority queue and run on a bounded pool of worker threads. A job is a function taking the Job as its
+first argument, which it uses to report progress and to poll for cancellation. Submitting a job with the same key as a
+job that is still queued returns the queued job instead of adding another one, so repeated requests coalesce.
+
+The state of every job is written to a directory of JSON files, so the jobs of every worker process can be listed, and
+finished jobs are still listed after a restart. Jobs that were queued or running when their process stopped are
+marked as interrupted.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import time
+import uuid
+from collections import deque
+from threading import Condition, Event, Thread
+
+from api.metrics import METRICS
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+INTERRUPTED = 'interrupted'
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED, INTERRUPTED)
+
+PRIORITY_LOW = -10
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10
+
+
+class JobCancelled(Exception):
+    """
+    Raised by `Job.check_cancelled` to stop a job that was asked to stop
+    """
+
+
+class Job:
+    """
+    A unit of work run by the JobScheduler
+    """
+
+    def __init__(self, kind, fn, params, priority, key):
+        """
+        :param kind: A name for the type of work, e.g. 'topics'
+        :param fn: The function run, called as fn(job, **params)
+        :param params: A JSON serializable dict of keyword arguments for `fn`
+        :param priority: Jobs with a higher priority run first
+        :param key: Jobs with the same key coalesce while queued, or None
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.params = params
+        self.priority = priority
+        self.key = key
+        self.state = QUEUED
+        self.progress = None
+        self.detail = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+        self._cancel = Event()
+        self._done = Event()
+        self._on_change = None
+
+    def set_progress(self, progress, detail=None):
+        """
+        Called by the job function to report how far along it is
+        :param progress: A fraction between 0 and 1, or None if unknown
+        :param detail: An optional JSON serializable description of the progress
+        """
+        last_percent = int(self.progress * 100) if self.progress is not None else None
+        self.progress = progress
+        self.detail = detail
+        percent = int(progress * 100) if progress is not None else None
+        if self._on_change is not None and (percent != last_percent or detail is not None):
+            self._on_change(self)
+
+    def cancelled(self):
+        """
+        :return: Whether the job was asked to stop
+        """
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        """
+        Raises JobCancelled if the job was asked to stop
+        """
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the job to finish
+        :return: True if it finished
+        """
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'priority': self.priority,
+            'state': self.state,
+            'progress': self.progress,
+            'detail': self.detail,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'pid': os.getpid(),
+        }
+
+
+class JobStore:
+    """
+    Stores the state of each job in a JSON file, written atomically
+    """
+
+    DEFAULT_KEEP = 200
+
+    def __init__(self, directory, keep=DEFAULT_KEEP):
+        """
+        :param directory: The directory holding the job files. It is created if needed
+        :param keep: The number of finished jobs kept
+        """
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, 'job-{}.json'.format(job_id))
+
+    def save(self, record):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self._path(record['id']))
+
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def load_all(self):
+        """
+        :return: Every stored job record, most recent first
+        """
+        records = []
+        for name in os.listdir(self.directory):
+            if name.startswith('job-') and name.endswith('.json'):
+                record = self.load(name[len('job-'):-len('.json')])
+                if record is not None:
+                    records.append(record)
+        return sorted(records, key=lambda r: r['created'], reverse=True)
+
+    def prune(self):
+        """
+        Removes the oldest finished jobs beyond the number kept
+        """
+        finished = [r for r in self.load_all() if r['state'] in FINISHED_STATES]
+        for record in finished[self.keep:]:
+            try:
+                os.remove(self._path(record['id']))
+            except FileNotFoundError:
+                pass
+
+
+class JobScheduler:
+    """
+    Runs jobs on a bounded pool of worker threads, highest priority first, then in submission order.
+    Jobs with the same key never run at the same time. Worker threads are started on the first submission.
+    """
+
+    def __init__(self, workers=2, store=None):
+        """
+        :param workers: The number of jobs run at the same time
+        :param store: A JobStore persisting the state of jobs, or None to keep it in memory only
+        """
+        self.workers = workers
+        self.store = store
+
+        self._condition = Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._jobs = {}
+        self._running_keys = set()
+        self._finished = deque()
+        self._threads = []
+
+        if store is not None:
+            for record in store.load_all():
+                if record['state'] in (QUEUED, RUNNING) and not _process_alive(record.get('pid')):
+                    record['state'] = INTERRUPTED
+                    record['finished'] = time.time()
+                    store.save(record)
+
+    def _save(self, job):
+        if self.store is not None:
+            self.store.save(job.to_dict())
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = Thread(target=self._work, daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, kind, fn, params=None, priority=PRIORITY_NORMAL, key=None):
+        """
+        Queues a job, or returns the queued job with the same key. A coalesced job takes the highest of both priorities
+        :param kind: A name for the type of work
+        :param fn: The function run, called as fn(job, **params). Its return value becomes the job's result, and must be
+          JSON serializable
+        :param params: A JSON serializable dict of keyword arguments for `fn`
+        :param priority: Jobs with a higher priority run first
+        :param key: Jobs with the same key coalesce while queued, or None
+        :return: The Job
+        """
+        with self._condition:
+            if key is not None:
+                for job in self._jobs.values():
+                    if job.key == key and job.state == QUEUED:
+                        if priority > job.priority:
+                            job.priority = priority
+                            heapq.heappush(self._queue, (-priority, next(self._sequence), job))
+                            self._save(job)
+                        return job
+
+            job = Job(kind, fn, params or {}, priority, key)
+            job._on_change = self._save
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (-priority, next(self._sequence), job))
+            self._save(job)
+            self._start_workers()
+            self._condition.notify()
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job, or asks a running job to stop
+        :param job_id: The id of a job of this process
+        :return: The Job, or None if this process has no such job
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.state == QUEUED:
+                self._finish(job, CANCELLED)
+            elif job.state == RUNNING:
+                job._cancel.set()
+        return job
+
+    def get(self, job_id):
+        """
+        :return: The dict describing a job of any process, or None
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+        return self.store.load(job_id) if self.store is not None else None
+
+    def find(self, kind, state=None):
+        """
+        :return: The jobs of this process of the given kind, and optionally in the given state, most recent first
+        """
+        with self._condition:
+            jobs = [j for j in self._jobs.values() if j.kind == kind and (state is None or j.state == state)]
+        return sorted(jobs, key=lambda j: j.created, reverse=True)
+
+    def active(self):
+        """
+        :return: The jobs of this process that are queued or running
+        """
+        with self._condition:
+            return [j for j in self._jobs.values() if j.state in (QUEUED, RUNNING)]
+
+    def list(self):
+        """
+        :return: The dicts describing the jobs of every process, most recent first
+        """
+        with self._condition:
+            records = {job.id: job.to_dict() for job in self._jobs.values()}
+        if self.store is not None:
+            for record in self.store.load_all():
+                records.setdefault(record['id'], record)
+        return sorted(records.values(), key=lambda r: r['created'], reverse=True)
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished = time.time()
+        self._save(job)
+        job._done.set()
+        # Finished jobs stay listed through the store, so only the unfinished ones are kept in memory. Without a store,
+        # as many finished jobs are kept as a store would keep
+        if self.store is not None:
+            del self._jobs[job.id]
+        else:
+            self._finished.append(job.id)
+            while len(self._finished) > JobStore.DEFAULT_KEEP:
+                self._jobs.pop(self._finished.popleft(), None)
+
+    def _next_job(self):
+        """
+        Pops the next job to run, waiting for one if needed. A job is held back while a job with the same key runs
+        """
+        while True:
+            held = []
+            job = None
+            while len(self._queue) > 0:
+                entry = heapq.heappop(self._queue)
+                candidate = entry[2]
+                # Entries of cancelled jobs, and entries superseded by a priority bump, are dropped
+                if candidate.state != QUEUED or -entry[0] != candidate.priority:
+                    continue
+                if candidate.key is not None and candidate.key in self._running_keys:
+                    held.append(entry)
+                    continue
+                job = candidate
+                break
+            for entry in held:
+                heapq.heappush(self._queue, entry)
+            if job is not None:
+                return job
+            self._condition.wait()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                job.state = RUNNING
+                job.started = time.time()
+                if job.key is not None:
+                    self._running_keys.add(job.key)
+                self._save(job)
+
+            try:
+                job.result = job.fn(job, **job.params)
+                state = DONE
+            except JobCancelled:
+                state = CANCELLED
+            except Exception as e:
+                job.error = str(e)
+                state = FAILED
+
+            with self._condition:
+                self._running_keys.discard(job.key)
+                self._finish(job, state)
+                self._condition.notify_all()
+            METRICS.observe('corpalizer_job_duration_seconds', (('kind', job.kind), ('state', state)),
+                            job.finished - job.started)
+            if self.store is not None:
+                self.store.prune()
+
+
+def _process_alive(pid):
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
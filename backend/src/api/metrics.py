@@ -0,0 +1,283 @@
+"""
+Instrumentation of requests, SQL statements, pipeline stages and background jobs, exposed in the Prometheus text format
+by the /metrics endpoint.
+
+Everything is recorded in the process-wide registry `METRICS`, which records nothing until `create_app` enables it, so
+the command line tools and benchmarks only pay an attribute check per call site. Each server process keeps its own
+metrics.
+
+While a thread has a profile started, the SQL statements and stages it runs are also added to the profile. The app
+starts one for requests carrying a `X-Profile` header when PROFILING is enabled, and returns it in a Server-Timing
+header.
+"""
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+HISTOGRAM = 'histogram'
+
+"""
+Upper bounds of the histogram buckets, in seconds
+"""
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+_TABLE_PATTERNS = {
+    'select': re.compile(r'\bFROM\s+`?(\w+)', re.IGNORECASE),
+    'insert': re.compile(r'\bINTO\s+`?(\w+)', re.IGNORECASE),
+    'replace': re.compile(r'\bINTO\s+`?(\w+)', re.IGNORECASE),
+    'update': re.compile(r'^\s*UPDATE\s+`?(\w+)', re.IGNORECASE),
+    'delete': re.compile(r'\bFROM\s+`?(\w+)', re.IGNORECASE),
+}
+
+
+@lru_cache(maxsize=1024)
+def _statement_label(head):
+    words = head.split(None, 1)
+    if len(words) == 0:
+        return 'empty'
+    verb = words[0].lower()
+    pattern = _TABLE_PATTERNS.get(verb)
+    match = pattern.search(head) if pattern is not None else None
+    return '{}_{}'.format(verb, match.group(1).lower()) if match is not None else verb
+
+
+def statement_label(sql):
+    """
+    :param sql: A SQL statement
+    :return: A label naming the statement by its verb and first table, e.g. 'insert_document_term'
+    """
+    # Multi-row INSERTs are long and differ in length only, the verb and table are at the start
+    return _statement_label(sql[:256])
+
+
+class _Summary:
+    __slots__ = ('count', 'sum')
+
+    def __init__(self, buckets=None):
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+
+
+class _Histogram(_Summary):
+    __slots__ = ('buckets', 'bucket_counts')
+
+    def __init__(self, buckets):
+        super().__init__()
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+
+    def observe(self, value):
+        super().observe(value)
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    The metrics of a process. Labels are given as tuples of (name, value) pairs
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._families = {}
+        self._values = {}
+        self._local = threading.local()
+
+        self.describe('corpalizer_http_request_duration_seconds', HISTOGRAM, 'Latency of HTTP requests')
+        self.describe('corpalizer_sql_statement_duration_seconds', SUMMARY,
+                      'Number of SQL statements executed and time spent in them, by statement')
+        self.describe('corpalizer_stage_duration_seconds', SUMMARY,
+                      'Number of runs of each pipeline stage and time spent in them')
+        self.describe('corpalizer_job_duration_seconds', HISTOGRAM, 'Duration of finished background jobs')
+
+    def describe(self, name, kind, help_text, buckets=DEFAULT_BUCKETS):
+        """
+        Declares a metric
+        :param name: The name of the metric
+        :param kind: SUMMARY or HISTOGRAM
+        :param help_text: The description of the metric
+        :param buckets: The upper bounds of the buckets of a histogram
+        """
+        self._families[name] = (kind, help_text, buckets)
+        self._values.setdefault(name, {})
+
+    def observe(self, name, labels, value):
+        """
+        Adds an observation to a summary or histogram
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            values = self._values[name]
+            metric = values.get(labels)
+            if metric is None:
+                kind, _, buckets = self._families[name]
+                metric = values[labels] = (_Histogram if kind == HISTOGRAM else _Summary)(buckets)
+            metric.observe(value)
+
+    def start_profile(self):
+        """
+        Starts recording the statements and stages run by the current thread
+        """
+        self._local.profile = {}
+
+    def stop_profile(self):
+        """
+        :return: A dict mapping ('sql', label) and ('stage', name) to [count, seconds], or None if no profile was
+          started
+        """
+        profile = getattr(self._local, 'profile', None)
+        self._local.profile = None
+        return profile
+
+    def _add_to_profile(self, key, seconds):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            entry = profile.setdefault(key, [0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def observe_sql(self, label, seconds):
+        if not self.enabled:
+            return
+        self.observe('corpalizer_sql_statement_duration_seconds', (('statement', label),), seconds)
+        self._add_to_profile(('sql', label), seconds)
+
+    def observe_stage(self, stage, seconds):
+        if not self.enabled:
+            return
+        self.observe('corpalizer_stage_duration_seconds', (('stage', stage),), seconds)
+        self._add_to_profile(('stage', stage), seconds)
+
+    def instrument(self, conn):
+        """
+        :param conn: A DB-API connection
+        :return: The connection, with its cursors timing their statements if metrics are enabled
+        """
+        return InstrumentedConnection(conn, self) if self.enabled else conn
+
+    def render(self, samples=()):
+        """
+        :param samples: Additional (name, COUNTER or GAUGE, help, [(labels, value)]) metrics, sampled by the caller
+        :return: The metrics in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._families):
+                kind, help_text, buckets = self._families[name]
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, metric in sorted(self._values[name].items()):
+                    if kind == HISTOGRAM:
+                        cumulative = 0
+                        for bound, count in zip(buckets + ('+Inf',), metric.bucket_counts):
+                            cumulative += count
+                            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, (('le', bound),)),
+                                                                 cumulative))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(metric.sum)))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), metric.count))
+        for name, kind, help_text, values in samples:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in values:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedCursor:
+    """
+    A cursor recording the number of statements it executes and the time they take
+    """
+
+    def __init__(self, cursor, registry):
+        self._cursor = cursor
+        self._registry = registry
+
+    def execute(self, query, args=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            self._registry.observe_sql(statement_label(query), time.perf_counter() - start)
+
+    def executemany(self, query, args):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, args)
+        finally:
+            self._registry.observe_sql(statement_label(query), time.perf_counter() - start)
+
+    def callproc(self, procname, args=()):
+        start = time.perf_counter()
+        try:
+            return self._cursor.callproc(procname, args)
+        finally:
+            self._registry.observe_sql('call_{}'.format(procname), time.perf_counter() - start)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """
+    A connection handing out InstrumentedCursors
+    """
+
+    def __init__(self, conn, registry):
+        self._conn = conn
+        self._registry = registry
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._registry)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def server_timing(profile, total_seconds):
+    """
+    :param profile: A profile returned by `Registry.stop_profile`
+    :param total_seconds: The duration of the request
+    :return: The value of a Server-Timing header listing the time spent in each stage and statement, slowest first
+    """
+    entries = ['total;dur={:.3f}'.format(total_seconds * 1000)]
+    for (kind, name), (count, seconds) in sorted(profile.items(), key=lambda item: -item[1][1]):
+        entries.append('{}.{};desc="{} x{}";dur={:.3f}'.format(kind, name, name, count, seconds * 1000))
+    return ', '.join(entries)
+
+
+"""
+The registry of this process
+"""
+METRICS = Registry()
@@ -0,0 +1,78 @@
+-- Converts a SQLite database created before terms had integer ids, as migrations/006_term_ids.sql does for MySQL.
+-- Run by SQLiteStorage in a single transaction before schema_sqlite.sql, which then creates the indexes and views, with
+-- foreign keys off so that dropping the former tables does not cascade. Renaming the new tables renames the references
+-- to them.
+
+DROP VIEW IF EXISTS document_term_score;
+DROP VIEW IF EXISTS paragraph_term_score;
+DROP VIEW IF EXISTS sentence_term_score;
+
+CREATE TABLE term_new (
+    term_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    term_text VARCHAR(100) NOT NULL UNIQUE
+);
+-- In the order terms were added, which ids keep
+INSERT INTO term_new (term_text) SELECT term_text FROM term ORDER BY rowid;
+
+CREATE TABLE document_term_new (
+    document_id VARCHAR(100) REFERENCES document(document_id) ON DELETE CASCADE,
+    term_id INT REFERENCES term_new(term_id) ON DELETE CASCADE,
+    frequency INT,
+    PRIMARY KEY (document_id, term_id)
+) WITHOUT ROWID;
+INSERT INTO document_term_new (document_id, term_id, frequency)
+SELECT document_id, term_id, SUM(frequency) FROM document_term JOIN term_new USING (term_text)
+GROUP BY document_id, term_id;
+
+CREATE TABLE paragraph_term_new (
+    paragraph_id INT REFERENCES paragraph(paragraph_id) ON DELETE CASCADE,
+    term_id INT REFERENCES term_new(term_id) ON DELETE CASCADE,
+    frequency INT,
+    PRIMARY KEY (paragraph_id, term_id)
+) WITHOUT ROWID;
+INSERT INTO paragraph_term_new (paragraph_id, term_id, frequency)
+SELECT paragraph_id, term_id, SUM(frequency) FROM paragraph_term JOIN term_new USING (term_text)
+GROUP BY paragraph_id, term_id;
+
+CREATE TABLE sentence_term_new (
+    sentence_id INT REFERENCES sentence(sentence_id) ON DELETE CASCADE,
+    term_id INT REFERENCES term_new(term_id) ON DELETE CASCADE,
+    frequency INT,
+    PRIMARY KEY (sentence_id, term_id)
+) WITHOUT ROWID;
+INSERT INTO sentence_term_new (sentence_id, term_id, frequency)
+SELECT sentence_id, term_id, SUM(frequency) FROM sentence_term JOIN term_new USING (term_text)
+GROUP BY sentence_id, term_id;
+
+CREATE TABLE term_df_new (
+    level VARCHAR(20),
+    term_id INT REFERENCES term_new(term_id) ON DELETE CASCADE,
+    df INT,
+    PRIMARY KEY (level, term_id)
+);
+INSERT INTO term_df_new (level, term_id, df)
+SELECT level, term_id, df FROM term_df JOIN term_new USING (term_text);
+
+CREATE TABLE term_trend_new (
+    level VARCHAR(20),
+    term_id INT REFERENCES term_new(term_id) ON DELETE CASCADE,
+    day DATE,
+    frequency BIGINT NOT NULL,
+    PRIMARY KEY (level, term_id, day)
+);
+INSERT INTO term_trend_new (level, term_id, day, frequency)
+SELECT level, term_id, day, frequency FROM term_trend JOIN term_new USING (term_text);
+
+DROP TABLE document_term;
+DROP TABLE paragraph_term;
+DROP TABLE sentence_term;
+DROP TABLE term_df;
+DROP TABLE term_trend;
+DROP TABLE term;
+
+ALTER TABLE term_new RENAME TO term;
+ALTER TABLE document_term_new RENAME TO document_term;
+ALTER TABLE paragraph_term_new RENAME TO paragraph_term;
+ALTER TABLE sentence_term_new RENAME TO sentence_term;
+ALTER TABLE term_df_new RENAME TO term_df;
+ALTER TABLE term_trend_new RENAME TO term_trend;
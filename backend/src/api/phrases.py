@@ -0,0 +1,227 @@
+"""
+Phrase queries and keyword-in-context snippets, answered from the positions stored along with the term counts of
+paragraphs.
+
+Each `paragraph` row holds in `token_offsets` the offset of every word of the paragraph, stopwords included, relative to
+the paragraph, and each `paragraph_term` row holds in `positions` the ordinals of the words that are occurrences of its
+term. Both are arrays of increasing integers, delta-encoded and stored in the narrowest unsigned type holding the
+deltas, after a byte giving the size of that type. Positions are kept per paragraph, so that updating a paragraph
+only rewrites its own positions, and phrases are matched within a paragraph.
+
+A phrase is looked up from its rarest term, whose paragraphs are narrowed down by each other term. Since stopwords count
+as words, the terms of a phrase must be exactly as far apart as they are in the phrase. Each match is then checked word
+for word against the text, reading only its range from the document store, along with the context around it.
+"""
+
+import re
+import sys
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+from api.analysis import get_analyzer
+from api.sql import in_chunks, insert_rows, replace_on_conflict
+from api.terms import get_term_dictionary
+from api.tfidf import PARAGRAPH_LEVEL
+
+"""
+An occurrence of a phrase: its offsets within the document, and its text with the context on each side
+"""
+PhraseMatch = namedtuple('PhraseMatch', ['document_id', 'start', 'end', 'left', 'text', 'right'])
+
+"""
+A word, as split by the analyzer's tokenizer
+"""
+_WORD = re.compile(r'\w+')
+
+_TYPECODES = [(1 << 8 * array(c).itemsize, c) for c in ('B', 'H', 'I', 'Q')]
+
+
+def encode_positions(positions):
+    """
+    :param positions: An increasing list of non-negative integers
+    :return: The bytes of the delta-encoded list
+    """
+    deltas = [b - a for a, b in zip([0] + positions, positions)]
+    top = max(deltas, default=0)
+    values = array(next(c for limit, c in _TYPECODES if top < limit), deltas)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return bytes((values.itemsize,)) + values.tobytes()
+
+
+def decode_positions(data):
+    """
+    :param data: The bytes written by encode_positions
+    :return: The int64 array of the positions
+    """
+    return np.cumsum(np.frombuffer(data, dtype='<u{}'.format(data[0]), offset=1), dtype=np.int64)
+
+
+def encode_paragraph_positions(tokens, words, start, ids):
+    """
+    :param tokens: The Tokens of a paragraph
+    :param words: The start offsets of the words of the paragraph, which the tokens are a subset of
+    :param start: The offset of the paragraph, relative to which word offsets are stored
+    :param ids: A dict mapping every term of the tokens to its id
+    :return: The encoded word offsets of the paragraph, and a dict mapping the id of each of its terms to the encoded
+      ordinals of the words it occurs as. Terms sharing an id have their positions merged
+    """
+    positions = {}
+    i = 0
+    for token in tokens:
+        while words[i] != token.start:
+            i += 1
+        positions.setdefault(ids[token.term], []).append(i)
+    return encode_positions([w - start for w in words]), {t: encode_positions(p) for t, p in positions.items()}
+
+
+def _paragraphs_with_terms(cursor, term_ids):
+    """
+    :param term_ids: The ids of the terms of a phrase
+    :return: A dict mapping the ids of the paragraphs containing every term to dicts mapping the ids of the terms to
+      their encoded positions in the paragraph
+    """
+    term_ids = sorted(set(term_ids))
+    cursor.execute('SELECT term_id, df FROM term_df WHERE level = %s AND term_id IN ({})'.format(
+        ','.join(['%s'] * len(term_ids))), (PARAGRAPH_LEVEL.name,) + tuple(term_ids))
+    df = dict(cursor.fetchall())
+    term_ids.sort(key=lambda t: df.get(t, 0))
+    if df.get(term_ids[0], 0) <= 0:
+        return {}
+
+    # Paragraphs written before positions were stored have none, and are left out
+    cursor.execute('SELECT paragraph_id, positions FROM paragraph_term WHERE term_id = %s AND positions IS NOT NULL',
+                   (term_ids[0],))
+    positions = {paragraph_id: {term_ids[0]: data} for paragraph_id, data in cursor.fetchall()}
+    for term_id in term_ids[1:]:
+        found = {}
+        for chunk, placeholders in in_chunks(sorted(positions)):
+            cursor.execute('SELECT paragraph_id, positions FROM paragraph_term WHERE term_id = %s AND positions IS NOT '
+                           'NULL AND paragraph_id IN ({})'.format(placeholders), (term_id,) + tuple(chunk))
+            found.update(cursor.fetchall())
+        positions = {paragraph_id: {**positions[paragraph_id], term_id: data} for paragraph_id, data in found.items()}
+        if len(positions) == 0:
+            break
+    return positions
+
+
+def _phrase_starts(positions, query):
+    """
+    :param positions: A dict mapping the ids of the terms of a phrase to their encoded positions in a paragraph
+    :param query: A list of (term id, ordinal of the word in the phrase) pairs
+    :return: The sorted array of the ordinals at which the phrase would start in the paragraph, judging by its terms
+    """
+    decoded = {t: decode_positions(data) for t, data in positions.items()}
+    term_id, ordinal = query[0]
+    starts = decoded[term_id] - ordinal
+    for term_id, ordinal in query[1:]:
+        starts = starts[np.isin(starts + ordinal, decoded[term_id], assume_unique=True)]
+    return starts[starts >= 0]
+
+
+def find_phrase(cursor, document_store, phrase, limit=10, context=40):
+    """
+    Finds the occurrences of a phrase: the same words in the same order, whatever their case and the characters between
+    them. Matches are ordered by document id, then by offset, and paragraphs are only checked until `limit` matches are
+    found
+    :param cursor: The database cursor
+    :param document_store: The DocumentStore holding the texts of the documents
+    :param phrase: The phrase
+    :param limit: The maximum number of matches
+    :param context: The number of characters returned on each side of a match
+    :return: A list of PhraseMatches. Phrases made of stopwords only match nothing
+    """
+    analyzer = get_analyzer()
+    word_starts = []
+    tokens = analyzer.tokenize(phrase, word_starts)
+    if len(tokens) == 0:
+        return []
+    words = [_WORD.match(phrase, start).group().lower() for start in word_starts]
+    ids = get_term_dictionary(cursor).get_ids(cursor, {t.term for t in tokens})
+    if any(t.term not in ids for t in tokens):
+        return []
+    ordinals = {start: i for i, start in enumerate(word_starts)}
+    query = [(ids[t.term], ordinals[t.start]) for t in tokens]
+    positions = _paragraphs_with_terms(cursor, [t for t, _ in query])
+
+    paragraphs = []
+    for chunk, placeholders in in_chunks(sorted(positions)):
+        cursor.execute('SELECT paragraph_id, document_id, position_in_fullText FROM paragraph '
+                       'WHERE paragraph_id IN ({})'.format(placeholders), tuple(chunk))
+        paragraphs.extend(cursor.fetchall())
+    paragraphs.sort(key=lambda row: (row[1], row[2]))
+
+    matches = []
+    for paragraph_id, document_id, paragraph_start in paragraphs:
+        starts = _phrase_starts(positions[paragraph_id], query)
+        if len(starts) == 0:
+            continue
+        cursor.execute('SELECT token_offsets FROM paragraph WHERE paragraph_id = %s', (paragraph_id,))
+        offsets = decode_positions(cursor.fetchone()[0]) + paragraph_start
+        for first in starts:
+            if first + len(words) > len(offsets):
+                continue
+            word_offsets = offsets[first:first + len(words)]
+            # One more character than the last word, to tell whether the word goes on
+            window_start = max(int(word_offsets[0]) - context, 0)
+            window = document_store.get_range(document_id, window_start,
+                                              int(word_offsets[-1]) + len(words[-1]) + max(context, 1))
+            if window is None:
+                break
+            found = [_WORD.match(window, int(offset) - window_start) for offset in word_offsets]
+            if any(m is None or m.group().lower() != w for m, w in zip(found, words)):
+                continue
+            start, end = int(word_offsets[0]), found[-1].end() + window_start
+            matches.append(PhraseMatch(document_id, start, end, window[:start - window_start],
+                                       window[start - window_start:end - window_start],
+                                       window[end - window_start:end - window_start + context]))
+            if len(matches) >= limit:
+                return matches
+    return matches
+
+
+def index_positions(cursor, document_store, limit=100):
+    """
+    Stores the positions of paragraphs written before positions were, which phrase queries otherwise leave out. Their
+    documents are read from the document store and tokenized again, and only the terms the paragraphs are known to
+    contain get positions
+    :param cursor: The database cursor
+    :param document_store: The DocumentStore holding the texts of the documents
+    :param limit: The maximum number of documents indexed
+    :return: The number of documents indexed, which is 0 once every paragraph has positions
+    """
+    cursor.execute('SELECT DISTINCT document_id FROM paragraph WHERE token_offsets IS NULL LIMIT %s', (limit,))
+    document_ids = [document_id for document_id, in cursor.fetchall()]
+    analyzer = get_analyzer()
+
+    for document_id in document_ids:
+        text = document_store.get(document_id) or ''
+        cursor.execute('SELECT paragraph_id, position_in_fullText FROM paragraph WHERE document_id = %s '
+                       'ORDER BY position_in_fullText', (document_id,))
+        stored = cursor.fetchall()
+        cursor.execute('SELECT paragraph_id, term_id, frequency FROM paragraph_term '
+                       'JOIN paragraph USING (paragraph_id) WHERE document_id = %s', (document_id,))
+        frequencies = {(paragraph_id, term_id): f for paragraph_id, term_id, f in cursor.fetchall()}
+
+        tokenized = []
+        for i, (paragraph_id, start) in enumerate(stored):
+            end = stored[i + 1][1] if i + 1 < len(stored) else len(text)
+            words = []
+            tokens = analyzer.tokenize(text[start:end], words)
+            tokenized.append((paragraph_id, tokens, words))
+        ids = get_term_dictionary(cursor).get_ids(cursor, {t.term for _, tokens, _ in tokenized for t in tokens})
+
+        offset_rows = []
+        term_rows = []
+        for paragraph_id, tokens, words in tokenized:
+            offsets, positions = encode_paragraph_positions([t for t in tokens if t.term in ids], words, 0, ids)
+            offset_rows.append((offsets, paragraph_id))
+            term_rows.extend((frequencies[paragraph_id, t], paragraph_id, t, data)
+                             for t, data in sorted(positions.items()) if (paragraph_id, t) in frequencies)
+        cursor.executemany('UPDATE paragraph SET token_offsets = %s WHERE paragraph_id = %s', offset_rows)
+        insert_rows(cursor, 'INSERT INTO paragraph_term (frequency, paragraph_id, term_id, positions) VALUES',
+                    '(%s, %s, %s, %s)', term_rows,
+                    suffix=replace_on_conflict(cursor, ('paragraph_id', 'term_id'), ('positions',)))
+    return len(document_ids)
@@ -0,0 +1,188 @@
+"""
+A pool of database connections shared by request handlers and background jobs.
+
+Connections are opened lazily up to the size of the pool and reused afterwards. Each is pinged when it is checked out,
+and reconnected if the server dropped it, and rolled back when it is returned, so every checkout starts a fresh
+transaction. The pool counts how long callers wait for a connection and how long they hold it.
+"""
+
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+
+from flask import g
+
+from api.metrics import METRICS
+from api.storage import Error
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection becomes available in time
+    """
+
+
+class ConnectionPool:
+    def __init__(self, storage, size=10, timeout=30, pre_ping=True):
+        """
+        :param storage: The MySQLStorage or SQLiteStorage connections are opened with
+        :param size: The maximum number of open connections
+        :param timeout: The number of seconds to wait for a connection before raising PoolTimeout
+        :param pre_ping: Whether to check that a connection is alive before handing it out
+        """
+        self.storage = storage
+        self.size = size
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+
+        self._idle = deque()
+        self._open = 0
+        self._checked_out = {}
+        self._condition = Condition()
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._wait_seconds = 0
+        self._max_wait_seconds = 0
+        self._checkout_seconds = 0
+
+    def _connect(self):
+        return METRICS.instrument(self.storage.connect())
+
+    def checkout(self, timeout=None):
+        """
+        Takes a connection from the pool, opening one if none is idle and the pool is not full
+        :param timeout: Overrides the pool's timeout, in seconds
+        :return: A DB-API connection, to be given back with `checkin`
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.perf_counter()
+        with self._condition:
+            while len(self._idle) == 0 and self._open >= self.size:
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout('no database connection available after {}s'.format(timeout))
+                self._condition.wait(remaining)
+            conn = self._idle.pop() if len(self._idle) > 0 else None
+            if conn is None:
+                self._open += 1
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif self.pre_ping:
+                try:
+                    self.storage.ping(conn)
+                except Error:
+                    self._close(conn)
+                    conn = self._connect()
+                    with self._condition:
+                        self._reconnects += 1
+        except BaseException:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+        now = time.perf_counter()
+        with self._condition:
+            self._checkouts += 1
+            self._wait_seconds += now - start
+            self._max_wait_seconds = max(self._max_wait_seconds, now - start)
+            self._checked_out[id(conn)] = now
+        return conn
+
+    def checkin(self, conn):
+        """
+        Gives a connection back to the pool, rolling back whatever it left uncommitted
+        :param conn: A connection returned by `checkout`
+        """
+        healthy = True
+        try:
+            conn.rollback()
+        except Error:
+            self._close(conn)
+            healthy = False
+
+        with self._condition:
+            checked_out = self._checked_out.pop(id(conn), None)
+            if checked_out is not None:
+                self._checkout_seconds += time.perf_counter() - checked_out
+            if healthy:
+                self._idle.append(conn)
+            else:
+                self._open -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Checks out a connection for the duration of a with block
+        """
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Error:
+            pass
+
+    def close(self):
+        """
+        Closes the idle connections. Connections still checked out are closed when they are given back
+        """
+        with self._condition:
+            while len(self._idle) > 0:
+                self._close(self._idle.pop())
+                self._open -= 1
+
+    def stats(self):
+        """
+        :return: A dict of the pool's size and usage counters. Times are in seconds
+        """
+        with self._condition:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': len(self._checked_out),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'reconnects': self._reconnects,
+                'wait_seconds_total': self._wait_seconds,
+                'wait_seconds_max': self._max_wait_seconds,
+                'checkout_seconds_total': self._checkout_seconds,
+            }
+
+
+class PooledDatabase:
+    """
+    Gives each Flask application context a connection from the pool, and returns it when the context ends
+    """
+
+    def __init__(self, pool, app=None):
+        self.pool = pool
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.teardown_appcontext(self.teardown)
+
+    @property
+    def connection(self):
+        if 'mysql_db' not in g:
+            g.mysql_db = self.pool.checkout()
+        return g.mysql_db
+
+    def teardown(self, exception):
+        conn = g.pop('mysql_db', None)
+        if conn is not None:
+            self.pool.checkin(conn)
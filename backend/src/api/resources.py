@@ -1,29 +1,84 @@
-import math
+import base64
+import json
 import os
+import time
 import uuid
-from threading import Thread, Lock
+from datetime import datetime
+from threading import Lock
 
-import pymysql
-from flask import request, current_app as app
-from flask_restful import Resource, reqparse
-from nltk.stem import PorterStemmer
+from flask import Response, request, stream_with_context, current_app as app
+from flask_restful import Resource, reqparse, inputs
 
+from api.analysis import get_analyzer
+from api.importer import import_corpus
+from api.jobs import PRIORITY_LOW, PRIORITY_NORMAL, QUEUED, RUNNING
+from api.metrics import COUNTER, GAUGE, METRICS
 from api.services import (
-    generate_topics,
+    cleanup_terms,
+    delete_document,
+    get_corpus_version,
+    get_unit_span,
     insert_document,
+    iter_documents,
+    list_documents,
     recompute_tfidf_scores,
+    update_document,
+)
+from api.phrases import find_phrase, index_positions
+from api.search import BM25, RANKINGS, SearchIndex
+from api.segmenters import check_segmenter
+from api.snapshot import load_snapshot, refresh_snapshot
+from api.sql import begin_read
+from api.tfidf import DOCUMENT_LEVEL, PARAGRAPH_LEVEL, SENTENCE_LEVEL
+from api.storage import OperationalError
+from api.topic_cache import TopicCache, params_key
+from api.topics import (
+    LSH_BANDS,
+    SIMILARITY_THRESHOLD,
+    TermDocumentMatrix,
+    generate_topics,
+    generate_topics_approximate,
+    topic_agreement,
 )
+from api.trends import BIN_FORMATS, get_trend, get_trends
 
 
 class DocumentRetrieveUpdateDeleteResource(Resource):
     def get(self, doc_uuid):
         """
-        Retrieves document content
+        Retrieves document content, or the content of one paragraph (`paragraph` argument, counted from 0), or of one
+        sentence of a paragraph (`paragraph` and `sentence` arguments)
         :param doc_uuid:
         :return:
         """
-        with open(os.path.join(app.config['documents_dir'], '{}.txt'.format(doc_uuid)), 'r') as f:
-            out = f.read()
+        from api import get_document_store, get_mysql
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('paragraph', type=inputs.natural, location='args')
+        parser.add_argument('sentence', type=inputs.natural, location='args')
+        args = parser.parse_args()
+
+        if args.paragraph is None:
+            if args.sentence is not None:
+                return {
+                           'error': 'a sentence is selected within a paragraph'
+                       }, 400
+            out = get_document_store().get(doc_uuid)
+        else:
+            cur = get_mysql().connection.cursor()
+            span = get_unit_span(doc_uuid, cur, args.paragraph, args.sentence)
+            if span is None:
+                return {
+                           'error': 'No such paragraph or sentence'
+                       }, 404
+            out = get_document_store().get_range(doc_uuid, *span)
+            if out is not None:
+                out = out.strip()
+
+        if out is None:
+            return {
+                       'error': 'No such document'
+                   }, 404
 
         return {
                    'content': out
@@ -31,11 +86,12 @@ class DocumentRetrieveUpdateDeleteResource(Resource):
 
     def put(self, doc_uuid):
         """
-        Updates document, and database
+        Updates document, and database. Only the paragraphs and sentences that changed are rewritten, see
+        update_document
         :param doc_uuid:
         :return:
         """
-        from api import get_mysql
+        from api import get_document_store, get_mysql
 
         parser = reqparse.RequestParser()
         parser.add_argument('content')
@@ -49,20 +105,19 @@ class DocumentRetrieveUpdateDeleteResource(Resource):
         try:
             cur = get_mysql().connection.cursor()
 
-            cur.execute('DELETE FROM document WHERE document_id = %s', (doc_uuid,))
-            insert_document(doc_uuid, text, cur)
-            recompute_tfidf_scores(cur)
-            cur.callproc('cleanup_terms')
-        except pymysql.err.OperationalError as e:
+            update_document(doc_uuid, get_document_store().get(doc_uuid), text, cur)
+            cleanup_terms(cur)
+        except OperationalError as e:
             get_mysql().connection.rollback()
             return {
                        'error': str(e)
                    }, 500
         else:
             get_mysql().connection.commit()
-            with open(os.path.join(app.config['documents_dir'], '{}.txt'.format(doc_uuid)), 'w+') as f:
-                f.write(text)
+            get_document_store().put(doc_uuid, text)
             TopicsResource.invalidate_cache()
+            SearchResource.document_replaced(cur, doc_uuid)
+            submit_compact_documents_if_needed()
 
             return None, 204
 
@@ -72,50 +127,90 @@ class DocumentRetrieveUpdateDeleteResource(Resource):
         :param doc_uuid:
         :return:
         """
-        from api import get_mysql
+        from api import get_document_store, get_mysql
 
         try:
             cur = get_mysql().connection.cursor()
 
-            cur.execute('DELETE FROM document WHERE document_id = %s', (doc_uuid,))
-            recompute_tfidf_scores(cur)
-            cur.callproc('cleanup_terms')
-        except pymysql.err.OperationalError as e:
+            delete_document(doc_uuid, cur)
+            cleanup_terms(cur)
+        except OperationalError as e:
             get_mysql().connection.rollback()
             return {
                        'error': str(e)
                    }, 500
         else:
             get_mysql().connection.commit()
-            try:
-                os.remove(os.path.join(app.config['documents_dir'], '{}.txt'.format(doc_uuid)))
-            except FileNotFoundError:
-                print("Corresponding file wasn't found")
+            get_document_store().delete(doc_uuid)
             TopicsResource.invalidate_cache()
+            SearchResource.document_removed(doc_uuid)
+            submit_compact_documents_if_needed()
             return None, 204
 
 
 class DocumentListCreateResource(Resource):
+    MAX_LIMIT = 10000
+
+    @staticmethod
+    def encode_cursor(doc_id, date):
+        return base64.urlsafe_b64encode(json.dumps([date.strftime('%Y-%m-%d'), doc_id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(value):
+        """
+        :return: The (timestamp, document_id) encoded in a cursor
+        """
+        try:
+            day, doc_id = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+            return datetime.strptime(day, '%Y-%m-%d').date(), doc_id
+        except (TypeError, ValueError):
+            raise ValueError('invalid cursor')
+
     def get(self):
+        """
+        Lists documents by date, then id. A page holds up to `limit` documents, and its `next` cursor is passed as the
+        `cursor` argument to get the following page. `start` and `end` restrict the dates listed. With `stream`, every
+        document is sent as one JSON object per line instead, read a page at a time
+        :return:
+        """
         from api import get_mysql
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=inputs.int_range(1, self.MAX_LIMIT), default=1000, location='args')
+        parser.add_argument('cursor', type=self.decode_cursor, location='args')
+        parser.add_argument('start', type=inputs.date, location='args')
+        parser.add_argument('end', type=inputs.date, location='args')
+        parser.add_argument('stream', type=inputs.boolean, default=False, location='args')
+        args = parser.parse_args()
+
+        def document(doc_id, date):
+            return {'id': doc_id, 'date': date.strftime('%Y-%m-%d')}
+
         cur = get_mysql().connection.cursor()
+        if args.stream:
+            return Response(stream_with_context(json.dumps(document(*row)) + '\n'
+                                                for row in iter_documents(cur, args.start, args.end)),
+                            mimetype='application/x-ndjson')
 
-        cur.execute('SELECT document_id, timestamp FROM document LIMIT 1000')
-        tuples = cur.fetchall()
+        # One more document than requested tells whether there is a next page
+        tuples = list_documents(cur, args.limit + 1, args.cursor, args.start, args.end)
+        next_cursor = self.encode_cursor(*tuples[args.limit - 1]) if len(tuples) > args.limit else None
 
         return {
-                   'documents': [{'id': doc_id, 'date': date.strftime('%Y-%m-%d')} for doc_id, date in tuples]
+                   'documents': [document(doc_id, date) for doc_id, date in tuples[:args.limit]],
+                   'next': next_cursor,
                }, 200
 
     def post(self):
-        from api import get_mysql
+        from api import get_document_store, get_mysql
 
         parser = reqparse.RequestParser()
         parser.add_argument('content')
-        parser.add_argument('auto_recompute_scores')
+        # Statistics are maintained incrementally, so a full recompute is only done on request
+        parser.add_argument('auto_recompute_scores', type=inputs.boolean, default=False)
         args = parser.parse_args()
         text = args.content
-        auto_recompute_scores = bool(args.auto_recompute_scores) if args.auto_recompute_scores is not None else True
+        auto_recompute_scores = args.auto_recompute_scores
         if text is None:
             return {
                        'error': 'no content'
@@ -125,14 +220,11 @@ class DocumentListCreateResource(Resource):
         try:
             cur = get_mysql().connection.cursor()
 
-            # Create file
-            with open(os.path.join(app.config['documents_dir'], '{}.txt'.format(doc_uuid)), 'w+') as f:
-                f.write(text)
+            # Store the text
+            get_document_store().put(doc_uuid, text)
 
             insert_document(doc_uuid, text, cur)
-            if auto_recompute_scores:
-                recompute_tfidf_scores(cur)
-        except pymysql.err.OperationalError as e:
+        except OperationalError as e:
             get_mysql().connection.rollback()
             return {
                        'error': str(e)
@@ -140,6 +232,9 @@ class DocumentListCreateResource(Resource):
         else:
             get_mysql().connection.commit()
             TopicsResource.invalidate_cache()
+            SearchResource.document_added(cur, doc_uuid)
+            if auto_recompute_scores:
+                submit_recompute_tfidf_scores()
 
             # Return document uuid as response
             return {
@@ -160,215 +255,783 @@ class TrendsResource(Resource):
     BIN_MONTH = 'month'
     BIN_YEAR = 'year'
 
+    LEVELS = {
+        GRANULARITY_DOCUMENT: DOCUMENT_LEVEL,
+        GRANULARITY_PARAGRAPH: PARAGRAPH_LEVEL,
+        GRANULARITY_SENTENCE: SENTENCE_LEVEL,
+    }
+
     def get(self, granularity, term_text):
         from api import get_mysql
 
-        stemmer = PorterStemmer()
-        stemmed_term_text = stemmer.stem(term_text, to_lowercase=True)
-
-        cur = get_mysql().connection.cursor()
+        stemmed_term_text = get_analyzer().stem(term_text)
 
         bin_type = request.args.get('bin_type', self.BIN_DAY)
 
-        if granularity == self.GRANULARITY_DOCUMENT:
-            cur.execute(
-                'SELECT frequency, timestamp FROM document_term JOIN document USING (document_id) WHERE term_text = %s',
-                (stemmed_term_text,))
-            freq_date_pairs = cur.fetchall()
-        elif granularity == self.GRANULARITY_PARAGRAPH:
-            cur.execute(
-                'SELECT frequency, timestamp FROM paragraph_term JOIN paragraph USING (paragraph_id) JOIN document'
-                ' USING (document_id) WHERE term_text = %s',
-                (stemmed_term_text,))
-            freq_date_pairs = cur.fetchall()
-        elif granularity == self.GRANULARITY_SENTENCE:
-            cur.execute(
-                'SELECT frequency, timestamp FROM sentence_term JOIN sentence USING (sentence_id) JOIN paragraph'
-                ' USING (paragraph_id) JOIN document USING (document_id) WHERE term_text = %s',
-                (stemmed_term_text,))
-            freq_date_pairs = cur.fetchall()
-        else:
+        if granularity not in self.LEVELS:
             return {
                        'error': 'unknown granularity'
                    }, 400
+        if bin_type not in BIN_FORMATS:
+            return {
+                       'error': 'unknown bin type'
+                   }, 400
 
-        date_to_freq_map = {}
-        date_format = {
-            self.BIN_DAY: '%Y-%m-%d',
-            self.BIN_MONTH: '%Y-%m',
-            self.BIN_YEAR: '%Y',
-        }
-        for freq, date in freq_date_pairs:
-            key = date.strftime(date_format[bin_type])
-            if key in date_to_freq_map:
-                date_to_freq_map[key] += freq
-            else:
-                date_to_freq_map[key] = freq
+        cur = get_mysql().connection.cursor()
+        date_to_freq_map = get_trend(cur, self.LEVELS[granularity], stemmed_term_text, bin_type)
 
         return {
                    'data': date_to_freq_map
                }, 200
 
 
+class BatchTrendsResource(Resource):
+    """
+    A resource for getting the trends of several terms at several granularities at once.
+    Terms are stemmed and deduplicated, and each granularity is read with a single query.
+    """
+
+    def get(self):
+        from api import get_mysql
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('term', dest='terms', action='append', required=True)
+        parser.add_argument('granularity', dest='granularities', action='append',
+                            default=[TrendsResource.GRANULARITY_DOCUMENT])
+        parser.add_argument('bin_type', default=TrendsResource.BIN_DAY)
+        parser.add_argument('start', type=inputs.date)
+        parser.add_argument('end', type=inputs.date)
+        parser.add_argument('stream', type=inputs.boolean, default=False)
+        args = parser.parse_args()
+
+        granularities = list(dict.fromkeys(args.granularities))
+        unknown = [g for g in granularities if g not in TrendsResource.LEVELS]
+        if len(unknown) > 0:
+            return {
+                       'error': 'unknown granularity ' + ', '.join(unknown)
+                   }, 400
+        if args.bin_type not in BIN_FORMATS:
+            return {
+                       'error': 'unknown bin type'
+                   }, 400
+
+        stem = get_analyzer().stem
+        inputs_by_term = {}
+        for term_text in args.terms:
+            inputs_by_term.setdefault(stem(term_text), []).append(term_text)
+
+        def series():
+            cur = get_mysql().connection.cursor()
+            for granularity in granularities:
+                trends = get_trends(cur, TrendsResource.LEVELS[granularity], inputs_by_term, args.bin_type,
+                                    args.start, args.end)
+                for term_text, term_inputs in inputs_by_term.items():
+                    yield {
+                        'granularity': granularity,
+                        'term': term_text,
+                        'inputs': term_inputs,
+                        'data': trends[term_text],
+                    }
+
+        if args.stream:
+            # One JSON object per line, sent as soon as the series of its granularity has been read
+            return Response(stream_with_context(json.dumps(x) + '\n' for x in series()),
+                            mimetype='application/x-ndjson')
+
+        return {
+                   'data': list(series())
+               }, 200
+
+    def post(self):
+        return self.get()
+
+
 class TopicsResource(Resource):
     """
-    A resources that asynchronously computes topics and stores a cached result.
+    A resources that computes topics in a background job, and caches the result of every corpus version on disk.
+    While the topics of the current corpus version are being computed, the most recent result is served, marked as
+    stale.
     """
 
-    topic_thread = None
-    topic_thread_lock = Lock()
+    MAX_BANDS = 1024
 
+    # (corpus version, params, result) of the last result served by this process
     cached_result = None
     cached_result_lock = Lock()
 
-    cancel_token = None
-    cancel_token_lock = Lock()
-
     @classmethod
     def invalidate_cache(cls):
-        pass
+        """
+        Drops the result held in memory. Results on disk are keyed by corpus version, so the write that called this has
+        already made them stale
+        """
+        cls.cached_result_lock.acquire()
+        cls.cached_result = None
+        cls.cached_result_lock.release()
 
     @classmethod
-    def _compute_topics(cls, cancellation_token, cancellation_token_lock):
-        from api import PYMYSQL_CONNECT_ARGS
-        conn = pymysql.connect(**PYMYSQL_CONNECT_ARGS)
+    def _get_cached_result(cls, cache, version, params):
+        cls.cached_result_lock.acquire()
+        try:
+            if cls.cached_result is not None and cls.cached_result[:2] == (version, params):
+                return cls.cached_result[2]
+        finally:
+            cls.cached_result_lock.release()
 
-        cur = conn.cursor()
+        result = cache.get(version, params)
+        if result is not None:
+            cls.cached_result_lock.acquire()
+            cls.cached_result = (version, params, result)
+            cls.cached_result_lock.release()
+        return result
 
-        cur.execute('SELECT term_text FROM term')
-        terms_list = [x[0] for x in cur.fetchall()]
-
-        similarity_score_fn_memo = {}
-
-        def similarity_score_fn(t1, t2):
-            if (t1, t2) in similarity_score_fn_memo:
-                return similarity_score_fn_memo[t1, t2]
-            cur.execute('SELECT compute_similarity_score(%s, %s)', (t1, t2))
-            ret = cur.fetchone()[0]
-            similarity_score_fn_memo[(t1, t2)] = ret
-            similarity_score_fn_memo[(t2, t1)] = ret
-            return ret
-
-        def geometric_mean_of_tfidf_scores_for_term_fn(term):
-            cur.execute('SELECT score FROM document_term WHERE term_text = %s', (term,))
-            scores = cur.fetchall()
-            product = 1
-            for score, in scores:
-                product *= score
-            product = math.pow(product, 1 / len(scores))
-            return product
+    @staticmethod
+    def topic_params(threshold, bands=None):
+        """
+        :param threshold: The similarity score threshold
+        :param bands: The number of LSH bands of the approximate mode, or None for the exact mode
+        :return: The parameters results are cached under
+        """
+        if bands is None:
+            return {'threshold': threshold}
+        return {'threshold': threshold, 'bands': bands}
 
-        def set_progress(progress):
-            cls.topic_thread_lock.acquire()
-            _, thread = cls.topic_thread
-            cls.topic_thread = (progress, thread)
-            cls.topic_thread_lock.release()
+    @staticmethod
+    def compute_topics(job, cache_dir, threshold, bands=None, snapshot_dir=None):
+        """
+        Job computing the topics of the current corpus version, unless they are cached or being computed elsewhere
+        :param bands: The number of LSH bands of the approximate mode, or None for the exact mode
+        :param snapshot_dir: The directory of the corpus snapshots, whose scores are read from a snapshot of the
+          current corpus version rather than from the database when there is one
+        """
+        from api import get_pool
+
+        params = TopicsResource.topic_params(threshold, bands)
+        cache = TopicCache(cache_dir)
+
+        # The version and the scores are read in the same transaction, so the result is cached under the version of
+        # the data it was computed from
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            begin_read(cur)
+            version = get_corpus_version(cur)
+            snapshot = load_snapshot(snapshot_dir, version) if snapshot_dir is not None else None
+            if snapshot is not None:
+                matrix = TermDocumentMatrix.from_snapshot(snapshot)
+            else:
+                matrix = TermDocumentMatrix.load(cur)
+            cur.close()
+
+        if cache.get(version, params) is not None or not cache.try_lock(version, params):
+            return {'version': version}
 
-        def poll_cancel():
-            cancellation_token_lock.acquire()
-            ret = cancellation_token[0]
-            cancellation_token_lock.release()
-            return ret
+        def set_progress(progress):
+            last_progress = job.progress or 0
+            job.set_progress(progress)
+            if int(progress * 100) != int(last_progress * 100):
+                cache.set_progress(version, params, progress)
 
         try:
-            results = generate_topics(
-                terms_list,
-                similarity_score_fn,
-                geometric_mean_of_tfidf_scores_for_term_fn,
-                set_progress_callback=set_progress,
-                poll_cancel=poll_cancel,
-            )
+            try:
+                if bands is None:
+                    results = generate_topics(
+                        matrix,
+                        threshold=threshold,
+                        set_progress_callback=set_progress,
+                        poll_cancel=job.cancelled,
+                    )
+                else:
+                    results = generate_topics_approximate(
+                        matrix,
+                        threshold=threshold,
+                        bands=bands,
+                        set_progress_callback=set_progress,
+                        poll_cancel=job.cancelled,
+                    )
+            except Exception:
+                job.check_cancelled()
+                raise
+            cache.put(version, params, results)
+        finally:
+            cache.unlock(version, params)
+
+        return {'version': version, 'topics': len(results)}
 
-            cls.cached_result_lock.acquire()
-            cls.cached_result = results
-            cls.cached_result_lock.release()
-        except Exception as e:
-            pass
+    @classmethod
+    def job_key(cls, threshold, bands=None):
+        return 'topics-{}'.format(params_key(cls.topic_params(threshold, bands)))
 
-        cur.close()
-        conn.close()
+    @classmethod
+    def submit(cls, threshold=SIMILARITY_THRESHOLD, bands=None, priority=PRIORITY_NORMAL):
+        from api import get_scheduler
+
+        return get_scheduler().submit('topics', cls.compute_topics, {
+            'cache_dir': app.config['topics_cache_dir'],
+            'threshold': threshold,
+            'bands': bands,
+            'snapshot_dir': app.config['snapshot_dir'],
+        }, priority=priority, key=cls.job_key(threshold, bands))
 
     @classmethod
     def get(cls):
+        from api import get_mysql, get_scheduler
+
         parser = reqparse.RequestParser()
-        parser.add_argument('cancel')
+        parser.add_argument('cancel', type=inputs.boolean, default=False)
+        parser.add_argument('threshold', type=float, default=SIMILARITY_THRESHOLD, location='args')
+        parser.add_argument('approximate', type=inputs.boolean, default=False, location='args')
+        parser.add_argument('bands', type=inputs.int_range(1, cls.MAX_BANDS), default=LSH_BANDS, location='args')
         args = parser.parse_args()
 
-        cancel = bool(args.cancel) if args.cancel is not None else None
+        cancel = args.cancel
+        bands = args.bands if args.approximate is True else None
+        params = cls.topic_params(args.threshold, bands)
+        cache = TopicCache(app.config['topics_cache_dir'])
 
-        cls.cached_result_lock.acquire()
-        if cls.cached_result is not None:
-            result = cls.cached_result
-            cls.cached_result_lock.release()
-            cls.topic_thread_lock.acquire()
-            if cls.topic_thread is not None:
-                cls.topic_thread = None
-            cls.topic_thread_lock.release()
+        key = cls.job_key(args.threshold, bands)
+        running = next((j for j in get_scheduler().find('topics') if j.state in (QUEUED, RUNNING) and j.key == key),
+                       None)
+
+        if cancel is True:
+            if running is None:
+                return {
+                           'error': 'No currently running process to cancel'
+                       }, 400
+
+            get_scheduler().cancel(running.id)
+            running.wait()
+            return {
+                       'status': 'cancelled',
+                       'job': running.id,
+                   }, 200
+
+        cur = get_mysql().connection.cursor()
+        version = get_corpus_version(cur)
+        result = cls._get_cached_result(cache, version, params)
+        if result is not None:
+            response = {
+                'status': 'done',
+                'version': version,
+                'result': result
+            }
+            # The accuracy of the approximate mode, measured against the exact topics of the same version if they
+            # were computed
+            exact = cache.get(version, cls.topic_params(args.threshold)) if bands is not None else None
+            if exact is not None:
+                response['agreement'] = topic_agreement(exact, result)
+            return response, 200
+
+        # Start computing the current version, unless this process or another one already is
+        lock = cache.lock_owner(version, params)
+        if running is not None:
+            status, progress, job_id = 'running', running.progress or 0, running.id
+        elif lock is not None:
+            status, progress, job_id = 'running', lock['progress'], None
+        else:
+            job = cls.submit(args.threshold, bands)
+            status, progress, job_id = 'started', 0, job.id
+
+        stale = cache.latest(params)
+        if stale is not None:
+            stale_version, stale_result = stale
             return {
                        'status': 'done',
-                       'result': result
+                       'stale': True,
+                       'version': stale_version,
+                       'result': stale_result,
+                       'progress': progress,
+                       'job': job_id,
                    }, 200
-        cls.cached_result_lock.release()
 
-        cls.topic_thread_lock.acquire()
-        if cls.topic_thread is not None:
-            if cancel is True:
-                cls.cancel_token_lock.acquire()
-                cls.cancel_token[0] = True
-                cls.cancel_token_lock.release()
+        return {
+                   'status': status,
+                   'progress': progress,
+                   'job': job_id,
+               }, 200
 
-                _, thread = cls.topic_thread
 
-                # release while waiting for thread to stop
-                cls.topic_thread_lock.release()
-                thread.join()
-                cls.cancel_token_lock.acquire()
+class SearchResource(Resource):
+    """
+    A resource ranking the documents, paragraphs or sentences matching a query, from an in-memory inverted index.
+    The index is built by a background job, then kept up to date by the document resources of this process. Writes made
+    by other processes or jobs are noticed by comparing corpus versions, at most every `search_refresh_seconds`, and
+    the index is then rebuilt in the background while queries are answered from the current one.
+    """
 
-                cls.topic_thread = None
-                cls.topic_thread_lock.release()
-                return {
-                           'status': 'cancelled',
-                       }, 200
+    MAX_K = 1000
 
-            progress = cls.topic_thread[0]
-            cls.topic_thread_lock.release()
-            return {
-                       'status': 'running',
-                       'progress': progress,
-                   }, 200
+    index = None
+    index_lock = Lock()
+    last_check = 0
+
+    @classmethod
+    def document_added(cls, cur, doc_uuid):
+        """
+        Adds a committed document to the index
+        :param cur: A cursor reading the committed document
+        """
+        index = cls.index
+        if index is not None:
+            index.add_document(cur, doc_uuid)
 
-        cls.topic_thread_lock.release()
+    @classmethod
+    def document_replaced(cls, cur, doc_uuid):
+        """
+        Re-indexes a document updated by a committed transaction
+        :param cur: A cursor reading the committed document
+        """
+        index = cls.index
+        if index is not None:
+            index.replace_document(cur, doc_uuid)
+            if index.needs_rebuild():
+                cls.submit()
 
-        if cancel is True:
+    @classmethod
+    def document_removed(cls, doc_uuid):
+        """
+        Removes a document deleted by a committed transaction from the index
+        """
+        index = cls.index
+        if index is not None:
+            index.remove_document(doc_uuid)
+            if index.needs_rebuild():
+                cls.submit()
+
+    @classmethod
+    def build_index(cls, job, snapshot_dir=None):
+        """
+        Job building the search index of the current corpus version, from a snapshot of that version if there is one
+        in `snapshot_dir`
+        """
+        from api import get_pool
+
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            # The index is built from the data of the version it is tagged with
+            begin_read(cur)
+            version = get_corpus_version(cur)
+            snapshot = load_snapshot(snapshot_dir, version) if snapshot_dir is not None else None
+            if snapshot is not None:
+                index = SearchIndex.from_snapshot(snapshot)
+            else:
+                index = SearchIndex.load(cur, version, set_progress_callback=job.set_progress,
+                                         poll_cancel=job.cancelled)
+            cur.close()
+        job.check_cancelled()
+
+        cls.index_lock.acquire()
+        cls.index = index
+        cls.index_lock.release()
+        return {'version': version}
+
+    @classmethod
+    def submit(cls, priority=PRIORITY_LOW):
+        """
+        Queues a build of the search index. Builds queued at the same time run once
+        """
+        from api import get_scheduler
+
+        return get_scheduler().submit('search_index', cls.build_index, {'snapshot_dir': app.config['snapshot_dir']},
+                                      priority=priority, key='search_index')
+
+    @classmethod
+    def _check_version(cls, index):
+        """
+        Queues a rebuild if the corpus changed in ways the index was not told about
+        """
+        from api import get_mysql, get_scheduler
+
+        cls.index_lock.acquire()
+        try:
+            if time.monotonic() - cls.last_check < app.config['search_refresh_seconds']:
+                return
+            cls.last_check = time.monotonic()
+        finally:
+            cls.index_lock.release()
+
+        cur = get_mysql().connection.cursor()
+        if get_corpus_version(cur) != index.expected_version or index.needs_rebuild():
+            if not any(j.state in (QUEUED, RUNNING) for j in get_scheduler().find('search_index')):
+                cls.submit()
+
+    @classmethod
+    def get(cls):
+        """
+        Ranks the units of granularity `granularity` by their relevance to the terms of `q`, with BM25 or the tfidf
+        scores. While the index is being built, the status of the build job is returned instead
+        :return:
+        """
+        from api import get_scheduler
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', required=True, location='args')
+        parser.add_argument('granularity', default=TrendsResource.GRANULARITY_DOCUMENT, location='args')
+        parser.add_argument('ranking', choices=RANKINGS, default=BM25, location='args')
+        parser.add_argument('k', type=inputs.int_range(1, cls.MAX_K), default=10, location='args')
+        args = parser.parse_args()
+
+        if args.granularity not in TrendsResource.LEVELS:
             return {
-                       'error': 'No currently running process to cancel'
+                       'error': 'unknown granularity'
                    }, 400
 
-        cls.cancel_token = [False]
-        thread = Thread(target=cls._compute_topics, args=(cls.cancel_token, cls.cancel_token_lock))
-        thread.start()
-        cls.topic_thread = (0, thread)
+        index = cls.index
+        if index is None:
+            running = next((j for j in get_scheduler().find('search_index') if j.state in (QUEUED, RUNNING)), None)
+            if running is not None:
+                status, job = 'running', running
+            else:
+                status, job = 'started', cls.submit(PRIORITY_NORMAL)
+            return {
+                       'status': status,
+                       'progress': job.progress or 0,
+                       'job': job.id,
+                   }, 200
+
+        cls._check_version(index)
+        terms = list(dict.fromkeys(token.term for token in get_analyzer().tokenize(args.q)))
+        results = index.search(TrendsResource.LEVELS[args.granularity], terms, args.k, args.ranking)
 
         return {
-                   'status': 'started',
-                   'progress': 0,
+                   'status': 'done',
+                   'version': index.version,
+                   'terms': terms,
+                   'results': [{'id': unit_id, 'document_id': doc_id, 'score': score}
+                               for unit_id, doc_id, score in results],
                }, 200
 
 
-class RPCResource(Resource):
-    def post(self, function):
-        from api import get_mysql
+class PhraseResource(Resource):
+    """
+    A resource for finding the occurrences of a phrase, with keyword-in-context snippets
+    """
+
+    MAX_K = 1000
+    MAX_CONTEXT = 1000
+
+    def get(self):
+        """
+        Finds the occurrences of the phrase `q` within paragraphs, whatever their case and the characters between
+        words, with `context` characters of text on each side, see find_phrase
+        :return:
+        """
+        from api import get_document_store, get_mysql
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', required=True, location='args')
+        parser.add_argument('k', type=inputs.int_range(1, self.MAX_K), default=10, location='args')
+        parser.add_argument('context', type=inputs.int_range(0, self.MAX_CONTEXT), default=40, location='args')
+        args = parser.parse_args()
 
         cur = get_mysql().connection.cursor()
+        matches = find_phrase(cur, get_document_store(), args.q, args.k, args.context)
+
+        return {
+                   'terms': [token.term for token in get_analyzer().tokenize(args.q)],
+                   'results': [m._asdict() for m in matches],
+               }, 200
+
+
+def recompute_tfidf_scores_job(job):
+    """
+    Job recomputing the tfidf statistics and trend rollups
+    """
+    from api import get_pool
+
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        recompute_tfidf_scores(cur)
+        cur.close()
+        conn.commit()
+    TopicsResource.invalidate_cache()
+
+
+def import_corpus_job(job, path, workers=None, batch_size=200, segmenter=None):
+    """
+    Job importing a directory or JSONL file, see import_corpus
+    """
+    from api import get_document_store, get_pool
+
+    try:
+        result = import_corpus(path, get_pool(), get_document_store(), workers=workers, batch_size=batch_size,
+                               progress_callback=lambda progress: job.set_progress(None, progress._asdict()),
+                               poll_cancel=job.cancelled, segmenter=segmenter)
+    finally:
+        TopicsResource.invalidate_cache()
+    job.check_cancelled()
+    return result._asdict()
+
+
+def submit_recompute_tfidf_scores(priority=PRIORITY_LOW):
+    """
+    Queues a recompute of the tfidf statistics. Recomputes queued at the same time run once
+    """
+    from api import get_scheduler
+
+    return get_scheduler().submit('recompute_tfidf_scores', recompute_tfidf_scores_job, priority=priority,
+                                  key='recompute_tfidf_scores')
+
+
+def submit_import_corpus(priority=PRIORITY_NORMAL):
+    """
+    Queues the import described by the request arguments `path`, `workers`, `batch_size` and `segmenter`
+    """
+    from api import get_scheduler
+
+    parser = reqparse.RequestParser()
+    parser.add_argument('path', required=True)
+    parser.add_argument('workers', type=int)
+    parser.add_argument('batch_size', type=int, default=200)
+    parser.add_argument('segmenter', type=check_segmenter)
+    args = parser.parse_args()
+
+    return get_scheduler().submit('import_corpus', import_corpus_job, {
+        'path': args.path,
+        'workers': args.workers,
+        'batch_size': args.batch_size,
+        'segmenter': args.segmenter,
+    }, priority=priority, key='import_corpus-{}'.format(os.path.abspath(args.path)))
+
+
+def compact_documents_job(job):
+    """
+    Job reclaiming the space of deleted and replaced documents in the document store
+    """
+    from api import get_document_store
+
+    reclaimed = get_document_store().compact(poll_cancel=job.cancelled)
+    job.check_cancelled()
+    return {'reclaimed_bytes': reclaimed, 'garbage_ratio': get_document_store().garbage_ratio()}
+
+
+def submit_compact_documents(priority=PRIORITY_LOW):
+    """
+    Queues a compaction of the document store. Compactions queued at the same time run once
+    """
+    from api import get_scheduler
+
+    return get_scheduler().submit('compact_documents', compact_documents_job, priority=priority,
+                                  key='compact_documents')
+
+
+def index_positions_job(job, batch_size=100):
+    """
+    Job storing the positions of the paragraphs written before positions were, a batch of documents per transaction
+    """
+    from api import get_document_store, get_pool
+
+    indexed = 0
+    while True:
+        job.check_cancelled()
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            count = index_positions(cur, get_document_store(), batch_size)
+            cur.close()
+            conn.commit()
+        if count == 0:
+            return {'documents': indexed}
+        indexed += count
+        job.set_progress(None, {'documents': indexed})
+
+
+def submit_index_positions(priority=PRIORITY_LOW):
+    """
+    Queues the indexing of the positions missing from earlier paragraphs. Indexings queued at the same time run once
+    """
+    from api import get_scheduler
+
+    return get_scheduler().submit('index_positions', index_positions_job, priority=priority, key='index_positions')
+
+
+def snapshot_job(job, snapshot_dir):
+    """
+    Job refreshing the corpus snapshot, see snapshot.py
+    """
+    from api import get_pool
+
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        snapshot = refresh_snapshot(cur, snapshot_dir, set_progress_callback=job.set_progress,
+                                    poll_cancel=job.cancelled)
+        cur.close()
+        conn.commit()
+    job.check_cancelled()
+    return {'version': snapshot.version, 'path': snapshot.path, 'documents': len(snapshot.document_ids),
+            'terms': len(snapshot.term_ids)}
+
+
+def submit_snapshot(priority=PRIORITY_LOW):
+    """
+    Queues a refresh of the corpus snapshot. Refreshes queued at the same time run once
+    """
+    from api import get_scheduler
+
+    return get_scheduler().submit('snapshot', snapshot_job, {'snapshot_dir': app.config['snapshot_dir']},
+                                  priority=priority, key='snapshot')
+
+
+def submit_compact_documents_if_needed():
+    """
+    Queues a compaction of the document store if enough of it is taken by deleted documents
+    """
+    from api import get_document_store
 
+    if get_document_store().needs_compaction():
+        submit_compact_documents()
+
+
+class RPCResource(Resource):
+    def post(self, function):
+        """
+        Starts a procedure as a background job
+        :param function: The name of the procedure
+        :return: The job, which can be followed at /jobs/<id>
+        """
         if function == 'recompute_tfidf_scores':
-            recompute_tfidf_scores(cur)
-            get_mysql().connection.commit()
+            job = submit_recompute_tfidf_scores()
+        elif function == 'import_corpus':
+            job = submit_import_corpus()
+        elif function == 'compact_documents':
+            job = submit_compact_documents()
+        elif function == 'index_positions':
+            job = submit_index_positions()
+        elif function == 'snapshot':
+            job = submit_snapshot()
+        else:
+            return {
+                       'error': 'Unknown procedure ' + function
+                   }, 400
+
+        return {
+                   'status': 'accepted',
+                   'job': job.to_dict(),
+               }, 202
+
+
+class JobListResource(Resource):
+    """
+    A resource for listing and starting background jobs
+    """
+
+    def get(self):
+        from api import get_scheduler
 
+        parser = reqparse.RequestParser()
+        parser.add_argument('kind', location='args')
+        parser.add_argument('state', location='args')
+        args = parser.parse_args()
+
+        return {
+                   'jobs': [job for job in get_scheduler().list()
+                            if (args.kind is None or job['kind'] == args.kind)
+                            and (args.state is None or job['state'] == args.state)]
+               }, 200
+
+    def post(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('kind', required=True)
+        parser.add_argument('priority', type=int)
+        parser.add_argument('threshold', type=float, default=SIMILARITY_THRESHOLD)
+        parser.add_argument('approximate', type=inputs.boolean, default=False)
+        parser.add_argument('bands', type=inputs.int_range(1, TopicsResource.MAX_BANDS), default=LSH_BANDS)
+        args = parser.parse_args()
+
+        priority = {} if args.priority is None else {'priority': args.priority}
+        if args.kind == 'recompute_tfidf_scores':
+            job = submit_recompute_tfidf_scores(**priority)
+        elif args.kind == 'import_corpus':
+            job = submit_import_corpus(**priority)
+        elif args.kind == 'compact_documents':
+            job = submit_compact_documents(**priority)
+        elif args.kind == 'index_positions':
+            job = submit_index_positions(**priority)
+        elif args.kind == 'snapshot':
+            job = submit_snapshot(**priority)
+        elif args.kind == 'topics':
+            job = TopicsResource.submit(args.threshold, args.bands if args.approximate is True else None, **priority)
+        elif args.kind == 'search_index':
+            job = SearchResource.submit(**priority)
+        else:
             return {
-                       'status': 'success'
-                   }, 200
+                       'error': 'Unknown job kind ' + args.kind
+                   }, 400
 
         return {
-                   'error': 'Unknown procedure ' + function
-               }, 400
+                   'job': job.to_dict()
+               }, 202
+
+
+class JobResource(Resource):
+    """
+    A resource for following and cancelling a background job
+    """
+
+    def get(self, job_id):
+        from api import get_scheduler
+
+        job = get_scheduler().get(job_id)
+        if job is None:
+            return {
+                       'error': 'No such job'
+                   }, 404
+
+        return {
+                   'job': job
+               }, 200
+
+    def delete(self, job_id):
+        from api import get_scheduler
+
+        job = get_scheduler().cancel(job_id)
+        if job is None:
+            if get_scheduler().get(job_id) is None:
+                return {
+                           'error': 'No such job'
+                       }, 404
+            return {
+                       'error': 'The job belongs to another process, or has finished'
+                   }, 409
+
+        return {
+                   'job': job.to_dict()
+               }, 202
+
+
+class MetricsResource(Resource):
+    """
+    Exposes the metrics of this process in the Prometheus text format
+    """
+
+    def get(self):
+        from api import get_document_store, get_pool, get_scheduler
+
+        stats = get_pool().stats()
+        jobs = get_scheduler().active()
+        job_counts = {}
+        for job in jobs:
+            job_counts[(job.kind, job.state)] = job_counts.get((job.kind, job.state), 0) + 1
+
+        samples = [
+            ('corpalizer_db_pool_connections', GAUGE, 'Connections of the database pool, by state',
+             [((('state', 'open'),), stats['open']), ((('state', 'idle'),), stats['idle']),
+              ((('state', 'in_use'),), stats['in_use']), ((('state', 'max'),), stats['size'])]),
+            ('corpalizer_db_pool_checkouts_total', COUNTER, 'Connections checked out of the pool',
+             [((), stats['checkouts'])]),
+            ('corpalizer_db_pool_timeouts_total', COUNTER, 'Checkouts that timed out waiting for a connection',
+             [((), stats['timeouts'])]),
+            ('corpalizer_db_pool_reconnects_total', COUNTER, 'Connections replaced after failing their ping',
+             [((), stats['reconnects'])]),
+            ('corpalizer_db_pool_wait_seconds_total', COUNTER, 'Time spent waiting for a connection',
+             [((), stats['wait_seconds_total'])]),
+            ('corpalizer_db_pool_checkout_seconds_total', COUNTER, 'Time connections were held by their callers',
+             [((), stats['checkout_seconds_total'])]),
+            ('corpalizer_document_store_garbage_ratio', GAUGE,
+             'Fraction of the document store taken by deleted documents, which compaction reclaims',
+             [((), get_document_store().garbage_ratio())]),
+            ('corpalizer_jobs', GAUGE, 'Queued and running jobs of this process, by kind and state',
+             [((('kind', kind), ('state', state)), n) for (kind, state), n in sorted(job_counts.items())]),
+            ('corpalizer_job_progress', GAUGE, 'Progress of the running jobs of this process, between 0 and 1',
+             [((('kind', job.kind), ('id', job.id)), job.progress)
+              for job in jobs if job.state == RUNNING and job.progress is not None]),
+        ]
+        return Response(METRICS.render(samples), mimetype='text/plain; version=0.0.4')
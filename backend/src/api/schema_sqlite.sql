@@ -0,0 +1,134 @@
+-- The schema of corpalizer_schema.sql for the embedded SQLite backend, applied by SQLiteStorage when it opens a
+-- database. Every statement is idempotent. The stored procedures of the MySQL schema are implemented in Python, see
+-- cleanup_terms in backend/src/api/services.py.
+
+CREATE TABLE IF NOT EXISTS document (
+    document_id VARCHAR(100) PRIMARY KEY,
+    timestamp DATE,
+    term_count INT DEFAULT 0,
+    -- The corpus version of the last write to the document, see snapshot.py
+    corpus_version BIGINT,
+    -- Set on documents from an unfinished import, which are not counted in the tfidf statistics and trend rollups yet
+    statistics_pending BOOLEAN NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS paragraph (
+    paragraph_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    document_id VARCHAR(100) REFERENCES document(document_id) ON DELETE CASCADE,
+    position_in_fullText INT,
+    term_count INT DEFAULT 0,
+    -- The offsets of the words of the paragraph, see phrases.py
+    token_offsets BLOB
+);
+
+CREATE TABLE IF NOT EXISTS sentence (
+    sentence_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    paragraph_id INT REFERENCES paragraph(paragraph_id) ON DELETE CASCADE,
+    position_in_paragraph INT,
+    term_count INT DEFAULT 0
+);
+
+-- The term dictionary. Other tables refer to terms by id, see terms.py. Terms are never deleted, so that the ids cached
+-- by the app stay valid
+CREATE TABLE IF NOT EXISTS term (
+    term_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    term_text VARCHAR(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS document_term (
+    document_id VARCHAR(100) REFERENCES document(document_id) ON DELETE CASCADE,
+    term_id INT REFERENCES term(term_id) ON DELETE CASCADE,
+    frequency INT,
+    PRIMARY KEY (document_id, term_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS paragraph_term (
+    paragraph_id INT REFERENCES paragraph(paragraph_id) ON DELETE CASCADE,
+    term_id INT REFERENCES term(term_id) ON DELETE CASCADE,
+    frequency INT,
+    -- The ordinals of the words of the paragraph that are occurrences of the term
+    positions BLOB,
+    PRIMARY KEY (paragraph_id, term_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sentence_term (
+    sentence_id INT REFERENCES sentence(sentence_id) ON DELETE CASCADE,
+    term_id INT REFERENCES term(term_id) ON DELETE CASCADE,
+    frequency INT,
+    PRIMARY KEY (sentence_id, term_id)
+) WITHOUT ROWID;
+
+-- Serves the pages of GET /doc, ordered by date then id
+CREATE INDEX IF NOT EXISTS document_timestamp ON document (timestamp, document_id);
+
+-- InnoDB indexes foreign keys implicitly, SQLite does not
+CREATE INDEX IF NOT EXISTS paragraph_document ON paragraph (document_id);
+CREATE INDEX IF NOT EXISTS sentence_paragraph ON sentence (paragraph_id);
+CREATE INDEX IF NOT EXISTS document_term_term ON document_term (term_id);
+CREATE INDEX IF NOT EXISTS paragraph_term_term ON paragraph_term (term_id);
+CREATE INDEX IF NOT EXISTS sentence_term_term ON sentence_term (term_id);
+
+-- Number of units containing each term, per level ('document', 'paragraph' or 'sentence')
+CREATE TABLE IF NOT EXISTS term_df (
+    level VARCHAR(20),
+    term_id INT REFERENCES term(term_id) ON DELETE CASCADE,
+    df INT,
+    PRIMARY KEY (level, term_id)
+);
+
+-- Number of units per level
+CREATE TABLE IF NOT EXISTS unit_count (
+    level VARCHAR(20) PRIMARY KEY,
+    n INT
+);
+
+INSERT OR IGNORE INTO unit_count (level, n) VALUES ('document', 0), ('paragraph', 0), ('sentence', 0);
+
+-- Total frequency of each term on each day, per level, maintained by backend/src/api/trends.py
+CREATE TABLE IF NOT EXISTS term_trend (
+    level VARCHAR(20),
+    term_id INT REFERENCES term(term_id) ON DELETE CASCADE,
+    day DATE,
+    frequency BIGINT NOT NULL,
+    PRIMARY KEY (level, term_id, day)
+);
+
+-- Sources already imported by backend/src/import_corpus.py, so an interrupted import can resume.
+-- Rows are kept when their document is deleted, so that resuming an import does not bring it back.
+CREATE TABLE IF NOT EXISTS imported_source (
+    source_key VARCHAR(255) PRIMARY KEY,
+    document_id VARCHAR(100)
+);
+
+-- Incremented by every write to the corpus, used to key cached analyses such as topics
+CREATE TABLE IF NOT EXISTS corpus_version (
+    version BIGINT NOT NULL
+);
+
+INSERT INTO corpus_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM corpus_version);
+
+-- tfidf scores, computed at read time from the statistics maintained by backend/src/api/tfidf.py.
+-- LN is the natural logarithm, registered by SQLiteStorage.
+CREATE VIEW IF NOT EXISTS document_term_score AS
+SELECT dt.document_id, dt.term_id, dt.frequency,
+    (1e0 * dt.frequency / d.term_count) * LN(1e0 * c.n / df.df) AS score
+FROM document_term AS dt
+JOIN document AS d ON d.document_id = dt.document_id
+JOIN unit_count AS c ON c.level = 'document'
+LEFT JOIN term_df AS df ON df.level = 'document' AND df.term_id = dt.term_id;
+
+CREATE VIEW IF NOT EXISTS paragraph_term_score AS
+SELECT pt.paragraph_id, pt.term_id, pt.frequency,
+    (1e0 * pt.frequency / p.term_count) * LN(1e0 * c.n / df.df) AS score
+FROM paragraph_term AS pt
+JOIN paragraph AS p ON p.paragraph_id = pt.paragraph_id
+JOIN unit_count AS c ON c.level = 'paragraph'
+LEFT JOIN term_df AS df ON df.level = 'paragraph' AND df.term_id = pt.term_id;
+
+CREATE VIEW IF NOT EXISTS sentence_term_score AS
+SELECT st.sentence_id, st.term_id, st.frequency,
+    (1e0 * st.frequency / s.term_count) * LN(1e0 * c.n / df.df) AS score
+FROM sentence_term AS st
+JOIN sentence AS s ON s.sentence_id = st.sentence_id
+JOIN unit_count AS c ON c.level = 'sentence'
+LEFT JOIN term_df AS df ON df.level = 'sentence' AND df.term_id = st.term_id;
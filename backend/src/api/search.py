@@ -0,0 +1,336 @@
+"""
+Ranked search over an in-memory inverted index of the `*_term` tables.
+
+For every level, each term maps to a posting list: the internal ids of the units containing it, delta-encoded, and
+their frequencies, both stored in the narrowest unsigned integer type that holds them. Units get increasing internal
+ids as they are added, so new postings are appended at the end of the lists. Deleted units are flagged rather than
+removed, and the index is rebuilt once they take too much of it.
+"""
+
+import math
+from array import array
+from threading import RLock
+
+import numpy as np
+
+from api.tfidf import DOCUMENT_LEVEL, LEVELS
+
+BM25 = 'bm25'
+TFIDF = 'tfidf'
+RANKINGS = (BM25, TFIDF)
+
+"""
+BM25 parameters: `BM25_K1` bounds the contribution of repeated terms, and `BM25_B` sets how much longer units are
+penalized
+"""
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+"""
+Fraction of deleted units past which the index should be rebuilt
+"""
+MAX_DELETED_FRACTION = 0.25
+
+
+def _narrow(values):
+    """
+    :return: The non-negative integer array in the narrowest unsigned type holding its values
+    """
+    top = int(values.max()) if len(values) > 0 else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if top <= np.iinfo(dtype).max:
+            return values.astype(dtype)
+    return values.astype(np.uint64)
+
+
+class PostingList:
+    """
+    The units containing a term, in increasing order, with the term's frequency in each
+    """
+
+    __slots__ = ('_deltas', '_frequencies', '_tail')
+
+    def __init__(self, units=(), frequencies=()):
+        """
+        :param units: The increasing internal ids of the units
+        :param frequencies: The frequency of the term in each unit
+        """
+        units = np.asarray(units, dtype=np.int64)
+        self._deltas = _narrow(np.diff(units, prepend=0))
+        self._frequencies = _narrow(np.asarray(frequencies, dtype=np.int64))
+        self._tail = []
+
+    def append(self, unit, frequency):
+        """
+        Adds a unit, whose id must be greater than every id of the list
+        """
+        self._tail.append((unit, frequency))
+
+    def __len__(self):
+        return len(self._deltas) + len(self._tail)
+
+    def decode(self):
+        """
+        :return: The arrays of unit ids and frequencies
+        """
+        units = np.cumsum(self._deltas, dtype=np.int64)
+        frequencies = self._frequencies.astype(np.int64)
+        if len(self._tail) > 0:
+            units = np.concatenate((units, [u for u, _ in self._tail]))
+            frequencies = np.concatenate((frequencies, [f for _, f in self._tail]))
+            # Appended postings are encoded once they are read
+            self.__init__(units, frequencies)
+        return units, frequencies
+
+
+class _LevelIndex:
+    """
+    The posting lists and unit statistics of a level
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.documents = []
+        self.document_units = {}
+        self.lengths = array('q')
+        self.alive = bytearray()
+        self.postings = {}
+        self.live_count = 0
+        self.live_length = 0
+
+    def add_units(self, units):
+        """
+        :param units: A list of (unit key, term count, document id) tuples, ordered by key
+        :return: A dict mapping the keys of the units to their internal ids
+        """
+        ids = {}
+        for key, length, document_id in units:
+            unit = len(self.keys)
+            ids[key] = unit
+            self.keys.append(key)
+            self.documents.append(document_id)
+            self.document_units.setdefault(document_id, []).append(unit)
+            self.lengths.append(length or 0)
+            self.alive.append(1)
+            self.live_count += 1
+            self.live_length += length or 0
+        return ids
+
+    def remove_document(self, document_id):
+        for unit in self.document_units.pop(document_id, []):
+            self.alive[unit] = 0
+            self.live_count -= 1
+            self.live_length -= self.lengths[unit]
+
+
+class SearchIndex:
+    """
+    The inverted index of every level. Thread safe
+    """
+
+    def __init__(self, version):
+        """
+        :param version: The corpus version the index is built from
+        """
+        self.version = version
+        self.expected_version = version
+        self.levels = {level.name: _LevelIndex() for level in LEVELS}
+        self._lock = RLock()
+
+    @staticmethod
+    def _read_units(cursor, level, document_id=None):
+        where, args = ('WHERE document_id = %s', (document_id,)) if document_id is not None else ('', ())
+        cursor.execute('SELECT {0}.{1}, {0}.term_count, document_id FROM {0} {2} {3} ORDER BY {0}.{1}'.format(
+            level.unit_table, level.unit_key, level.document_join, where), args)
+        return cursor.fetchall()
+
+    @staticmethod
+    def _read_postings(cursor, level, document_id=None):
+        if document_id is None:
+            cursor.execute('SELECT term_text, {}, frequency FROM {} JOIN term USING (term_id)'.format(
+                level.unit_key, level.term_table))
+        else:
+            cursor.execute('SELECT term_text, {0}.{1}, {0}.frequency FROM {0} JOIN term USING (term_id) '
+                           'JOIN {2} USING ({1}) {3} WHERE document_id = %s'.format(
+                               level.term_table, level.unit_key, level.unit_table, level.document_join), (document_id,))
+        while True:
+            rows = cursor.fetchmany(10000)
+            if len(rows) == 0:
+                return
+            yield from rows
+
+    @classmethod
+    def load(cls, cursor, version, set_progress_callback=None, poll_cancel=None):
+        """
+        Builds the index of every level from the database
+        :param cursor: The database cursor
+        :param version: The corpus version of the data read by the cursor
+        :param set_progress_callback: A function called with the fraction of levels loaded so far
+        :param poll_cancel: A function returning True when loading should stop, checked between levels
+        :return: The SearchIndex, or None if loading was cancelled
+        """
+        index = cls(version)
+        document_ids = {}
+        for i, level in enumerate(LEVELS):
+            if poll_cancel is not None and poll_cancel() is True:
+                return None
+            level_index = index.levels[level.name]
+            # Units of the same document share their document id string
+            ids = level_index.add_units([(key, length, document_ids.setdefault(document_id, document_id))
+                                         for key, length, document_id in cls._read_units(cursor, level)])
+
+            grouped = {}
+            for term_text, key, frequency in cls._read_postings(cursor, level):
+                unit = ids.get(key)
+                if unit is not None:
+                    grouped.setdefault(term_text, []).append((unit, frequency))
+            for term_text, postings in grouped.items():
+                postings.sort()
+                level_index.postings[term_text] = PostingList([u for u, _ in postings], [f for _, f in postings])
+
+            if set_progress_callback is not None:
+                set_progress_callback((i + 1) / len(LEVELS))
+        return index
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Builds the index load would read, from a corpus snapshot
+        :param snapshot: The CorpusSnapshot
+        :return: The SearchIndex, at the corpus version of the snapshot
+        """
+        index = cls(snapshot.version)
+        document_ids = snapshot.document_ids.tolist()
+        for level in LEVELS:
+            matrix = snapshot.level(level)
+            level_index = index.levels[level.name]
+            # Units of the same document share their document id string
+            documents = [document_ids[d] for d in matrix.documents.tolist()]
+            keys = [document_ids[d] for d in matrix.keys.tolist()] if level is DOCUMENT_LEVEL else matrix.keys.tolist()
+            level_index.add_units(zip(keys, matrix.term_counts.tolist(), documents))
+
+            # Units are numbered in key order, like the rows of the snapshot
+            units = matrix.entry_units()
+            order = np.lexsort((units, matrix.terms))
+            units, terms, frequencies = units[order], matrix.terms[order], matrix.frequencies[order]
+            term_ids, starts = np.unique(terms, return_index=True)
+            ends = np.append(starts[1:], len(terms))
+            texts = snapshot.term_texts[snapshot.term_index(term_ids)].tolist()
+            for term_text, start, end in zip(texts, starts.tolist(), ends.tolist()):
+                level_index.postings[term_text] = PostingList(units[start:end], frequencies[start:end])
+        return index
+
+    def add_document(self, cursor, document_id):
+        """
+        Indexes a document written after the index was built
+        :param cursor: A cursor reading the committed document
+        :param document_id: The id of the document
+        """
+        document_id = str(document_id)
+        rows = self._read_document(cursor, document_id)
+        with self._lock:
+            self.expected_version += 1
+            if document_id in self.levels[LEVELS[0].name].document_units:
+                return
+            self._add_rows(document_id, rows)
+
+    def replace_document(self, cursor, document_id):
+        """
+        Re-indexes a document rewritten in place after the index was built, by a single write
+        :param cursor: A cursor reading the committed document
+        :param document_id: The id of the document
+        """
+        document_id = str(document_id)
+        rows = self._read_document(cursor, document_id)
+        with self._lock:
+            self.expected_version += 1
+            for level_index in self.levels.values():
+                level_index.remove_document(document_id)
+            self._add_rows(document_id, rows)
+
+    def remove_document(self, document_id):
+        """
+        Removes a document deleted after the index was built
+        """
+        with self._lock:
+            self.expected_version += 1
+            for level_index in self.levels.values():
+                level_index.remove_document(str(document_id))
+
+    def _read_document(self, cursor, document_id):
+        """
+        :return: A dict mapping the name of every level to the units and postings of the document, see load
+        """
+        return {level.name: (self._read_units(cursor, level, document_id),
+                             list(self._read_postings(cursor, level, document_id))) for level in LEVELS}
+
+    def _add_rows(self, document_id, rows):
+        """
+        Adds the units and postings read by _read_document. The caller holds the lock
+        """
+        for name, (units, postings) in rows.items():
+            level_index = self.levels[name]
+            ids = level_index.add_units([(key, length, document_id) for key, length, _ in units])
+            for term_text, key, frequency in sorted(postings, key=lambda p: (p[0], ids.get(p[1], -1))):
+                if key in ids:
+                    level_index.postings.setdefault(term_text, PostingList()).append(ids[key], frequency)
+
+    def needs_rebuild(self):
+        """
+        :return: Whether deleted units take enough of the index that it should be rebuilt
+        """
+        with self._lock:
+            return any(len(li.keys) > 0 and len(li.keys) - li.live_count > MAX_DELETED_FRACTION * len(li.keys)
+                       for li in self.levels.values())
+
+    def search(self, level, terms, k=10, ranking=BM25):
+        """
+        Ranks the units of a level by their relevance to the terms
+        :param level: The Level searched
+        :param terms: The list of stemmed query terms
+        :param k: The maximum number of results
+        :param ranking: BM25, or TFIDF for the scores of the `*_term_score` views
+        :return: A list of (unit key, document id, score) tuples, best first
+        """
+        with self._lock:
+            level_index = self.levels[level.name]
+            n = level_index.live_count
+            if n == 0:
+                return []
+            average_length = level_index.live_length / n
+            lengths = np.frombuffer(level_index.lengths, dtype=np.int64)
+            alive = np.frombuffer(level_index.alive, dtype=np.uint8).astype(bool)
+
+            matched_units = []
+            matched_scores = []
+            for term_text in dict.fromkeys(terms):
+                posting_list = level_index.postings.get(term_text)
+                if posting_list is None:
+                    continue
+                units, frequencies = posting_list.decode()
+                live = alive[units]
+                units, frequencies = units[live], frequencies[live]
+                df = len(units)
+                if df == 0:
+                    continue
+                if ranking == BM25:
+                    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[units] / average_length)
+                    scores = idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+                else:
+                    scores = frequencies / np.maximum(lengths[units], 1) * math.log(n / df)
+                matched_units.append(units)
+                matched_scores.append(scores)
+            del lengths
+
+            if len(matched_units) == 0:
+                return []
+            units, inverse = np.unique(np.concatenate(matched_units), return_inverse=True)
+            totals = np.bincount(inverse, weights=np.concatenate(matched_scores))
+            # Partial selection of the k best, then a sort of those only
+            if len(totals) > k:
+                best = np.argpartition(-totals, k - 1)[:k]
+            else:
+                best = np.arange(len(totals))
+            best = sorted(best, key=lambda i: (-totals[i], units[i]))
+            return [(level_index.keys[units[i]], level_index.documents[units[i]], float(totals[i])) for i in best]
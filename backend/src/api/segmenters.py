@@ -0,0 +1,184 @@
+"""
+Sentence segmenters, which split paragraphs into sentences for the sentence level.
+
+Every segmenter returns the same kind of spans as pysbd with `char_span=True`: the sentences of a paragraph cover it
+from its first non-whitespace character to its end, each one ending where the next one starts, so it holds the
+whitespace that follows it. Three are available, named by the SEGMENTER setting or per import job:
+  * PYSBD: pysbd's rule set, the reference, and the slowest per character
+  * RULES: a single regular expression splitting after terminal punctuation followed by an uppercase letter, a digit or
+    an opening quote, unless the word before is a known abbreviation or an initial
+  * SPACY: spaCy's `sentencizer` on a blank English pipeline, which segments many paragraphs at once with `nlp.pipe`.
+    'spacy:<model>' uses the sentence boundaries of an installed spaCy model instead, e.g. 'spacy:en_core_web_sm'
+pysbd and spaCy are only imported once a segmenter using them is built, see `python -m benchmarks.segmenters` for how
+the others agree with pysbd and how fast each one is.
+"""
+
+import re
+from threading import Lock, local
+
+PYSBD = 'pysbd'
+RULES = 'rules'
+SPACY = 'spacy'
+SEGMENTERS = (PYSBD, RULES, SPACY)
+
+"""
+Words that end with a period without ending a sentence, lowercased and without their final period
+"""
+ABBREVIATIONS = frozenset([
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'vs', 'etc', 'e.g', 'i.e', 'cf', 'al', 'approx', 'dept',
+    'est', 'fig', 'inc', 'ltd', 'co', 'corp', 'no', 'vol', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep',
+    'sept', 'oct', 'nov', 'dec', 'gen', 'gov', 'sen', 'rep', 'rev', 'capt', 'col', 'lt', 'sgt', 'u.s', 'a.m', 'p.m',
+])
+
+"""
+Terminal punctuation, then closing quotes or brackets, then whitespace, before what looks like the start of a sentence
+"""
+_BOUNDARY = re.compile(r'([.!?]+)["\'”’)\]]*\s+(?=["\'“‘(\[]?[A-Z0-9])')
+_FIRST = re.compile(r'\S')
+
+
+def _spans(paragraph, starts):
+    """
+    :param paragraph: The paragraph text
+    :param starts: The increasing offsets at which its sentences start, the first of which is its first non-whitespace
+      character
+    :return: The list of (start, end, text) tuples of the sentences
+    """
+    ends = starts[1:] + [len(paragraph)]
+    return [(start, end, paragraph[start:end]) for start, end in zip(starts, ends)]
+
+
+class Segmenter:
+    """
+    Splits paragraphs into sentences. Subclasses implement `segment`, and `segment_many` when they process batches
+    faster than paragraphs one at a time
+    """
+
+    name = None
+
+    def segment(self, paragraph):
+        """
+        :param paragraph: The paragraph text
+        :return: A list of (start, end, text) tuples, the offsets of each sentence within the paragraph and its text
+        """
+        raise NotImplementedError
+
+    def segment_many(self, paragraphs):
+        """
+        :param paragraphs: A list of paragraph texts
+        :return: The list of the sentences of each paragraph, see segment
+        """
+        return [self.segment(paragraph) for paragraph in paragraphs]
+
+
+class PysbdSegmenter(Segmenter):
+    """
+    pysbd segmenters keep per-call state, so each thread gets its own
+    """
+
+    name = PYSBD
+
+    def __init__(self):
+        self._local = local()
+
+    def segment(self, paragraph):
+        if not hasattr(self._local, 'segmenter'):
+            from pysbd import Segmenter as PysbdRules
+
+            self._local.segmenter = PysbdRules(char_span=True)
+        return [(s.start, s.end, s.sent) for s in self._local.segmenter.segment(paragraph)]
+
+
+class RuleSegmenter(Segmenter):
+    name = RULES
+
+    def __init__(self, abbreviations=ABBREVIATIONS):
+        """
+        :param abbreviations: The words after which a period does not end a sentence, see ABBREVIATIONS
+        """
+        self.abbreviations = abbreviations
+
+    def segment(self, paragraph):
+        first = _FIRST.search(paragraph)
+        if first is None:
+            return []
+        starts = [first.start()]
+        for match in _BOUNDARY.finditer(paragraph, first.start()):
+            if match.group(1) == '.':
+                end = match.start()
+                start = max(paragraph.rfind(' ', 0, end), paragraph.rfind('\t', 0, end), paragraph.rfind('\n', 0, end))
+                word = paragraph[start + 1:end].lstrip('"\'([').lower()
+                # Initials, such as the A. of John A. Smith, do not end sentences either
+                if word in self.abbreviations or (len(word) == 1 and word.isalpha()):
+                    continue
+            starts.append(match.end())
+        return _spans(paragraph, starts)
+
+
+class SpacySegmenter(Segmenter):
+    """
+    spaCy pipelines are shared by every thread, which take turns running them
+    """
+
+    name = SPACY
+
+    def __init__(self, model=None, batch_size=256):
+        """
+        :param model: The name of an installed spaCy model whose sentence boundaries are used, or None for the
+          rule-based `sentencizer`
+        :param batch_size: The number of paragraphs spaCy processes at once
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self._nlp = None
+        self._lock = Lock()
+
+    def _pipeline(self):
+        if self._nlp is None:
+            import spacy
+
+            if self.model is None:
+                nlp = spacy.blank('en')
+                nlp.add_pipe('sentencizer')
+            else:
+                nlp = spacy.load(self.model)
+            self._nlp = nlp
+        return self._nlp
+
+    def segment(self, paragraph):
+        return self.segment_many([paragraph])[0]
+
+    def segment_many(self, paragraphs):
+        result = []
+        with self._lock:
+            for paragraph, doc in zip(paragraphs, self._pipeline().pipe(paragraphs, batch_size=self.batch_size)):
+                # spaCy leaves the whitespace between sentences out of them, or in sentences of its own
+                starts = [m.start() for m in (_FIRST.search(paragraph, sent.start_char, sent.end_char)
+                                              for sent in doc.sents) if m is not None]
+                result.append(_spans(paragraph, starts) if len(starts) > 0 else [])
+        return result
+
+
+def check_segmenter(name):
+    """
+    :param name: The name of a segmenter, see the module docstring
+    :return: The name
+    :raise ValueError: If there is no such segmenter
+    """
+    kind = name.split(':', 1)[0]
+    if kind not in SEGMENTERS or (kind != SPACY and kind != name):
+        raise ValueError('unknown segmenter {}, expected one of {}'.format(name, ', '.join(SEGMENTERS)))
+    return name
+
+
+def create_segmenter(name):
+    """
+    :param name: PYSBD, RULES, SPACY, or 'spacy:<model>'
+    :return: The Segmenter
+    """
+    kind, _, model = check_segmenter(name).partition(':')
+    if kind == PYSBD:
+        return PysbdSegmenter()
+    if kind == RULES:
+        return RuleSegmenter()
+    return SpacySegmenter(model or None)
@@ -0,0 +1,103 @@
+"""
+A pre-forking server for production, serving the app from several worker processes sharing one listening socket.
+
+The parent process imports the app and warms the text analyzer up before forking the workers, which therefore share
+those pages copy-on-write rather than loading them each. Each worker then creates its own app, since database
+connections, document store files and the threads of the job scheduler do not survive a fork, and serves requests with
+a thread per request. Workers that exit are replaced, and SIGTERM or SIGINT stops them all. Unix only.
+"""
+
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+from api.analysis import warm_up
+
+"""
+Seconds a worker must have run for its exit to be taken as a crash rather than a failure to start, after which the
+server waits before replacing it, so that a broken configuration does not make it fork in a loop
+"""
+MIN_WORKER_SECONDS = 1
+
+
+def _run_worker(create_app, host, listener):
+    """
+    Body of a worker process: serves requests from the inherited socket until it receives SIGTERM
+    """
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server = make_server(host, listener.getsockname()[1], create_app(), threaded=True, fd=listener.fileno())
+    server.serve_forever()
+
+
+def serve(create_app, host='127.0.0.1', port=5000, workers=4):
+    """
+    Serves the app from pre-forked worker processes until SIGTERM or SIGINT
+    :param create_app: The function creating the app, called once in each worker
+    :param host: The address listened on
+    :param port: The port listened on
+    :param workers: The number of worker processes
+    """
+    start = time.perf_counter()
+    warm_up()
+    listener = socket.create_server((host, port), family=socket.AF_INET6 if ':' in host else socket.AF_INET,
+                                    backlog=128)
+    print('warmed up in {:.2f}s, serving on http://{}:{}/ with {} workers'.format(
+        time.perf_counter() - start, host, listener.getsockname()[1], workers), file=sys.stderr)
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _run_worker(create_app, host, listener)
+            except SystemExit as e:
+                status = e.code or 0
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while len(children) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        print('worker {} {} {}, replacing it'.format(
+            pid, *(('exited with status', os.WEXITSTATUS(status)) if os.WIFEXITED(status)
+                   else ('was killed by signal', os.WTERMSIG(status)))), file=sys.stderr)
+        if time.monotonic() - started < MIN_WORKER_SECONDS:
+            time.sleep(MIN_WORKER_SECONDS)
+        if not stopping:
+            spawn()
+    listener.close()
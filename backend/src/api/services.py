@@ -2,36 +2,29 @@
 Service functions for the API resources
 """
 
-import nltk
+from datetime import date
+from difflib import SequenceMatcher
 
-nltk.download('stopwords')
-
-from nltk import RegexpTokenizer
-from nltk.stem import PorterStemmer
-from nltk.corpus import stopwords
-from pysbd import Segmenter
-from itertools import chain
-from collections import Counter
-from datetime import datetime
-
-
-def break_document_into_paragraphs(doc):
-    """
-    Extracts information about paragraphs in the given document
-    :param doc: The document text
-    :return: A list of 3-tuples, which are start and end indices of each paragraph within the given string, and the
-      paragraph text itself as the third item
-    """
-    splits = []
-    last_end = 0
-    for i, char in enumerate(doc):
-        if char == '\n':
-            splits.append((last_end, i, doc[last_end:i]))
-            last_end = i
-
-    splits.append((last_end, len(doc), doc[last_end:]))
-
-    return splits
+from api.analysis import break_document_into_paragraphs, get_analyzer, timed
+from api.phrases import encode_paragraph_positions
+from api.sql import SQLITE, dialect, in_chunks, increment_on_conflict, insert_rows
+from api.terms import encode_term_counts, get_term_dictionary
+from api.tfidf import (
+    DOCUMENT_LEVEL,
+    PARAGRAPH_LEVEL,
+    SENTENCE_LEVEL,
+    add_document_statistics,
+    rebuild_all_statistics,
+    remove_document_statistics,
+    update_document_statistics,
+)
+from api.trends import (
+    add_document_trends,
+    as_date,
+    rebuild_trends,
+    remove_document_trends,
+    update_document_trends,
+)
 
 
 def break_paragraph_into_sentences(doc):
@@ -41,149 +34,536 @@ def break_paragraph_into_sentences(doc):
     :return: A list of 3-tuples, which are start and end indices of each sentence within the given string, and the text
       itself as the third item
     """
-    seg = Segmenter(char_span=True)
-
-    processed_doc = seg.segment(doc)
-    return [(s.start, s.end, s.sent) for s in processed_doc]
+    return get_analyzer().segment(doc)
 
 
 def process_raw_document_into_terms(text):
     """
     Processes the given raw document text into terms
     :param text: The raw text to process
-    :return: A set of terms
+    :return: A list of terms, in order. `get_analyzer().tokenize` also gives their positions
+    """
+    return [t.term for t in get_analyzer().tokenize(text)]
+
+
+def analyze_document(text, timings=None, segmenter=None):
+    """
+    Breaks a document down into paragraphs and sentences, and counts the terms of each of them
+    :param text: The raw text of the document
+    :param timings: An optional dict to which the time spent in each stage is added
+    :param segmenter: The name of the sentence segmenter, or None for the default one
+    :return: An AnalyzedDocument
+    """
+    return get_analyzer(segmenter).analyze(text, timings)
+
+
+def analyze_documents(texts, timings=None, segmenter=None):
+    """
+    Analyzes documents like analyze_document, segmenting the sentences of all of them in one batch
+    :return: The list of AnalyzedDocuments
+    """
+    return get_analyzer(segmenter).analyze_many(texts, timings)
+
+
+def write_documents(documents, cursor, timings=None, update_statistics=True):
+    """
+    Writes analyzed documents to the database, with one batched statement per table for the whole batch.
+    The ids of paragraphs and sentences are derived from the AUTO_INCREMENT id of the first inserted row, and the terms
+    of the batch are looked up in the term dictionary once, adding the new ones.
+    :param documents: A list of (doc_uuid, AnalyzedDocument, timestamp) tuples. A timestamp of None means now
+    :param cursor: The database cursor
+    :param timings: An optional dict to which the time spent in each stage is added
+    :param update_statistics: Whether to add the documents' contribution to the tfidf statistics and trend rollups. Bulk
+      loads may skip it and rebuild them once at the end, with recompute_tfidf_scores. Until then, the documents are
+      flagged as `statistics_pending`, so that deleting or updating them leaves the statistics alone
+    """
+    days = {str(doc_uuid): as_date(timestamp) if timestamp is not None else date.today()
+            for doc_uuid, _, timestamp in documents}
+    paragraphs = [(str(doc_uuid), p) for doc_uuid, analysis, _ in documents for p in analysis.paragraphs]
+    sentence_documents = [(doc_uuid, s) for doc_uuid, p in paragraphs for s in p.sentences]
+    sentences = [s for _, s in sentence_documents]
+
+    with timed(timings, 'insert_document'):
+        insert_rows(cursor, 'INSERT INTO document (document_id, timestamp, term_count, statistics_pending) VALUES',
+                    '(%s, %s, %s, %s)', [(str(doc_uuid), days[str(doc_uuid)], sum(analysis.term_counts.values()),
+                                          not update_statistics) for doc_uuid, analysis, _ in documents])
+
+    with timed(timings, 'insert_terms'):
+        vocabulary = set()
+        for _, analysis, _ in documents:
+            vocabulary.update(analysis.term_counts)
+        for s in sentences:
+            vocabulary.update(s.term_counts)
+        ids = get_term_dictionary(cursor).add_terms(cursor, vocabulary)
+        document_counts = [encode_term_counts(analysis.term_counts, ids) for _, analysis, _ in documents]
+
+    paragraph_counts, sentence_counts = _write_paragraphs(cursor, paragraphs, ids, timings)
+
+    with timed(timings, 'insert_unit_terms'):
+        insert_rows(cursor, 'INSERT INTO document_term (frequency, document_id, term_id) VALUES', '(%s, %s, %s)',
+                    [(f, str(doc_uuid), t)
+                     for (doc_uuid, _, _), counts in zip(documents, document_counts) for t, f in counts.items()])
+
+    with timed(timings, 'statistics'):
+        if update_statistics:
+            add_document_statistics(cursor, {
+                DOCUMENT_LEVEL: document_counts,
+                PARAGRAPH_LEVEL: paragraph_counts,
+                SENTENCE_LEVEL: sentence_counts,
+            })
+            add_document_trends(cursor, {
+                DOCUMENT_LEVEL: [(days[str(doc_uuid)], counts)
+                                 for (doc_uuid, _, _), counts in zip(documents, document_counts)],
+                PARAGRAPH_LEVEL: [(days[doc_uuid], counts)
+                                  for (doc_uuid, _), counts in zip(paragraphs, paragraph_counts)],
+                SENTENCE_LEVEL: [(days[doc_uuid], counts)
+                                 for (doc_uuid, _), counts in zip(sentence_documents, sentence_counts)],
+            })
+        bump_corpus_version(cursor, [str(doc_uuid) for doc_uuid, _, _ in documents])
+
+
+def _write_paragraphs(cursor, paragraphs, ids, timings=None):
     """
-    # TODO: Include position information for each of the terms
-    stop_words = set(stopwords.words('english'))
-    stemmer = PorterStemmer()
-    tokenizer = RegexpTokenizer(r'\w+')
-    tokens = [stemmer.stem(w.lower()) for w in tokenizer.tokenize(text) if w.lower() not in stop_words]
-    return tokens
+    Inserts paragraphs, their sentences, and the term counts of both, along with the positions of the terms of the
+    paragraphs
+    :param cursor: The database cursor
+    :param paragraphs: A list of (doc_uuid, AnalyzedParagraph) pairs
+    :param ids: A dict mapping every term of the paragraphs to its id
+    :param timings: An optional dict to which the time spent in each stage is added
+    :return: The term counts of the paragraphs, and those of all their sentences, as dicts mapping term ids to
+      frequencies
+    """
+    paragraph_counts = [encode_term_counts(p.term_counts, ids) for _, p in paragraphs]
+    with timed(timings, 'positions'):
+        positions = [encode_paragraph_positions(p.tokens, p.words, p.start, ids) for _, p in paragraphs]
+
+    with timed(timings, 'insert_paragraphs'):
+        paragraph_ids = insert_rows(
+            cursor, 'INSERT INTO paragraph (document_id, position_in_fullText, term_count, token_offsets) VALUES',
+            '(%s, %s, %s, %s)', [(doc_uuid, p.start, sum(p.term_counts.values()), offsets)
+                                 for (doc_uuid, p), (offsets, _) in zip(paragraphs, positions)], return_ids=True)
+
+    sentence_counts = _write_sentences(cursor, [(paragraph_id, s) for paragraph_id, (_, p) in
+                                                zip(paragraph_ids, paragraphs) for s in p.sentences], ids, timings)
 
+    with timed(timings, 'insert_unit_terms'):
+        insert_rows(cursor, 'INSERT INTO paragraph_term (frequency, paragraph_id, term_id, positions) VALUES',
+                    '(%s, %s, %s, %s)', [(f, paragraph_id, t, term_positions[t])
+                                         for paragraph_id, counts, (_, term_positions)
+                                         in zip(paragraph_ids, paragraph_counts, positions)
+                                         for t, f in counts.items()])
+    return paragraph_counts, sentence_counts
 
-def generate_topics(
-        terms_list,
-        similarity_score_fn,
-        geometric_mean_of_tfidf_scores_for_term_fn,
-        set_progress_callback=None,
-        poll_cancel=None,
-):
+
+def _write_sentences(cursor, sentences, ids, timings=None):
     """
-    Generates a list of topics
-    :param terms_list: The full list of terms
-    :param similarity_score_fn: A function (term1, term2) -> similarity_score
-    :param geometric_mean_of_tfidf_scores_for_term_fn: A function with the signature (term -> float) that takes a term
-      and produces the geometric mean of tfidf scores for that term across all documents
-    :return: The list of topics (a list of list of terms), sorted in descending order of significance
+    Inserts sentences and their term counts
+    :param cursor: The database cursor
+    :param sentences: A list of (paragraph id, AnalyzedSentence) pairs
+    :param ids: A dict mapping every term of the sentences to its id
+    :param timings: An optional dict to which the time spent in each stage is added
+    :return: The term counts of the sentences, as dicts mapping term ids to frequencies
     """
-    THRESH = 0.001
+    sentence_counts = [encode_term_counts(s.term_counts, ids) for _, s in sentences]
 
-    L = []
-    for i, t in enumerate(terms_list):
+    with timed(timings, 'insert_sentences'):
+        sentence_ids = insert_rows(
+            cursor, 'INSERT INTO sentence (paragraph_id, position_in_paragraph, term_count) VALUES', '(%s, %s, %s)',
+            [(paragraph_id, s.start, sum(s.term_counts.values())) for paragraph_id, s in sentences], return_ids=True)
 
-        if poll_cancel is not None and poll_cancel() is True:
-            raise Exception('cancelled')
+    with timed(timings, 'insert_unit_terms'):
+        insert_rows(cursor, 'INSERT INTO sentence_term (frequency, sentence_id, term_id) VALUES', '(%s, %s, %s)',
+                    [(f, sentence_id, t)
+                     for sentence_id, counts in zip(sentence_ids, sentence_counts) for t, f in counts.items()])
+    return sentence_counts
 
-        was_added = False
-        for topic in L:
-            if all([similarity_score_fn(t, topic_term) < THRESH if similarity_score_fn(t,
-                                                                                       topic_term) is not None else False
-                    for topic_term in topic]):
-                topic.append(t)
-                was_added = True
-                break
-        if not was_added:
-            L.append([t])
-        if set_progress_callback is not None:
-            set_progress_callback(i / len(terms_list))
 
-    return sorted(L, key=lambda l: sum(map(geometric_mean_of_tfidf_scores_for_term_fn, l)) / len(l), reverse=True)
+def write_document(doc_uuid, analysis, cursor, timings=None, timestamp=None):
+    """
+    Writes an analyzed document to the database, see write_documents
+    :param doc_uuid: The UUID of the document
+    :param analysis: The AnalyzedDocument
+    :param cursor: The database cursor
+    :param timings: An optional dict to which the time spent in each stage is added
+    :param timestamp: The date of the document, defaults to now
+    """
+    write_documents([(doc_uuid, analysis, timestamp)], cursor, timings)
 
 
-def insert_document(doc_uuid, text, cursor):
+def insert_document(doc_uuid, text, cursor, timings=None):
     """
     Performs the setup required to ingest a new document into the database.
-    This function configures the document, its paragraphs, its sentences, and the terms associated with each of these.
-    This function does not recompute the tfidf scores.
+    This function configures the document, its paragraphs, its sentences, and the terms associated with each of these,
+    and adds the document's contribution to the tfidf statistics.
     :param doc_uuid: The UUID of the document
     :param text: The raw text of the document
     :param cursor: The database cursor
+    :param timings: An optional dict to which the time spent in each stage of the ingestion is added, in seconds
+    """
+    analysis = analyze_document(text, timings)
+    write_document(doc_uuid, analysis, cursor, timings)
+
+
+def _statistics_pending(cursor, doc_uuid):
+    """
+    :return: Whether the document was written without adding its contribution to the tfidf statistics and trend rollups,
+      which have not been rebuilt since, see write_documents
+    """
+    cursor.execute('SELECT statistics_pending FROM document WHERE document_id = %s', (str(doc_uuid),))
+    row = cursor.fetchone()
+    return row is not None and bool(row[0])
+
+
+def delete_document(doc_uuid, cursor):
+    """
+    Deletes a document from the database, along with its paragraphs, sentences and their terms, and removes the
+    document's contribution to the tfidf statistics and trend rollups
+    :param doc_uuid: The UUID of the document
+    :param cursor: The database cursor
+    """
+    with timed(None, 'delete'):
+        _delete_document_rows(doc_uuid, cursor)
+        bump_corpus_version(cursor)
+
+
+def _delete_document_rows(doc_uuid, cursor):
+    """
+    Deletes a document like delete_document, without bumping the corpus version
+    """
+    if not _statistics_pending(cursor, doc_uuid):
+        remove_document_statistics(cursor, doc_uuid)
+        remove_document_trends(cursor, doc_uuid)
+    cursor.execute('DELETE FROM document WHERE document_id = %s', (str(doc_uuid),))
+
+
+def _read_term_counts(cursor, level, unit_ids):
+    """
+    :return: A dict mapping each of the units of a level to its term counts, as a dict mapping term ids to frequencies
+    """
+    counts = {u: {} for u in unit_ids}
+    for chunk, placeholders in in_chunks(list(unit_ids)):
+        cursor.execute('SELECT {0}, term_id, frequency FROM {1} WHERE {0} IN ({2})'.format(
+            level.unit_key, level.term_table, placeholders), tuple(chunk))
+        for unit_id, term_id, frequency in cursor.fetchall():
+            counts[unit_id][term_id] = frequency
+    return counts
+
+
+def _update_term_counts(cursor, level, unit_id, old_counts, new_counts):
+    """
+    Rewrites the term counts of a unit, only touching the terms whose frequency changed
+    """
+    insert_rows(cursor, 'INSERT INTO {} (frequency, {}, term_id) VALUES'.format(level.term_table, level.unit_key),
+                '(%s, %s, %s)', [(f - old_counts.get(t, 0), unit_id, t) for t, f in sorted(new_counts.items())
+                                 if f != old_counts.get(t, 0)],
+                suffix=increment_on_conflict(cursor, (level.unit_key, 'term_id'), ('frequency',)))
+    for chunk, placeholders in in_chunks(sorted(t for t in old_counts if t not in new_counts)):
+        cursor.execute('DELETE FROM {} WHERE {} = %s AND term_id IN ({})'.format(
+            level.term_table, level.unit_key, placeholders), (unit_id,) + tuple(chunk))
+
+
+def _shift_positions(cursor, table, key, column, shifts):
+    """
+    Moves units, with one statement per distinct shift, of which an edit usually makes one
+    :param shifts: A list of (unit id, offset added to its position) pairs
+    """
+    by_shift = {}
+    for unit_id, shift in shifts:
+        if shift != 0:
+            by_shift.setdefault(shift, []).append(unit_id)
+    for shift, unit_ids in sorted(by_shift.items()):
+        for chunk, placeholders in in_chunks(unit_ids):
+            cursor.execute('UPDATE {0} SET {1} = {1} + %s WHERE {2} IN ({3})'.format(table, column, key, placeholders),
+                           (shift,) + tuple(chunk))
+
+
+def _diff(old_keys, new_keys):
+    """
+    Matches two sequences of units
+    :return: The (old index, new index) pairs of the units left unchanged, the (old index, new index) pairs of the units
+      replaced one for one, the old indices of the units removed, and the new indices of the units added
+    """
+    kept, replaced, removed, added = [], [], [], []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_keys, new_keys, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            kept.extend(zip(range(i1, i2), range(j1, j2)))
+        else:
+            n = min(i2 - i1, j2 - j1)
+            replaced.extend(zip(range(i1, i1 + n), range(j1, j1 + n)))
+            removed.extend(range(i1 + n, i2))
+            added.extend(range(j1 + n, j2))
+    return kept, replaced, removed, added
+
+
+def _sentence_keys(paragraph_text, starts, counts):
+    """
+    :return: A key for each sentence of a paragraph, which is equal for sentences of the same text and term counts
+    """
+    ends = starts[1:] + [len(paragraph_text)]
+    return [(paragraph_text[start:end], tuple(sorted(c.items()))) for start, end, c in zip(starts, ends, counts)]
+
+
+def update_document(doc_uuid, old_text, text, cursor, timings=None):
+    """
+    Updates a document in place, only analyzing and rewriting the paragraphs and sentences whose text changed.
+    The paragraphs of the former and new texts are matched by their text: paragraphs left unchanged are only moved,
+    and within each paragraph replaced by another, sentences are matched by their text and term counts. The term counts
+    of the document, the tfidf statistics and the trend rollups are adjusted by the difference, and the term rows of the
+    paragraphs replaced are rewritten along with their positions. The document keeps its date.
+    The document is rewritten from scratch, like a deletion followed by an insertion, when it does not exist yet, or
+    when its stored paragraphs do not match `old_text`.
+    Whichever way the document is written, even when its text is unchanged, the corpus version is bumped exactly once,
+    so that the search index can tell whether it missed any other write, see SearchIndex.replace_document.
+    :param doc_uuid: The UUID of the document
+    :param old_text: The text the document was written with, or None if it is unknown
+    :param text: The new text of the document
+    :param cursor: The database cursor
+    :param timings: An optional dict to which the time spent in each stage is added
+    :return: True if the document was updated in place
     """
+    doc_uuid = str(doc_uuid)
+    cursor.execute('SELECT timestamp, statistics_pending FROM document WHERE document_id = %s', (doc_uuid,))
+    row = cursor.fetchone()
+    if row is None:
+        insert_document(doc_uuid, text, cursor, timings)
+        return False
+    timestamp, statistics_pending = row
+
+    old_paragraphs = break_document_into_paragraphs(old_text) if old_text is not None else None
+    cursor.execute('SELECT paragraph_id, position_in_fullText FROM paragraph WHERE document_id = %s '
+                   'ORDER BY position_in_fullText', (doc_uuid,))
+    stored = cursor.fetchall()
+    if old_paragraphs is None or [p for _, p in stored] != [start for start, _, _ in old_paragraphs]:
+        with timed(timings, 'delete'):
+            _delete_document_rows(doc_uuid, cursor)
+        write_document(doc_uuid, analyze_document(text, timings), cursor, timings, timestamp=timestamp)
+        return False
+    if text == old_text:
+        bump_corpus_version(cursor)
+        return True
 
+    with timed(timings, 'update'):
+        new_paragraphs = break_document_into_paragraphs(text)
+        kept, replaced, removed, added = _diff([p for _, _, p in old_paragraphs], [p for _, _, p in new_paragraphs])
+        analyzer = get_analyzer()
+        analyses = {j: analyzer.analyze_paragraph(text, new_paragraphs[j][0], new_paragraphs[j][1], timings)
+                    for j in sorted([j for _, j in replaced] + added)}
+
+        # The former term counts of the units that change, and the sentences of the paragraphs that change
+        changed_ids = sorted(stored[i][0] for i in [i for i, _ in replaced] + removed)
+        old_sentences = {paragraph_id: [] for paragraph_id in changed_ids}
+        for chunk, placeholders in in_chunks(changed_ids):
+            cursor.execute('SELECT paragraph_id, sentence_id, position_in_paragraph FROM sentence '
+                           'WHERE paragraph_id IN ({}) ORDER BY paragraph_id, position_in_paragraph'.format(
+                               placeholders), tuple(chunk))
+            for paragraph_id, sentence_id, position in cursor.fetchall():
+                old_sentences[paragraph_id].append((sentence_id, position))
+        old_paragraph_counts = _read_term_counts(cursor, PARAGRAPH_LEVEL, changed_ids)
+        old_sentence_counts = _read_term_counts(
+            cursor, SENTENCE_LEVEL, [sentence_id for rows in old_sentences.values() for sentence_id, _ in rows])
+        old_document_counts = _read_term_counts(cursor, DOCUMENT_LEVEL, [doc_uuid])[doc_uuid]
+
+        with timed(timings, 'insert_terms'):
+            vocabulary = set()
+            for p in analyses.values():
+                vocabulary.update(p.term_counts)
+                for s in p.sentences:
+                    vocabulary.update(s.term_counts)
+            ids = get_term_dictionary(cursor).add_terms(cursor, vocabulary)
+
+        removed_counts = {DOCUMENT_LEVEL: [old_document_counts], PARAGRAPH_LEVEL: [], SENTENCE_LEVEL: []}
+        added_counts = {DOCUMENT_LEVEL: [], PARAGRAPH_LEVEL: [], SENTENCE_LEVEL: []}
+        new_document_counts = dict(old_document_counts)
+
+        def move_counts(level, old_counts, new_counts):
+            removed_counts[level].extend(old_counts)
+            added_counts[level].extend(new_counts)
+            if level is PARAGRAPH_LEVEL:
+                for sign, counts in ((-1, old_counts), (1, new_counts)):
+                    for c in counts:
+                        for t, f in c.items():
+                            new_document_counts[t] = new_document_counts.get(t, 0) + sign * f
+
+        # Paragraphs replaced one for one keep their row, and the sentences they share with the former paragraph
+        sentence_shifts = []
+        new_sentences = []
+        for i, j in replaced:
+            paragraph_id = stored[i][0]
+            analysis = analyses[j]
+            new_counts = encode_term_counts(analysis.term_counts, ids)
+            move_counts(PARAGRAPH_LEVEL, [old_paragraph_counts[paragraph_id]], [new_counts])
+            offsets, positions = encode_paragraph_positions(analysis.tokens, analysis.words, analysis.start, ids)
+            cursor.execute('UPDATE paragraph SET position_in_fullText = %s, term_count = %s, token_offsets = %s '
+                           'WHERE paragraph_id = %s',
+                           (analysis.start, sum(analysis.term_counts.values()), offsets, paragraph_id))
+            # The positions of every term may move, so the term rows of the paragraph are all rewritten
+            cursor.execute('DELETE FROM paragraph_term WHERE paragraph_id = %s', (paragraph_id,))
+            insert_rows(cursor, 'INSERT INTO paragraph_term (frequency, paragraph_id, term_id, positions) VALUES',
+                        '(%s, %s, %s, %s)', [(f, paragraph_id, t, positions[t]) for t, f in sorted(new_counts.items())])
+
+            rows = old_sentences[paragraph_id]
+            sentence_counts = [encode_term_counts(s.term_counts, ids) for s in analysis.sentences]
+            old_keys = _sentence_keys(old_paragraphs[i][2], [position for _, position in rows],
+                                      [old_sentence_counts[sentence_id] for sentence_id, _ in rows])
+            new_keys = _sentence_keys(new_paragraphs[j][2], [s.start for s in analysis.sentences], sentence_counts)
+            same, changed_old, gone, new = _diff(old_keys, new_keys)
+            sentence_shifts.extend((rows[k][0], analysis.sentences[m].start - rows[k][1]) for k, m in same)
+            gone = sorted(gone + [k for k, _ in changed_old])
+            new = sorted(new + [m for _, m in changed_old])
+            move_counts(SENTENCE_LEVEL, [old_sentence_counts[rows[k][0]] for k in gone],
+                        [sentence_counts[m] for m in new])
+            new_sentences.extend((paragraph_id, analysis.sentences[m]) for m in new)
+            for chunk, placeholders in in_chunks([rows[k][0] for k in gone]):
+                cursor.execute('DELETE FROM sentence WHERE sentence_id IN ({})'.format(placeholders), tuple(chunk))
+        _shift_positions(cursor, 'sentence', 'sentence_id', 'position_in_paragraph', sentence_shifts)
+        _write_sentences(cursor, new_sentences, ids, timings)
+
+        # Paragraphs removed take their sentences along
+        removed_ids = [stored[i][0] for i in removed]
+        move_counts(PARAGRAPH_LEVEL, [old_paragraph_counts[paragraph_id] for paragraph_id in removed_ids], [])
+        move_counts(SENTENCE_LEVEL, [old_sentence_counts[sentence_id] for paragraph_id in removed_ids
+                                     for sentence_id, _ in old_sentences[paragraph_id]], [])
+        for chunk, placeholders in in_chunks(removed_ids):
+            cursor.execute('DELETE FROM paragraph WHERE paragraph_id IN ({})'.format(placeholders), tuple(chunk))
+
+        _shift_positions(cursor, 'paragraph', 'paragraph_id', 'position_in_fullText',
+                         [(stored[i][0], new_paragraphs[j][0] - old_paragraphs[i][0]) for i, j in kept])
+        paragraph_counts, sentence_counts = _write_paragraphs(cursor, [(doc_uuid, analyses[j]) for j in added], ids,
+                                                              timings)
+        move_counts(PARAGRAPH_LEVEL, [], paragraph_counts)
+        move_counts(SENTENCE_LEVEL, [], sentence_counts)
+
+        new_document_counts = {t: f for t, f in new_document_counts.items() if f > 0}
+        added_counts[DOCUMENT_LEVEL].append(new_document_counts)
+        cursor.execute('UPDATE document SET term_count = %s WHERE document_id = %s',
+                       (sum(new_document_counts.values()), doc_uuid))
+        _update_term_counts(cursor, DOCUMENT_LEVEL, doc_uuid, old_document_counts, new_document_counts)
+
+        with timed(timings, 'statistics'):
+            # The statistics of documents from an unfinished import are rebuilt once it finishes
+            if not statistics_pending:
+                update_document_statistics(cursor, removed_counts, added_counts)
+                update_document_trends(cursor, timestamp, removed_counts, added_counts)
+            bump_corpus_version(cursor, [doc_uuid])
+    return True
+
+
+def cleanup_terms(cursor):
     """
-    Create document entry
+    Deletes the document frequencies of the terms that no unit contains anymore. The terms stay in the term dictionary,
+    so that the ids cached by every process stay valid
+    :param cursor: The database cursor
     """
-    cursor.execute('INSERT INTO document (document_id, timestamp) VALUES (%s, %s)', (doc_uuid, datetime.now()))
+    if dialect(cursor) == SQLITE:
+        cursor.execute('DELETE FROM term_df WHERE df <= 0')
+    else:
+        cursor.callproc('cleanup_terms')
+
 
+def get_unit_span(doc_uuid, cursor, paragraph, sentence=None):
     """
-    Process document's raw text into terms
+    Finds the character offsets of a paragraph, or of a sentence within it, from the positions stored by
+    write_documents. A unit ends where the next one starts, so the span includes the whitespace separating them.
+    :param doc_uuid: The UUID of the document
+    :param cursor: The database cursor
+    :param paragraph: The index of the paragraph within the document
+    :param sentence: The index of the sentence within the paragraph, or None for the whole paragraph
+    :return: A (start, end) tuple of offsets within the document, where an end of None is the end of the document, or
+      None if there is no such unit
     """
-    terms = process_raw_document_into_terms(text)
-    if len(terms) > 0:
-        cursor.execute('INSERT IGNORE INTO term (term_text) VALUES ' + ','.join(['(%s)' for i in range(len(terms))]),
-                       tuple(terms))
-        cnt = Counter(terms)
-        cursor.execute('INSERT INTO document_term (frequency, document_id, term_text) VALUES ' + ','.join(
-            ['(%s, %s, %s)' for i in range(len(cnt.most_common()))]),
-                       tuple(chain.from_iterable((f, str(doc_uuid), t) for t, f in cnt.most_common())))
+    cursor.execute('SELECT paragraph_id, position_in_fullText FROM paragraph WHERE document_id = %s '
+                   'ORDER BY position_in_fullText LIMIT 2 OFFSET %s', (str(doc_uuid), paragraph))
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        return None
+    paragraph_id, start = rows[0]
+    end = rows[1][1] if len(rows) > 1 else None
+    if sentence is None:
+        return start, end
+
+    cursor.execute('SELECT position_in_paragraph FROM sentence WHERE paragraph_id = %s '
+                   'ORDER BY position_in_paragraph LIMIT 2 OFFSET %s', (paragraph_id, sentence))
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        return None
+    return start + rows[0][0], start + rows[1][0] if len(rows) > 1 else end
+
 
+def list_documents(cursor, limit, after=None, start=None, end=None):
     """
-    Break document down into paragraphs and insert those records
+    Lists documents in (timestamp, document_id) order, a page at a time. Each page is read from the
+    `document_timestamp` index, starting where the previous page ended, so every page costs the same whatever its
+    position in the corpus.
+    :param cursor: The database cursor
+    :param limit: The maximum number of documents returned
+    :param after: The (timestamp, document_id) of the last document of the previous page, or None for the first page
+    :param start: The earliest date of the documents listed, or None
+    :param end: The latest date of the documents listed, or None
+    :return: A list of (document_id, timestamp) tuples
     """
-    paragraphs = break_document_into_paragraphs(text)
-    if len(paragraphs) > 0:
-        cursor.execute('INSERT INTO paragraph (document_id, position_in_fulltext) VALUES ' + ','.join(
-            ['(%s, %s)' for i in range(len(paragraphs))]),
-                       tuple(chain.from_iterable(((str(doc_uuid), p[0]) for p in paragraphs))))
+    conditions = []
+    args = []
+    if after is not None:
+        conditions.append('(timestamp > %s OR (timestamp = %s AND document_id > %s))')
+        args.extend((after[0], after[0], after[1]))
+    if start is not None:
+        conditions.append('timestamp >= %s')
+        args.append(as_date(start))
+    if end is not None:
+        conditions.append('timestamp <= %s')
+        args.append(as_date(end))
 
-    for start, end, paragraph_text in paragraphs:
-        cursor.execute('SELECT paragraph_id FROM paragraph WHERE document_id = %s AND position_in_fullText = %s',
-                       (str(doc_uuid), start))
-        paragraph_id, = cursor.fetchone()
+    cursor.execute('SELECT document_id, timestamp FROM document {} ORDER BY timestamp, document_id LIMIT %s'.format(
+        'WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''), tuple(args) + (limit,))
+    return cursor.fetchall()
 
-        # The following four lines are abstractable
-        terms = process_raw_document_into_terms(paragraph_text)
-        if len(terms) > 0:
-            cursor.execute(
-                'INSERT IGNORE INTO term (term_text) VALUES ' + ','.join(['(%s)' for i in range(len(terms))]),
-                tuple(terms))
-            cnt = Counter(terms)
-            cursor.execute('INSERT INTO paragraph_term (frequency, paragraph_id, term_text) VALUES ' + ','.join(
-                ['(%s, %s, %s)' for i in range(len(cnt.most_common()))]),
-                           tuple(chain.from_iterable((f, paragraph_id, t) for t, f in cnt.most_common())))
 
+def iter_documents(cursor, start=None, end=None, page_size=1000):
     """
-    Break each paragraph down into sentences and insert those records
+    Iterates over every document, see list_documents. Only one page is held in memory at a time
+    :return: A generator of (document_id, timestamp) tuples
     """
-    cursor.execute('SELECT paragraph_id, position_in_fulltext FROM paragraph WHERE document_id = %s', (doc_uuid,))
-    for paragraph_id, position_in_fulltext in cursor.fetchall():
-        sentences = break_paragraph_into_sentences([text for s, e, text in paragraphs if s == position_in_fulltext][0])
-        if len(sentences) > 0:
-            cursor.execute('INSERT INTO sentence (paragraph_id, position_in_paragraph) VALUES ' + ','.join(
-                ['(%s, %s)' for i in range(len(sentences))]),
-                           tuple(chain.from_iterable(((str(paragraph_id), s[0]) for s in sentences))))
+    after = None
+    while True:
+        page = list_documents(cursor, page_size, after, start, end)
+        yield from page
+        if len(page) < page_size:
+            return
+        after = (page[-1][1], page[-1][0])
 
-        for start, end, sentence_text in sentences:
-            cursor.execute('SELECT sentence_id FROM sentence WHERE paragraph_id = %s AND position_in_paragraph = %s',
-                           (paragraph_id, start))
-            sentence_id, = cursor.fetchone()
 
-            terms = process_raw_document_into_terms(sentence_text)
-            if len(terms) > 0:
-                cursor.execute(
-                    'INSERT IGNORE INTO term (term_text) VALUES ' + ','.join(['(%s)' for i in range(len(terms))]),
-                    tuple(terms))
-                cnt = Counter(terms)
-                cursor.execute('INSERT INTO sentence_term (frequency, sentence_id, term_text) VALUES ' + ','.join(
-                    ['(%s, %s, %s)' for i in range(len(cnt.most_common()))]),
-                               tuple(chain.from_iterable((f, sentence_id, t) for t, f in cnt.most_common())))
+def get_corpus_version(cursor):
+    """
+    :param cursor: The database cursor
+    :return: The corpus version, which increases every time the content of the corpus changes
+    """
+    cursor.execute('SELECT version FROM corpus_version')
+    return cursor.fetchone()[0]
+
+
+def bump_corpus_version(cursor, document_ids=()):
+    """
+    Increments the corpus version. Called by every function that changes the content of the corpus, in the same
+    transaction as the change
+    :param cursor: The database cursor
+    :param document_ids: The ids of the documents written by the change, which are stamped with the new version so that
+      snapshots can tell them apart, see snapshot.py
+    """
+    cursor.execute('UPDATE corpus_version SET version = version + 1')
+    for chunk, placeholders in in_chunks(list(document_ids)):
+        cursor.execute('UPDATE document SET corpus_version = (SELECT version FROM corpus_version) '
+                       'WHERE document_id IN ({})'.format(placeholders), tuple(chunk))
 
 
 def recompute_tfidf_scores(cursor):
     """
-    Recomputes all tfidf scores in the database
+    Recomputes the tfidf statistics and the trend rollups of the whole database from scratch.
+    Inserting and deleting documents keeps them up to date, so this only needs to run to repair them, and after bulk
+    loads that skipped them, whose documents then stop being flagged as `statistics_pending`.
     :param cursor: The database cursor
     """
-    cursor.callproc('recompute_all_document_tfidf_scores')
-    cursor.callproc('recompute_all_paragraph_tfidf_scores')
-    cursor.callproc('recompute_all_sentence_tfidf_scores')
+    with timed(None, 'rescore'):
+        cursor.execute('UPDATE document SET statistics_pending = %s WHERE statistics_pending = %s', (False, True))
+        rebuild_all_statistics(cursor)
+        rebuild_trends(cursor)
+        bump_corpus_version(cursor)
@@ -0,0 +1,359 @@
+"""
+Columnar snapshots of the corpus, from which in-process engines warm-start and offline analyses run without the
+database.
+
+A snapshot holds, at one corpus version, the term dictionary, the dates of the documents, and for every level the
+sparse unit x term matrices of the frequencies and tfidf scores, in the CSR layout: the entries of unit `u` are
+`terms[ptr[u]:ptr[u + 1]]`, by increasing term id. Each array is a `.npy` file of the directory
+`snapshot-v<version>`, which `load_snapshot` maps into memory rather than reading, so loading one takes milliseconds
+whatever its size. The files can also be read with `numpy.load` alone:
+  * `term_ids`, `term_texts`: the terms occurring in the corpus, by increasing id
+  * `document_ids`, `timestamps`: the documents, by increasing id, and their dates (NaT when unknown)
+  * `<level>_keys`, `<level>_documents`, `<level>_term_counts`: the units of the level by increasing key, the index of
+    their document in `document_ids`, and their total term frequency. Documents are keyed by their index
+  * `<level>_ptr`, `<level>_terms`, `<level>_frequencies`, `<level>_scores`: the entries of the units. Scores are
+    computed like the `*_term_score` views, from document frequencies and unit counts derived from the entries, and are
+    NaN where the views give NULL
+
+Every write stamps the documents it changes with the new corpus version (`document.corpus_version`), so a snapshot is
+refreshed by reading the rows of the documents written since its version only, and merging them with the entries of
+the documents it already holds. Snapshots are written to a temporary directory renamed once complete, and the most
+recent ones are kept, so readers never see a partial snapshot and may keep using one after it is replaced.
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from api.services import get_corpus_version
+from api.sql import begin_read, in_chunks
+from api.tfidf import DOCUMENT_LEVEL, LEVELS
+
+"""
+Version of the layout of snapshots. Snapshots of another format are rebuilt rather than refreshed
+"""
+SNAPSHOT_FORMAT = 1
+
+_ENTRY_PATTERN = re.compile(r'^snapshot-v(?P<version>\d+)$')
+
+_LEVEL_ARRAYS = ('keys', 'documents', 'term_counts', 'ptr', 'terms', 'frequencies', 'scores')
+
+
+class LevelMatrix:
+    """
+    The units of a level and their entries, see the module docstring
+    """
+
+    def __init__(self, keys, documents, term_counts, ptr, terms, frequencies, scores=None):
+        self.keys = keys
+        self.documents = documents
+        self.term_counts = term_counts
+        self.ptr = ptr
+        self.terms = terms
+        self.frequencies = frequencies
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.keys)
+
+    def entry_units(self):
+        """
+        :return: The index of the unit of every entry
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.ptr))
+
+
+class CorpusSnapshot:
+    """
+    The term dictionary, documents and level matrices of the corpus at one corpus version
+    """
+
+    def __init__(self, version, term_ids, term_texts, document_ids, timestamps, levels, path=None):
+        """
+        :param version: The corpus version
+        :param term_ids: The array of the ids of the terms, increasing
+        :param term_texts: The array of the texts of the terms
+        :param document_ids: The array of the ids of the documents, increasing
+        :param timestamps: The datetime64[D] array of the dates of the documents
+        :param levels: A dict mapping level names to LevelMatrices
+        :param path: The directory the snapshot was loaded from, if any
+        """
+        self.version = version
+        self.term_ids = term_ids
+        self.term_texts = term_texts
+        self.document_ids = document_ids
+        self.timestamps = timestamps
+        self.levels = levels
+        self.path = path
+
+    def level(self, level):
+        """
+        :param level: A Level
+        :return: Its LevelMatrix
+        """
+        return self.levels[level.name]
+
+    def term_index(self, term_ids):
+        """
+        :param term_ids: An array of ids of terms of the snapshot
+        :return: The indices of the terms in `term_ids` and `term_texts`
+        """
+        return np.searchsorted(self.term_ids, term_ids)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        :param path: The directory of the snapshot
+        :param mmap: Whether to map the arrays into memory rather than read them
+        :return: The CorpusSnapshot
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        def read(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+
+        levels = {name: LevelMatrix(*(read('{}_{}'.format(name, a)) for a in _LEVEL_ARRAYS)) for name in meta['levels']}
+        return cls(meta['version'], read('term_ids'), read('term_texts'), read('document_ids'), read('timestamps'),
+                   levels, path)
+
+    def save(self, directory):
+        """
+        Writes the snapshot to `snapshot-v<version>` in a directory, unless it already exists
+        :param directory: The directory holding the snapshots. It is created if needed
+        :return: The path of the snapshot
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'snapshot-v{}'.format(self.version))
+        tmp_path = tempfile.mkdtemp(dir=directory, prefix='.snapshot-')
+        try:
+            arrays = {'term_ids': self.term_ids, 'term_texts': self.term_texts, 'document_ids': self.document_ids,
+                      'timestamps': self.timestamps}
+            for name, matrix in self.levels.items():
+                arrays.update(('{}_{}'.format(name, a), getattr(matrix, a)) for a in _LEVEL_ARRAYS)
+            for name, values in arrays.items():
+                np.save(os.path.join(tmp_path, name + '.npy'), values)
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({
+                    'format': SNAPSHOT_FORMAT,
+                    'version': self.version,
+                    'created_at': time.time(),
+                    'levels': list(self.levels),
+                    'terms': len(self.term_ids),
+                    'documents': len(self.document_ids),
+                }, f)
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            # Another process wrote the same version first
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                raise
+        return path
+
+
+def snapshot_versions(directory):
+    """
+    :param directory: The directory holding the snapshots
+    :return: The corpus versions of the snapshots of the current format, most recent first
+    """
+    versions = []
+    if not os.path.isdir(directory):
+        return versions
+    for name in os.listdir(directory):
+        match = _ENTRY_PATTERN.match(name)
+        if match is None:
+            continue
+        try:
+            with open(os.path.join(directory, name, 'meta.json'), 'r') as f:
+                if json.load(f)['format'] == SNAPSHOT_FORMAT:
+                    versions.append(int(match.group('version')))
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+    return sorted(versions, reverse=True)
+
+
+def load_snapshot(directory, version=None):
+    """
+    :param directory: The directory holding the snapshots
+    :param version: The corpus version of the snapshot, or None for the most recent one
+    :return: The memory-mapped CorpusSnapshot, or None if there is no such snapshot
+    """
+    versions = snapshot_versions(directory)
+    if version is None:
+        version = versions[0] if len(versions) > 0 else None
+    if version not in versions:
+        return None
+    try:
+        return CorpusSnapshot.load(os.path.join(directory, 'snapshot-v{}'.format(version)))
+    except FileNotFoundError:
+        # Removed by a refresh since it was listed
+        return None
+
+
+def _read_level(cursor, level, document_ids=None):
+    """
+    :param document_ids: The ids of the documents read, or None for all of them
+    :return: The list of (unit key, term count, document id) tuples of the units of the documents, and the list of
+      (unit key, term id, frequency) tuples of their entries
+    """
+    units_sql = 'SELECT {0}.{1}, {0}.term_count, document_id FROM {0} {2}'.format(
+        level.unit_table, level.unit_key, level.document_join)
+    entries_sql = 'SELECT {0}.{1}, {0}.term_id, {0}.frequency FROM {0} JOIN {2} USING ({1}) {3}'.format(
+        level.term_table, level.unit_key, level.unit_table, level.document_join)
+    if document_ids is None:
+        cursor.execute(units_sql)
+        units = list(cursor.fetchall())
+        cursor.execute('SELECT {}, term_id, frequency FROM {}'.format(level.unit_key, level.term_table))
+        entries = []
+        while True:
+            rows = cursor.fetchmany(10000)
+            if len(rows) == 0:
+                return units, entries
+            entries.extend(rows)
+
+    units = []
+    entries = []
+    for chunk, placeholders in in_chunks(document_ids):
+        cursor.execute(units_sql + ' WHERE document_id IN ({})'.format(placeholders), tuple(chunk))
+        units.extend(cursor.fetchall())
+        cursor.execute(entries_sql + ' WHERE document_id IN ({})'.format(placeholders), tuple(chunk))
+        entries.extend(cursor.fetchall())
+    return units, entries
+
+
+def _build_level(previous, kept, document_index, unit_rows, entry_rows, is_document_level):
+    """
+    Merges the units of the documents a snapshot keeps with those read from the database
+    :param previous: The LevelMatrix of the previous snapshot, or None
+    :param kept: For each document of the previous snapshot, its index in the new snapshot, or -1 if it is re-read or
+      deleted
+    :param document_index: A dict mapping the ids of the documents of the new snapshot to their index
+    :param unit_rows: The units read from the database, see _read_level
+    :param entry_rows: The entries read from the database
+    :param is_document_level: Whether units are keyed by the id of their document
+    :return: The LevelMatrix, without scores
+    """
+    def key_of(key):
+        return document_index.get(key, -1) if is_document_level else key
+
+    # Units of documents written after the documents were listed are left for the next refresh
+    unit_rows = [row for row in unit_rows if row[2] in document_index]
+    keys = np.array([key_of(key) for key, _, _ in unit_rows], dtype=np.int64)
+    documents = np.array([document_index[document_id] for _, _, document_id in unit_rows], dtype=np.int64)
+    term_counts = np.array([term_count or 0 for _, term_count, _ in unit_rows], dtype=np.int64)
+    entry_keys = np.array([key_of(key) for key, _, _ in entry_rows], dtype=np.int64)
+    entry_terms = np.array([term_id for _, term_id, _ in entry_rows], dtype=np.int64)
+    entry_frequencies = np.array([frequency or 0 for _, _, frequency in entry_rows], dtype=np.int64)
+
+    if previous is not None:
+        unit_kept = kept[previous.documents] >= 0
+        entry_kept = np.repeat(unit_kept, np.diff(previous.ptr))
+        old_keys = np.asarray(previous.keys)[unit_kept]
+        if is_document_level:
+            old_keys = kept[old_keys]
+        keys = np.concatenate((old_keys, keys))
+        documents = np.concatenate((kept[previous.documents][unit_kept], documents))
+        term_counts = np.concatenate((np.asarray(previous.term_counts)[unit_kept], term_counts))
+        old_entry_keys = np.repeat(np.asarray(previous.keys), np.diff(previous.ptr))[entry_kept]
+        if is_document_level:
+            old_entry_keys = kept[old_entry_keys]
+        entry_keys = np.concatenate((old_entry_keys, entry_keys))
+        entry_terms = np.concatenate((np.asarray(previous.terms)[entry_kept], entry_terms))
+        entry_frequencies = np.concatenate((np.asarray(previous.frequencies)[entry_kept], entry_frequencies))
+
+    order = np.argsort(keys, kind='stable')
+    keys, documents, term_counts = keys[order], documents[order], term_counts[order]
+    # Entries of units that are not in the snapshot are dropped along with them
+    units = np.minimum(np.searchsorted(keys, entry_keys), max(len(keys) - 1, 0))
+    found = keys[units] == entry_keys if len(keys) > 0 else np.zeros(len(entry_keys), dtype=bool)
+    units, entry_terms, entry_frequencies = units[found], entry_terms[found], entry_frequencies[found]
+    order = np.lexsort((entry_terms, units))
+    ptr = np.concatenate(([0], np.cumsum(np.bincount(units, minlength=len(keys))))).astype(np.int64)
+    # The columns of the database are INTs
+    return LevelMatrix(keys, documents.astype(np.int32), term_counts.astype(np.int32), ptr,
+                       entry_terms[order].astype(np.int32), entry_frequencies[order].astype(np.int32))
+
+
+def _score(matrix, term_ids):
+    """
+    :param matrix: A LevelMatrix
+    :param term_ids: The increasing ids of every term of the matrix
+    :return: The array of the tfidf scores of the entries of the matrix
+    """
+    terms = np.searchsorted(term_ids, matrix.terms)
+    df = np.bincount(terms[matrix.frequencies > 0], minlength=len(term_ids))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = matrix.frequencies / matrix.term_counts[matrix.entry_units()] * np.log(len(matrix) / df[terms])
+    scores[~np.isfinite(scores)] = np.nan
+    return scores
+
+
+def refresh_snapshot(cursor, directory, keep=2, set_progress_callback=None, poll_cancel=None):
+    """
+    Writes a snapshot of the current corpus version, from the most recent snapshot and the documents written since
+    :param cursor: The database cursor
+    :param directory: The directory holding the snapshots
+    :param keep: The number of snapshots kept
+    :param set_progress_callback: A function called with the fraction of levels read so far
+    :param poll_cancel: A function returning True when the refresh should stop, checked between levels
+    :return: The CorpusSnapshot of the current corpus version, or None if the refresh was cancelled
+    """
+    # The version and the documents are read in the same transaction
+    begin_read(cursor)
+    version = get_corpus_version(cursor)
+    previous = load_snapshot(directory)
+    if previous is not None and previous.version == version:
+        return previous
+    if previous is not None and previous.version > version:
+        # The database was restored from an earlier state
+        previous = None
+
+    cursor.execute('SELECT document_id, timestamp, corpus_version FROM document')
+    rows = sorted(cursor.fetchall())
+    document_ids = np.array([document_id for document_id, _, _ in rows], dtype=str)
+    document_index = {document_id: i for i, (document_id, _, _) in enumerate(rows)}
+    timestamps = np.array([timestamp for _, timestamp, _ in rows], dtype='datetime64[D]')
+
+    kept = None
+    changed = None
+    if previous is not None:
+        # Documents written before versions were recorded have none, and are unchanged since any snapshot holding them
+        unchanged = {document_id for document_id, _, written in rows if written is None or written <= previous.version}
+        kept = np.array([document_index[d] if d in unchanged else -1 for d in previous.document_ids.tolist()],
+                        dtype=np.int64)
+        held = set(previous.document_ids.tolist())
+        changed = [document_id for document_id, _, _ in rows if document_id not in unchanged or document_id not in held]
+
+    levels = {}
+    for i, level in enumerate(LEVELS):
+        if poll_cancel is not None and poll_cancel() is True:
+            return None
+        unit_rows, entry_rows = _read_level(cursor, level, changed)
+        levels[level.name] = _build_level(previous.level(level) if previous is not None else None, kept,
+                                          document_index, unit_rows, entry_rows, level is DOCUMENT_LEVEL)
+        if set_progress_callback is not None:
+            set_progress_callback((i + 1) / len(LEVELS))
+
+    term_ids = np.unique(np.concatenate([matrix.terms for matrix in levels.values()])).astype(np.int32)
+    texts = {}
+    if previous is not None:
+        texts.update(zip(previous.term_ids.tolist(), previous.term_texts.tolist()))
+    missing = [t for t in term_ids.tolist() if t not in texts]
+    for chunk, placeholders in in_chunks(missing):
+        cursor.execute('SELECT term_id, term_text FROM term WHERE term_id IN ({})'.format(placeholders), tuple(chunk))
+        texts.update(cursor.fetchall())
+    term_texts = np.array([texts[t] for t in term_ids.tolist()], dtype=str)
+
+    for matrix in levels.values():
+        matrix.scores = _score(matrix, term_ids)
+    snapshot = CorpusSnapshot(version, term_ids, term_texts, document_ids, timestamps, levels)
+    path = snapshot.save(directory)
+
+    for old_version in snapshot_versions(directory)[keep:]:
+        shutil.rmtree(os.path.join(directory, 'snapshot-v{}'.format(old_version)), ignore_errors=True)
+    return CorpusSnapshot.load(path)
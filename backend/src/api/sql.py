@@ -0,0 +1,122 @@
+"""
+Helpers for batched SQL statements, and for the few statements that differ between MySQL and SQLite
+"""
+
+from itertools import chain
+
+MYSQL = 'mysql'
+SQLITE = 'sqlite'
+
+"""
+Rows per multi-row INSERT statement, which keeps statements well below the default max_allowed_packet
+"""
+MAX_ROWS_PER_STATEMENT = 5000
+
+_auto_increment_step = None
+
+
+def dialect(cursor):
+    """
+    :param cursor: The database cursor
+    :return: MYSQL or SQLITE. Cursors of SQLiteStorage say so with a `dialect` attribute
+    """
+    return getattr(cursor, 'dialect', MYSQL)
+
+
+def begin_read(cursor):
+    """
+    Makes the following reads of the transaction see the same state of the database, until it ends.
+    MySQL's REPEATABLE READ transactions already do from their first read, but the sqlite3 module only starts
+    transactions before writes, so SQLite gets an explicit deferred transaction, which takes its snapshot at the first
+    read under WAL
+    :param cursor: The database cursor, whose connection has no transaction in progress on SQLite
+    """
+    if dialect(cursor) == SQLITE and not cursor.connection.in_transaction:
+        cursor.execute('BEGIN')
+
+
+def insert_ignore(cursor):
+    """
+    :return: The INSERT statement keyword that skips rows conflicting with a unique key
+    """
+    return 'INSERT OR IGNORE' if dialect(cursor) == SQLITE else 'INSERT IGNORE'
+
+
+def increment_on_conflict(cursor, key_columns, columns):
+    """
+    :param cursor: The database cursor
+    :param key_columns: The columns of the unique key the inserted rows may conflict with
+    :param columns: The columns to which the inserted values are added when a row already exists
+    :return: The clause appended to a multi-row INSERT, to add its values to the rows that already exist
+    """
+    if dialect(cursor) == SQLITE:
+        return ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            ', '.join(key_columns), ', '.join('{0} = {0} + excluded.{0}'.format(c) for c in columns))
+    return ' ON DUPLICATE KEY UPDATE {}'.format(', '.join('{0} = {0} + VALUES({0})'.format(c) for c in columns))
+
+
+def replace_on_conflict(cursor, key_columns, columns):
+    """
+    :param cursor: The database cursor
+    :param key_columns: The columns of the unique key the inserted rows may conflict with
+    :param columns: The columns set to the inserted values when a row already exists
+    :return: The clause appended to a multi-row INSERT, to overwrite the rows that already exist
+    """
+    if dialect(cursor) == SQLITE:
+        return ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            ', '.join(key_columns), ', '.join('{0} = excluded.{0}'.format(c) for c in columns))
+    return ' ON DUPLICATE KEY UPDATE {}'.format(', '.join('{0} = VALUES({0})'.format(c) for c in columns))
+
+
+def auto_increment_step(cursor):
+    """
+    :param cursor: The database cursor
+    :return: The server's AUTO_INCREMENT step (auto_increment_increment), read once per process. Always 1 on SQLite
+    """
+    global _auto_increment_step
+    if dialect(cursor) == SQLITE:
+        return 1
+    if _auto_increment_step is None:
+        cursor.execute('SELECT @@auto_increment_increment')
+        _auto_increment_step, = cursor.fetchone()
+    return _auto_increment_step
+
+
+def insert_rows(cursor, statement, row_template, rows, suffix='', return_ids=False):
+    """
+    Inserts rows with as few multi-row INSERT statements as possible.
+    When `return_ids` is set, the AUTO_INCREMENT ids of the rows are derived from the id of the first row of each
+    statement, without reading them back. InnoDB reserves the ids of a multi-row INSERT with a known number of rows (a
+    "simple insert") in one block, so they are consecutive, provided that no INSERT ... SELECT or LOAD DATA runs
+    concurrently on the same table when innodb_autoinc_lock_mode is 2. SQLite has a single writer, so its ids are
+    consecutive too, but it reports the id of the last row rather than the first.
+    :param cursor: The database cursor
+    :param statement: The statement up to and including VALUES
+    :param row_template: The placeholders of one row, e.g. '(%s, %s)'
+    :param rows: A list of tuples of values
+    :param suffix: SQL appended after the values, e.g. an ON DUPLICATE KEY UPDATE clause
+    :param return_ids: Whether to return the AUTO_INCREMENT ids of the inserted rows
+    :return: The list of ids of the inserted rows, in order, if `return_ids` is set
+    """
+    ids = []
+    step = auto_increment_step(cursor) if return_ids and len(rows) > 0 else 1
+    last_row_id = dialect(cursor) == SQLITE
+    for i in range(0, len(rows), MAX_ROWS_PER_STATEMENT):
+        chunk = rows[i:i + MAX_ROWS_PER_STATEMENT]
+        cursor.execute(statement + ' ' + ','.join([row_template] * len(chunk)) + suffix,
+                       tuple(chain.from_iterable(chunk)))
+        if return_ids:
+            first_id = cursor.lastrowid - (len(chunk) - 1) * step if last_row_id else cursor.lastrowid
+            ids.extend(first_id + j * step for j in range(len(chunk)))
+    return ids if return_ids else None
+
+
+def in_chunks(values):
+    """
+    Splits values bound to an IN list, so that each statement stays below MAX_ROWS_PER_STATEMENT parameters
+    :param values: A list of values
+    :return: A generator of (chunk of values, placeholders of the chunk) pairs
+    """
+    for i in range(0, len(values), MAX_ROWS_PER_STATEMENT):
+        chunk = values[i:i + MAX_ROWS_PER_STATEMENT]
+        yield chunk, ','.join(['%s'] * len(chunk))
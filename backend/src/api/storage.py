@@ -0,0 +1,170 @@
+"""
+Storage backends: the MySQL server the app was built on, and an embedded SQLite database for single-node deployments and
+hermetic benchmarks.
+
+Both hand out DB-API connections whose cursors take `%s` placeholders, so the rest of the code runs the same SQL on
+either. The few statements that differ are picked by `api.sql.dialect`, which reads the `dialect` attribute of SQLite
+cursors.
+"""
+
+import math
+import os
+import sqlite3
+from datetime import date
+from threading import Lock
+
+import pymysql
+
+from api.sql import MYSQL, SQLITE
+from api.terms import TermDictionary
+
+"""
+The exceptions raised by either backend
+"""
+Error = (pymysql.err.Error, sqlite3.Error)
+OperationalError = (pymysql.err.OperationalError, sqlite3.OperationalError)
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_sqlite.sql')
+SQLITE_TERM_IDS_MIGRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migration_term_ids_sqlite.sql')
+
+"""
+The columns added to databases created by earlier versions of the schema, as (table, column, type) tuples: the term
+positions, and the corpus versions of documents
+"""
+SQLITE_ADDED_COLUMNS = (('paragraph', 'token_offsets', 'BLOB'), ('paragraph_term', 'positions', 'BLOB'),
+                        ('document', 'corpus_version', 'BIGINT'),
+                        ('document', 'statistics_pending', 'BOOLEAN NOT NULL DEFAULT 0'))
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_converter('DATE', lambda value: date.fromisoformat(value.decode('ascii')))
+
+
+class MySQLStorage:
+    dialect = MYSQL
+
+    def __init__(self, connect_args):
+        """
+        :param connect_args: The PyMySQL connection arguments
+        """
+        self.connect_args = connect_args
+        self.term_dictionary = TermDictionary()
+
+    def connect(self):
+        conn = pymysql.connect(**self.connect_args)
+        conn.term_dictionary = self.term_dictionary
+        return conn
+
+    def ping(self, conn):
+        """
+        Raises one of `Error` if the connection is no longer usable
+        """
+        conn.ping(reconnect=False)
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    """
+    A cursor taking the `%s` placeholders of PyMySQL
+    """
+
+    dialect = SQLITE
+
+    def execute(self, query, args=None):
+        return super().execute(query.replace('%s', '?'), () if args is None else args)
+
+    def executemany(self, query, args):
+        return super().executemany(query.replace('%s', '?'), args)
+
+
+class SQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+
+def _ln(x):
+    # MySQL's LOG returns NULL out of its domain rather than raising
+    return math.log(x) if x is not None and x > 0 else None
+
+
+class SQLiteStorage:
+    dialect = SQLITE
+
+    def __init__(self, path, timeout=30):
+        """
+        :param path: The database file, created along with the schema if it does not exist
+        :param timeout: The number of seconds a write waits for another one to finish
+        """
+        self.path = path
+        self.timeout = timeout
+        self.term_dictionary = TermDictionary()
+        self._initialized = False
+        self._initialize_lock = Lock()
+
+    def connect(self):
+        # Connections are checked out of a pool by one thread at a time, but not always the thread that opened them
+        conn = sqlite3.connect(self.path, timeout=self.timeout, factory=SQLiteConnection, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.create_function('LN', 1, _ln, deterministic=True)
+        # Readers see the last committed state without blocking the writer, and a commit does not wait for a checkpoint
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.term_dictionary = self.term_dictionary
+
+        if not self._initialized:
+            with self._initialize_lock:
+                if not self._initialized:
+                    self._migrate(conn)
+                    with open(SQLITE_SCHEMA, 'r') as f:
+                        conn.executescript(f.read())
+                    self._initialized = True
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        """
+        Converts a database created by an earlier version of the schema
+        """
+        def columns(table):
+            return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table)).fetchall()]
+
+        def needs_term_ids():
+            term_columns = columns('term')
+            return len(term_columns) > 0 and 'term_id' not in term_columns
+
+        def missing_columns():
+            return [(table, column, column_type) for table, column, column_type in SQLITE_ADDED_COLUMNS
+                    if len(columns(table)) > 0 and column not in columns(table)]
+
+        if not needs_term_ids() and len(missing_columns()) == 0:
+            return
+        # Another process may have converted the database while this one waited for the write lock
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if needs_term_ids():
+                with open(SQLITE_TERM_IDS_MIGRATION, 'r') as f:
+                    for statement in f.read().split(';'):
+                        if sqlite3.complete_statement(statement + ';'):
+                            conn.execute(statement)
+            for table, column, column_type in missing_columns():
+                conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, column_type))
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def ping(self, conn):
+        conn.execute('SELECT 1')
+
+
+def create_storage(backend, connect_args=None, sqlite_path=None):
+    """
+    :param backend: 'mysql' or 'sqlite'
+    :param connect_args: The PyMySQL connection arguments, for MySQL
+    :param sqlite_path: The database file, for SQLite
+    :return: The storage backend
+    """
+    if backend == MYSQL:
+        return MySQLStorage(connect_args)
+    if backend == SQLITE:
+        return SQLiteStorage(sqlite_path)
+    raise ValueError('unknown storage backend {}'.format(backend))
@@ -0,0 +1,117 @@
+"""
+The term dictionary. Stemmed terms are stored once, in the `term` table, and every other table refers to them by their
+integer `term_id`, which keeps the rows and indexes of the `*_term`, `term_df` and `term_trend` tables narrow and their
+joins on integers.
+
+Terms are never deleted from the dictionary, so an id, once assigned, always names the same term. Each storage backend
+keeps a TermDictionary caching the ids it has seen, which spares writes and trend queries a lookup per term.
+"""
+
+from threading import Lock
+
+from api.sql import MAX_ROWS_PER_STATEMENT, MYSQL, dialect, insert_ignore, insert_rows
+
+
+class TermDictionary:
+    """
+    Caches the ids of the terms of one database. Thread safe
+    """
+
+    def __init__(self, max_size=1 << 20):
+        """
+        :param max_size: The number of cached terms past which the cache is emptied
+        """
+        self.max_size = max_size
+        self._ids = {}
+        self._lock = Lock()
+
+    def clear(self):
+        """
+        Forgets every cached id, which is needed when the `term` table is emptied
+        """
+        with self._lock:
+            self._ids = {}
+
+    def _cache(self, ids):
+        with self._lock:
+            if len(self._ids) + len(ids) > self.max_size:
+                self._ids = {}
+            self._ids.update(ids)
+
+    def _lookup(self, cursor, terms, inserted=False):
+        ids = {}
+        for i in range(0, len(terms), MAX_ROWS_PER_STATEMENT):
+            chunk = terms[i:i + MAX_ROWS_PER_STATEMENT]
+            cursor.execute('SELECT term_text, term_id FROM term WHERE term_text IN ({})'.format(
+                ','.join(['%s'] * len(chunk))), tuple(chunk))
+            ids.update(cursor.fetchall())
+        if inserted and dialect(cursor) == MYSQL:
+            # MySQL compares terms by the collation of the column, which may equate terms that differ, e.g. by accents,
+            # and then returns the one stored first. Terms sharing an id are told apart here
+            for t in terms:
+                if t not in ids:
+                    cursor.execute('SELECT term_id FROM term WHERE term_text = %s', (t,))
+                    ids[t], = cursor.fetchone()
+        return {t: ids[t] for t in terms if t in ids}
+
+    def get_ids(self, cursor, terms):
+        """
+        :param cursor: The database cursor
+        :param terms: An iterable of stemmed terms
+        :return: A dict mapping the terms of the dictionary to their ids. Unknown terms are left out
+        """
+        with self._lock:
+            ids = {t: self._ids[t] for t in terms if t in self._ids}
+        missing = sorted(t for t in set(terms) if t not in ids)
+        if len(missing) > 0:
+            found = self._lookup(cursor, missing)
+            self._cache(found)
+            ids.update(found)
+        return ids
+
+    def add_terms(self, cursor, terms):
+        """
+        Adds terms to the dictionary, unless they are already in it
+        :param cursor: The database cursor
+        :param terms: An iterable of stemmed terms
+        :return: A dict mapping every term to its id
+        """
+        terms = set(terms)
+        with self._lock:
+            ids = {t: self._ids[t] for t in terms if t in self._ids}
+        missing = sorted(terms - ids.keys())
+        if len(missing) > 0:
+            found = self._lookup(cursor, missing)
+            self._cache(found)
+            ids.update(found)
+            new = [t for t in missing if t not in found]
+            if len(new) > 0:
+                # In sorted order, so that concurrent ingestions lock terms in the same order. The ids of the new terms
+                # are not cached, since the transaction adding them may still roll back
+                insert_rows(cursor, insert_ignore(cursor) + ' INTO term (term_text) VALUES', '(%s)',
+                            [(t,) for t in new])
+                ids.update(self._lookup(cursor, new, inserted=True))
+        return ids
+
+
+def get_term_dictionary(cursor):
+    """
+    :param cursor: The database cursor
+    :return: The TermDictionary of the database of the cursor. Connections opened by a storage backend share the
+      dictionary of the backend, others get an empty one
+    """
+    dictionary = getattr(cursor.connection, 'term_dictionary', None)
+    return dictionary if dictionary is not None else TermDictionary()
+
+
+def encode_term_counts(term_counts, ids):
+    """
+    :param term_counts: A Counter of terms
+    :param ids: A dict mapping each term to its id
+    :return: A dict mapping term ids to frequencies. Terms sharing an id have their frequencies added up
+    """
+    encoded = {}
+    for t, f in term_counts.items():
+        term_id = ids[t]
+        encoded[term_id] = encoded.get(term_id, 0) + f
+    return encoded
@@ -0,0 +1,192 @@
+"""
+TF-IDF statistics for the document, paragraph and sentence levels.
+
+The score of a term in a unit is tf * idf, where tf is the frequency of the term divided by the total frequency of all
+terms in the unit, and idf is the natural log of the number of units divided by the number of units containing the
+term. Scores are not stored. Instead, the statistics they are made of are persisted and maintained as documents come and
+go:
+  * `term_count` on each unit table, the total frequency of all terms in the unit (the tf denominator)
+  * `term_df`, the number of units containing each term at each level (the idf denominator)
+  * `unit_count`, the number of units at each level (the idf numerator)
+The `*_term_score` views combine them into scores at read time, so a write only touches the statistics of the terms of
+the document being written, and the idf of every other term adjusts lazily.
+"""
+
+from collections import namedtuple, Counter
+from itertools import chain
+
+from api.sql import MYSQL, SQLITE, dialect, increment_on_conflict, insert_rows
+
+"""
+A level of granularity at which terms are counted and scored.
+`unit_table` holds one row per unit (document, paragraph or sentence), keyed by `unit_key`, and `term_table` holds the
+per-unit term frequencies. `document_join` joins `unit_table` to the table holding the `document_id` of the unit, and
+`score_view` is the view exposing the scores of `term_table`.
+"""
+Level = namedtuple('Level', ['name', 'unit_table', 'unit_key', 'term_table', 'document_join', 'score_view'])
+
+DOCUMENT_LEVEL = Level('document', 'document', 'document_id', 'document_term', '', 'document_term_score')
+PARAGRAPH_LEVEL = Level('paragraph', 'paragraph', 'paragraph_id', 'paragraph_term', '', 'paragraph_term_score')
+SENTENCE_LEVEL = Level('sentence', 'sentence', 'sentence_id', 'sentence_term', 'JOIN paragraph USING (paragraph_id)',
+                       'sentence_term_score')
+
+LEVELS = (DOCUMENT_LEVEL, PARAGRAPH_LEVEL, SENTENCE_LEVEL)
+
+"""
+Rebuilds the statistics of a level from its term table with set-based statements, each aggregating once over the whole
+table. Statements that differ between MySQL and SQLite are dicts keyed by dialect.
+"""
+_REBUILD_TERM_COUNT_SQL = {
+    MYSQL: '''
+UPDATE {unit_table}
+LEFT JOIN (
+    SELECT {unit_key}, SUM(frequency) AS total FROM {term_table} GROUP BY {unit_key}
+) AS unit_total USING ({unit_key})
+SET {unit_table}.term_count = IFNULL(unit_total.total, 0)
+''',
+    SQLITE: '''
+UPDATE {unit_table} SET term_count = IFNULL((
+    SELECT SUM(frequency) FROM {term_table} WHERE {term_table}.{unit_key} = {unit_table}.{unit_key}
+), 0)
+''',
+}
+_CLEAR_TERM_DF_SQL = 'DELETE FROM term_df WHERE level = %s'
+_REBUILD_TERM_DF_SQL = '''
+INSERT INTO term_df (level, term_id, df)
+SELECT %s, term_id, COUNT(*) FROM {term_table} WHERE frequency > 0 GROUP BY term_id
+'''
+_REBUILD_UNIT_COUNT_SQL = {
+    MYSQL: '''
+INSERT INTO unit_count (level, n) SELECT %s, COUNT(*) FROM {unit_table}
+ON DUPLICATE KEY UPDATE n = VALUES(n)
+''',
+    SQLITE: '''
+INSERT INTO unit_count (level, n) SELECT %s, COUNT(*) FROM {unit_table} WHERE true
+ON CONFLICT (level) DO UPDATE SET n = excluded.n
+''',
+}
+
+"""
+Removes the contribution of one document to the statistics of a level. This must run before the document is deleted.
+"""
+_REMOVE_DOCUMENT_TERM_DF_SQL = {
+    MYSQL: '''
+UPDATE term_df
+JOIN (
+    SELECT term_id, COUNT(*) AS df FROM {term_table}
+    JOIN {unit_table} USING ({unit_key}) {document_join}
+    WHERE document_id = %s AND frequency > 0 GROUP BY term_id
+) AS document_df USING (term_id)
+SET term_df.df = term_df.df - document_df.df
+WHERE term_df.level = %s
+''',
+    SQLITE: '''
+UPDATE term_df SET df = term_df.df - document_df.df
+FROM (
+    SELECT term_id, COUNT(*) AS df FROM {term_table}
+    JOIN {unit_table} USING ({unit_key}) {document_join}
+    WHERE document_id = %s AND frequency > 0 GROUP BY term_id
+) AS document_df
+WHERE term_df.term_id = document_df.term_id AND term_df.level = %s
+''',
+}
+_REMOVE_DOCUMENT_UNIT_COUNT_SQL = '''
+UPDATE unit_count SET n = n - (
+    SELECT COUNT(*) FROM {unit_table} {document_join} WHERE document_id = %s
+) WHERE level = %s
+'''
+
+
+def _format(sql, level, cursor=None):
+    if isinstance(sql, dict):
+        sql = sql[dialect(cursor)]
+    return sql.format(
+        unit_table=level.unit_table,
+        unit_key=level.unit_key,
+        term_table=level.term_table,
+        document_join=level.document_join,
+    )
+
+
+def rebuild_level_statistics(cursor, level):
+    """
+    Recomputes the term counts, document frequencies and unit count of one level from scratch
+    :param cursor: The database cursor
+    :param level: The Level to rebuild
+    """
+    cursor.execute(_format(_REBUILD_TERM_COUNT_SQL, level, cursor))
+    cursor.execute(_CLEAR_TERM_DF_SQL, (level.name,))
+    cursor.execute(_format(_REBUILD_TERM_DF_SQL, level), (level.name,))
+    cursor.execute(_format(_REBUILD_UNIT_COUNT_SQL, level, cursor), (level.name,))
+
+
+def rebuild_all_statistics(cursor, levels=LEVELS):
+    """
+    Recomputes the tfidf statistics of every level from scratch.
+    Writes keep the statistics up to date, so this is only needed to repair them, or after loading rows directly.
+    :param cursor: The database cursor
+    :param levels: The levels to rebuild
+    """
+    for level in levels:
+        rebuild_level_statistics(cursor, level)
+
+
+def add_document_statistics(cursor, unit_term_counts):
+    """
+    Adds the contribution of a newly inserted document to the document frequencies and unit counts.
+    The term counts of the units are expected to have been written along with the units themselves.
+    :param cursor: The database cursor
+    :param unit_term_counts: A dict mapping each Level to the list of term counts of the document's units at that level,
+      as dicts mapping term ids to frequencies
+    """
+    df_rows = []
+    unit_count_rows = []
+    for level, counters in unit_term_counts.items():
+        df = Counter(chain.from_iterable((t for t, f in c.items() if f > 0) for c in counters))
+        df_rows.extend((level.name, t, n) for t, n in df.items())
+        unit_count_rows.append((level.name, len(counters)))
+
+    insert_rows(cursor, 'INSERT INTO term_df (level, term_id, df) VALUES', '(%s, %s, %s)', sorted(df_rows),
+                suffix=increment_on_conflict(cursor, ('level', 'term_id'), ('df',)))
+    insert_rows(cursor, 'INSERT INTO unit_count (level, n) VALUES', '(%s, %s)', unit_count_rows,
+                suffix=increment_on_conflict(cursor, ('level',), ('n',)))
+
+
+def update_document_statistics(cursor, removed_unit_term_counts, added_unit_term_counts):
+    """
+    Replaces the contribution of some units of a document to the document frequencies and unit counts by the one of
+    other units, for documents updated in place. A unit whose term counts change is both removed and added.
+    The term counts of the units are expected to have been written along with the units themselves.
+    :param cursor: The database cursor
+    :param removed_unit_term_counts: A dict mapping Levels to the lists of the former term counts of the units removed
+      or changed at that level, as dicts mapping term ids to frequencies
+    :param added_unit_term_counts: The same for the new term counts of the units added or changed
+    """
+    df_rows = []
+    unit_count_rows = []
+    for level in LEVELS:
+        removed = removed_unit_term_counts.get(level, [])
+        added = added_unit_term_counts.get(level, [])
+        df = Counter(chain.from_iterable((t for t, f in c.items() if f > 0) for c in added))
+        df.subtract(chain.from_iterable((t for t, f in c.items() if f > 0) for c in removed))
+        df_rows.extend((level.name, t, n) for t, n in df.items() if n != 0)
+        if len(added) != len(removed):
+            unit_count_rows.append((level.name, len(added) - len(removed)))
+
+    insert_rows(cursor, 'INSERT INTO term_df (level, term_id, df) VALUES', '(%s, %s, %s)', sorted(df_rows),
+                suffix=increment_on_conflict(cursor, ('level', 'term_id'), ('df',)))
+    insert_rows(cursor, 'INSERT INTO unit_count (level, n) VALUES', '(%s, %s)', unit_count_rows,
+                suffix=increment_on_conflict(cursor, ('level',), ('n',)))
+
+
+def remove_document_statistics(cursor, doc_uuid, levels=LEVELS):
+    """
+    Removes the contribution of a document to the document frequencies and unit counts.
+    This must be called before the document is deleted.
+    :param cursor: The database cursor
+    :param doc_uuid: The UUID of the document
+    :param levels: The levels to update
+    """
+    for level in levels:
+        cursor.execute(_format(_REMOVE_DOCUMENT_TERM_DF_SQL, level, cursor), (str(doc_uuid), level.name))
+        cursor.execute(_format(_REMOVE_DOCUMENT_UNIT_COUNT_SQL, level), (str(doc_uuid), level.name))
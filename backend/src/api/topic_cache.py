@@ -0,0 +1,184 @@
+"""
+A disk-backed cache of topic generation results, shared by every worker process
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+_ENTRY_PATTERN = re.compile(r'^topics-(?P<params>[0-9a-f]+)-v(?P<version>\d+)\.json$')
+
+
+def params_key(params):
+    """
+    :param params: A JSON serializable dict of clustering parameters
+    :return: A short stable hash of the parameters
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _alive(pid):
+    """
+    :return: Whether a process with this id exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TopicCache:
+    """
+    Stores one JSON file per (clustering parameters, corpus version) pair.
+    Entries are written atomically, so concurrent readers never see a partial result, and a lock file per entry makes
+    sure only one process computes it at a time.
+    """
+
+    def __init__(self, directory, keep=2):
+        """
+        :param directory: The directory holding the cache files. It is created if needed
+        :param keep: The number of versions kept for each set of parameters
+        """
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self._takeover_path = os.path.join(directory, 'takeover.lock')
+
+    def _path(self, version, params, suffix):
+        return os.path.join(self.directory, 'topics-{}-v{}.{}'.format(params_key(params), version, suffix))
+
+    def _versions(self, params):
+        key = params_key(params)
+        versions = []
+        for name in os.listdir(self.directory):
+            match = _ENTRY_PATTERN.match(name)
+            if match is not None and match.group('params') == key:
+                versions.append(int(match.group('version')))
+        return sorted(versions, reverse=True)
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def get(self, version, params):
+        """
+        :return: The cached topics for this corpus version and parameters, or None
+        """
+        entry = self._read(self._path(version, params, 'json'))
+        return entry['result'] if entry is not None else None
+
+    def latest(self, params):
+        """
+        Finds the most recent result computed with these parameters, whatever its corpus version
+        :return: A (version, topics) pair, or None
+        """
+        for version in self._versions(params):
+            entry = self._read(self._path(version, params, 'json'))
+            if entry is not None:
+                return version, entry['result']
+        return None
+
+    def put(self, version, params, result):
+        """
+        Stores a result, and removes the results of older corpus versions beyond the number kept
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'version': version,
+                'params': params,
+                'computed_at': time.time(),
+                'result': result,
+            }, f)
+        os.replace(tmp_path, self._path(version, params, 'json'))
+
+        for old_version in self._versions(params)[self.keep:]:
+            try:
+                os.remove(self._path(old_version, params, 'json'))
+            except FileNotFoundError:
+                pass
+
+    def _write_lock(self, progress):
+        """
+        Writes the lock file contents to a temporary file, whose path is returned
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'pid': os.getpid(), 'progress': progress}, f)
+        return tmp_path
+
+    def try_lock(self, version, params):
+        """
+        Claims the computation of an entry for this process.
+        The lock file is written in full before it is linked into place, so other processes never read a partial one.
+        A lock left behind by a process that no longer exists is taken over, by one process at a time: the others then
+        find the lock of the process that took it over.
+        :return: True if the lock was acquired
+        """
+        path = self._path(version, params, 'lock')
+        tmp_path = self._write_lock(0)
+        try:
+            try:
+                os.link(tmp_path, path)
+                return True
+            except FileExistsError:
+                pass
+            if self.lock_owner(version, params) is not None:
+                return False
+            # Released by the system if this process dies, so takeovers never leave a stale lock of their own
+            with open(self._takeover_path, 'a') as takeover_file:
+                fcntl.flock(takeover_file, fcntl.LOCK_EX)
+                try:
+                    while True:
+                        try:
+                            os.link(tmp_path, path)
+                            return True
+                        except FileExistsError:
+                            pass
+                        lock = self._read(path)
+                        if lock is None and not os.path.exists(path):
+                            # Released meanwhile
+                            continue
+                        if lock is not None and _alive(lock['pid']):
+                            return False
+                        # A lock whose owner is gone is only replaced by takeovers, which take turns, so it is still
+                        # the one found stale
+                        os.replace(tmp_path, path)
+                        return True
+                finally:
+                    fcntl.flock(takeover_file, fcntl.LOCK_UN)
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def lock_owner(self, version, params):
+        """
+        :return: The lock file contents ({'pid', 'progress'}) if a live process is computing this entry, else None
+        """
+        lock = self._read(self._path(version, params, 'lock'))
+        return lock if lock is not None and _alive(lock['pid']) else None
+
+    def set_progress(self, version, params, progress):
+        """
+        Publishes the progress of a computation to the other processes
+        """
+        path = self._path(version, params, 'lock')
+        os.replace(self._write_lock(progress), path)
+
+    def unlock(self, version, params):
+        try:
+            os.remove(self._path(version, params, 'lock'))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,463 @@
+"""
+Topic generation over an in-memory term x document score matrix.
+
+The exact mode checks every term against every term of the topics grown before it, which takes a time growing with the
+square of the vocabulary. The approximate mode only checks the pairs of terms found by locality-sensitive hashing to
+share documents, since other pairs have a similarity score of 0 and always match, so it takes a time growing with the
+number of pairs found. Each band hashes terms by several MinHash values: a pair of terms whose sets of documents have a
+Jaccard similarity of J is found with a probability of 1 - (1 - J^rows)^bands (see lsh_recall), which is close to 1 for
+pairs sharing a large fraction of their documents and falls quickly for the others. The default bands find at least
+LSH_RECALL of the pairs with a similarity of LSH_JACCARD. Pairs sharing a small fraction of their documents are mostly
+missed, and may put terms that do not match in the same topic: `python -m benchmarks.topics` reports the fraction of the
+pairs sharing a document that are found, along with the time of both modes.
+"""
+
+import math
+
+import numpy as np
+
+from api.tfidf import DOCUMENT_LEVEL
+
+"""
+Two terms whose similarity score is below this threshold are considered to be part of the same topic
+"""
+SIMILARITY_THRESHOLD = 0.001
+
+"""
+Upper bound on the number of intermediate values materialized when computing a block of similarity scores
+"""
+BLOCK_BUDGET = 1 << 22
+
+"""
+Recall target of the approximate mode: the fraction of the pairs of terms with a Jaccard similarity of LSH_JACCARD that
+its default number of bands finds
+"""
+LSH_RECALL = 0.95
+LSH_JACCARD = 0.3
+
+"""
+Default number of bands of the approximate mode, the fewest meeting the recall target. Each band hashes every term by
+`LSH_ROWS` MinHash values of its set of documents, and terms sharing a bucket in any band are compared. More bands find
+more of the pairs of terms sharing documents, which makes the result closer to the exact one, and slower to compute.
+With a single row, the pairs of low similarity, which are most of the pairs sharing a document, fill the buckets, and
+checking them takes longer than the exact mode
+"""
+LSH_ROWS = 2
+LSH_BANDS = math.ceil(math.log(1 - LSH_RECALL) / math.log(1 - LSH_JACCARD ** LSH_ROWS))
+
+"""
+Size above which the buckets of a band are left out of the approximate mode. With more than one row, a large bucket
+gathers the terms of a document ranked first by every permutation of the band, e.g. a long one, all of whose pairs would
+be checked
+"""
+LSH_MAX_BUCKET = 256
+
+"""
+Seed of the MinHash permutations, fixed so that every process computes the same buckets
+"""
+LSH_SEED = 0
+
+
+class TermDocumentMatrix:
+    """
+    The sparse matrix of document level tfidf scores, indexed by term and by document.
+    The nonzero entries are stored twice, grouped by term (`term_ptr`, `term_docs`, `term_scores`) and grouped by document
+    (`doc_ptr`, `doc_terms`, `doc_scores`), in the same layout as CSR and CSC matrices.
+    """
+
+    def __init__(self, terms, term_indices, doc_indices, scores, document_count):
+        """
+        :param terms: The list of terms, in the order topics are grown
+        :param term_indices: The term index of each entry
+        :param doc_indices: The document index of each entry
+        :param scores: The score of each entry. NULL scores are NaN
+        :param document_count: The number of documents
+        """
+        self.terms = terms
+        term_indices = np.asarray(term_indices, dtype=np.int64)
+        doc_indices = np.asarray(doc_indices, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float64)
+        # NULL scores are left out, like the SQL similarity score leaves out their NULL differences. A term with no other
+        # score then has no entry, and never matches, like a NULL similarity score
+        known = ~np.isnan(scores)
+        term_indices, doc_indices, scores = term_indices[known], doc_indices[known], scores[known]
+
+        by_term = np.lexsort((doc_indices, term_indices))
+        self.term_ptr = np.concatenate(([0], np.cumsum(np.bincount(term_indices, minlength=len(terms)))))
+        self.term_docs = doc_indices[by_term]
+        self.term_scores = scores[by_term]
+
+        by_doc = np.lexsort((term_indices, doc_indices))
+        self.doc_ptr = np.concatenate(([0], np.cumsum(np.bincount(doc_indices, minlength=document_count))))
+        self.doc_terms = term_indices[by_doc]
+        self.doc_scores = scores[by_doc]
+
+    @classmethod
+    def load(cls, cursor):
+        """
+        Loads the document level scores of every term
+        :param cursor: The database cursor
+        :return: The TermDocumentMatrix
+        """
+        # The term dictionary keeps terms no document contains anymore, they are left out. Topics are grown from the
+        # terms in alphabetical order, whatever order their ids were assigned in
+        cursor.execute('SELECT term_id, term_text FROM term WHERE EXISTS ('
+                       'SELECT 1 FROM document_term WHERE document_term.term_id = term.term_id) ORDER BY term_text')
+        rows = cursor.fetchall()
+        terms = [term_text for _, term_text in rows]
+        term_index = {term_id: i for i, (term_id, _) in enumerate(rows)}
+
+        cursor.execute('SELECT term_id, document_id, score FROM document_term_score')
+        doc_index = {}
+        term_indices = []
+        doc_indices = []
+        scores = []
+        for term_id, document_id, score in cursor.fetchall():
+            if term_id not in term_index:
+                continue
+            term_indices.append(term_index[term_id])
+            doc_indices.append(doc_index.setdefault(document_id, len(doc_index)))
+            scores.append(np.nan if score is None else score)
+
+        return cls(terms, term_indices, doc_indices, scores, len(doc_index))
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Builds the matrix load would read, from the document level of a corpus snapshot
+        :param snapshot: The CorpusSnapshot
+        :return: The TermDocumentMatrix
+        """
+        matrix = snapshot.level(DOCUMENT_LEVEL)
+        term_ids, term_indices = np.unique(matrix.terms, return_inverse=True)
+        _, doc_indices = np.unique(matrix.entry_units(), return_inverse=True)
+        texts = snapshot.term_texts[snapshot.term_index(term_ids)]
+        # In alphabetical order, like load
+        order = np.argsort(texts, kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return cls(texts[order].tolist(), rank[term_indices], doc_indices, matrix.scores,
+                   int(doc_indices.max(initial=-1)) + 1)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def has_scores(self):
+        """
+        :return: A boolean array telling which terms have at least one document score
+        """
+        return np.diff(self.term_ptr) > 0
+
+    def block_bounds(self, budget=BLOCK_BUDGET):
+        """
+        Splits the terms into consecutive blocks whose similarity scores can each be computed within the budget
+        :param budget: The maximum number of intermediate values per block
+        :return: A list of (start, end) term index pairs
+        """
+        doc_lengths = np.diff(self.doc_ptr)
+        entry_work = np.concatenate(([0], np.cumsum(doc_lengths[self.term_docs])))
+        work = entry_work[self.term_ptr]
+        rows_per_block = max(1, budget // max(1, len(self)))
+
+        bounds = []
+        start = 0
+        while start < len(self):
+            end = int(np.searchsorted(work, work[start] + budget, side='right')) - 1
+            end = min(max(end, start + 1), start + rows_per_block, len(self))
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def similarity_scores(self, start, end):
+        """
+        Computes the similarity scores between a block of terms and every term.
+        This is the vectorized form of the `compute_similarity_score` SQL function, which, for every document containing
+        both terms, adds up the absolute score difference once for each ordering of the two terms.
+        :param start: The index of the first term of the block
+        :param end: The index after the last term of the block
+        :return: A (end - start) x len(self) array
+        """
+        size = len(self)
+        lo, hi = self.term_ptr[start], self.term_ptr[end]
+        rows = np.repeat(np.arange(end - start), np.diff(self.term_ptr[start:end + 1]))
+        docs = self.term_docs[lo:hi]
+        scores = self.term_scores[lo:hi]
+
+        # Pair every entry of the block with every entry of its document
+        lengths = self.doc_ptr[docs + 1] - self.doc_ptr[docs]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        other = np.repeat(self.doc_ptr[docs], lengths) + offsets
+
+        differences = np.abs(np.repeat(scores, lengths) - self.doc_scores[other])
+        keys = np.repeat(rows, lengths) * size + self.doc_terms[other]
+        totals = np.bincount(keys, weights=differences, minlength=(end - start) * size)
+        return 2 * totals.reshape(end - start, size)
+
+    def pair_similarity_scores(self, first, second, budget=BLOCK_BUDGET):
+        """
+        Computes the similarity scores of pairs of terms, like similarity_scores
+        :param first: The array of the indices of the first terms of the pairs
+        :param second: The array of the indices of the second terms of the pairs
+        :param budget: The maximum number of intermediate values materialized at once
+        :return: The array of similarity scores
+        """
+        document_count = len(self.doc_ptr) - 1
+        lengths = np.diff(self.term_ptr)
+        # Entries sorted by term then document, so that the entry of a (term, document) pair is found by bisection
+        keys = np.repeat(np.arange(len(self)), lengths) * document_count + self.term_docs
+        totals = np.zeros(len(first))
+        if len(keys) == 0:
+            return totals
+
+        # The documents of the term with fewer documents are looked up among those of the other
+        swap = lengths[first] > lengths[second]
+        short, long = np.where(swap, second, first), np.where(swap, first, second)
+        work = np.cumsum(lengths[short])
+        start = 0
+        while start < len(first):
+            end = int(np.searchsorted(work, (work[start - 1] if start > 0 else 0) + budget, side='right'))
+            end = max(end, start + 1)
+            counts = lengths[short[start:end]]
+            rows = np.repeat(np.arange(end - start), counts)
+            entries = np.repeat(self.term_ptr[short[start:end]] - (np.cumsum(counts) - counts), counts) + np.arange(
+                counts.sum())
+            targets = long[start + rows] * document_count + self.term_docs[entries]
+            found = np.minimum(np.searchsorted(keys, targets), len(keys) - 1)
+            shared = keys[found] == targets
+            differences = np.abs(self.term_scores[entries[shared]] - self.term_scores[found[shared]])
+            totals[start:end] = np.bincount(rows[shared], weights=differences, minlength=end - start)
+            start = end
+        return 2 * totals
+
+    def minhashes(self, count, seed=LSH_SEED):
+        """
+        Computes MinHash values of the sets of documents of the terms: for each of `count` random permutations of the
+        documents, the smallest rank of the documents of every term.
+        The permutations only depend on the seed and on their rank, so that the first values stay the same as more are
+        asked for.
+        :param count: The number of permutations
+        :param seed: The random seed
+        :return: A len(self) x count array. Terms without any document get -1
+        """
+        document_count = len(self.doc_ptr) - 1
+        nonempty = np.diff(self.term_ptr) > 0
+        values = np.full((len(self), count), -1, dtype=np.int64)
+        if len(self.term_docs) > 0:
+            for f in range(count):
+                ranks = np.random.default_rng([seed, f]).permutation(document_count)
+                values[nonempty, f] = np.minimum.reduceat(ranks[self.term_docs], self.term_ptr[:-1][nonempty])
+        return values
+
+    def geometric_means(self):
+        """
+        Computes the geometric mean of the document scores of every term, in log space.
+        Terms without any score get a mean of 0
+        :return: An array of geometric means
+        """
+        with np.errstate(divide='ignore'):
+            logs = np.log(self.term_scores)
+        counts = np.diff(self.term_ptr)
+        sums = np.add.reduceat(logs, self.term_ptr[:-1][counts > 0]) if len(logs) > 0 else np.zeros(0)
+        means = np.zeros(len(self))
+        means[counts > 0] = np.exp(sums / counts[counts > 0])
+        return means
+
+
+def _grow_topics(matrix, threshold, on_term=None):
+    """
+    Puts every term in the first topic whose terms all have a similarity score below the threshold with it, or in a new
+    topic
+    :param on_term: A function called with the index of every term before it is placed
+    :return: The topic index of every term, and the size of every topic
+    """
+    size = len(matrix)
+    has_scores = matrix.has_scores()
+    labels = np.zeros(size, dtype=np.int64)
+    topic_sizes = []
+
+    for start, end in matrix.block_bounds():
+        similarity = matrix.similarity_scores(start, end)
+        for i in range(start, end):
+            if on_term is not None:
+                on_term(i)
+
+            # A pair of terms without any score has a NULL similarity score, which never matches
+            matches = (similarity[i - start, :i] < threshold) & (has_scores[i] | has_scores[:i])
+            matches_per_topic = np.bincount(labels[:i][matches], minlength=len(topic_sizes))
+            candidates = np.flatnonzero(matches_per_topic == topic_sizes)
+            if len(candidates) > 0:
+                labels[i] = candidates[0]
+                topic_sizes[candidates[0]] += 1
+            else:
+                labels[i] = len(topic_sizes)
+                topic_sizes.append(1)
+    return labels, topic_sizes
+
+
+def _rank_topics(matrix, labels, topic_sizes):
+    """
+    :return: The list of topics (a list of list of terms), sorted in descending order of significance, then in the
+      order of their first term
+    """
+    significance = np.bincount(labels, weights=matrix.geometric_means(), minlength=len(topic_sizes)) / np.maximum(
+        topic_sizes, 1)
+    order = np.argsort(-significance, kind='stable')
+    members = np.argsort(labels, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(topic_sizes))).astype(np.int64)
+    return [[matrix.terms[i] for i in members[bounds[k]:bounds[k + 1]]] for k in order]
+
+
+def generate_topics(matrix, threshold=SIMILARITY_THRESHOLD, set_progress_callback=None, poll_cancel=None):
+    """
+    Generates a list of topics.
+    Terms are considered in order, and each term joins the first topic whose terms all have a similarity score below the
+    threshold with it, or starts a new topic.
+    :param matrix: The TermDocumentMatrix of the corpus
+    :param threshold: The similarity score threshold
+    :param set_progress_callback: A function called with the fraction of terms processed so far
+    :param poll_cancel: A function returning True when the computation should stop
+    :return: The list of topics (a list of list of terms), sorted in descending order of significance
+    """
+    size = len(matrix)
+
+    def on_term(i):
+        if poll_cancel is not None and poll_cancel() is True:
+            raise Exception('cancelled')
+        if set_progress_callback is not None:
+            set_progress_callback(i / size)
+
+    labels, topic_sizes = _grow_topics(matrix, threshold, on_term)
+    return _rank_topics(matrix, labels, topic_sizes)
+
+
+def _bucket_pairs(buckets, max_size=None):
+    """
+    :param buckets: The bucket index of every term, or -1 for terms in no bucket
+    :param max_size: The size above which buckets are left out, or None to keep every bucket
+    :return: The pairs of terms sharing a bucket, each encoded as `first * len(buckets) + second`, with first < second
+    """
+    members = np.flatnonzero(buckets >= 0)
+    members = members[np.argsort(buckets[members], kind='stable')]
+    sizes = np.bincount(buckets[members]) if len(members) > 0 else np.zeros(0, dtype=np.int64)
+    if max_size is not None:
+        kept = np.repeat(sizes <= max_size, sizes)
+        members = members[kept]
+        sizes = sizes[sizes <= max_size]
+    starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    # Each member is paired with the members sorted before it in its bucket
+    before = np.arange(len(members)) - starts
+    offsets = np.arange(before.sum()) - np.repeat(np.cumsum(before) - before, before)
+    return members[np.repeat(starts, before) + offsets] * len(buckets) + np.repeat(members, before)
+
+
+def lsh_recall(jaccard, bands=LSH_BANDS, rows=LSH_ROWS):
+    """
+    :param jaccard: The Jaccard similarity of the sets of documents of two terms
+    :param bands: The number of bands
+    :param rows: The number of MinHash values per band
+    :return: The probability that lsh_candidate_pairs finds the pair
+    """
+    return 1 - (1 - jaccard ** rows) ** bands
+
+
+def lsh_candidate_pairs(matrix, bands=LSH_BANDS, rows=LSH_ROWS, seed=LSH_SEED, max_bucket=LSH_MAX_BUCKET):
+    """
+    Finds pairs of terms likely to share documents. In each band, terms are hashed by `rows` MinHash values, and two
+    terms fall in the same bucket with a probability of J^rows, where J is the Jaccard similarity of their sets of
+    documents. Terms without documents are all paired, since they never match each other.
+    Since the bands of a smaller count are the first bands of a larger one, more bands only add pairs.
+    :param matrix: The TermDocumentMatrix of the corpus
+    :param bands: The number of bands
+    :param rows: The number of MinHash values per band
+    :param seed: The random seed of the MinHash permutations
+    :param max_bucket: The size above which the buckets of a band are left out, or None to keep every bucket
+    :return: The sorted array of the distinct pairs, each encoded as `first * len(matrix) + second`, with first < second
+    """
+    size = len(matrix)
+    has_scores = matrix.has_scores()
+    pairs = [_bucket_pairs(np.where(has_scores, -1, 0))]
+    hashes = matrix.minhashes(bands * rows, seed)
+    for b in range(bands):
+        # The values of the band are mixed into one key. Keys colliding only add pairs, which are then checked
+        keys = np.zeros(size, dtype=np.uint64)
+        for r in range(b * rows, (b + 1) * rows):
+            keys = keys * np.uint64(0x9E3779B97F4A7C15) + hashes[:, r].astype(np.uint64)
+        buckets = np.unique(keys, return_inverse=True)[1].reshape(-1)
+        pairs.append(_bucket_pairs(np.where(has_scores, buckets, -1), max_bucket))
+
+    # A pair found by several bands is only checked once
+    pairs = np.sort(np.concatenate(pairs))
+    return pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) > 0 else pairs
+
+
+def generate_topics_approximate(matrix, threshold=SIMILARITY_THRESHOLD, bands=LSH_BANDS, rows=LSH_ROWS, seed=LSH_SEED,
+                                set_progress_callback=None, poll_cancel=None):
+    """
+    Generates a list of topics like generate_topics, but only computes the similarity scores of the pairs of terms
+    found by lsh_candidate_pairs. Pairs of terms sharing no document have a similarity score of 0, so the other pairs
+    are assumed to match. The result is the exact one when every pair of terms sharing a document is found, and the
+    pairs that are missed may put terms that do not match in the same topic.
+    :param matrix: The TermDocumentMatrix of the corpus
+    :param threshold: The similarity score threshold
+    :param bands: The number of LSH bands, which trades speed for accuracy
+    :param rows: The number of MinHash values per band
+    :param seed: The random seed of the MinHash permutations
+    :param set_progress_callback: A function called with the fraction of terms processed so far
+    :param poll_cancel: A function returning True when the computation should stop
+    :return: The list of topics (a list of list of terms), sorted in descending order of significance
+    """
+    size = len(matrix)
+    has_scores = matrix.has_scores()
+    pairs = lsh_candidate_pairs(matrix, bands, rows, seed)
+    first, second = pairs // max(size, 1), pairs % max(size, 1)
+    # A pair of terms without any score has a NULL similarity score, which never matches
+    conflicts = ~((matrix.pair_similarity_scores(first, second) < threshold) & (has_scores[first] | has_scores[second]))
+    first, second = first[conflicts], second[conflicts]
+    earlier = first[np.argsort(second, kind='stable')]
+    earlier_ptr = np.concatenate(([0], np.cumsum(np.bincount(second, minlength=size)))).astype(np.int64)
+
+    labels = np.zeros(size, dtype=np.int64)
+    topic_sizes = []
+    for i in range(size):
+        if poll_cancel is not None and poll_cancel() is True:
+            raise Exception('cancelled')
+
+        # The first topic without a term conflicting with this one
+        taken = set(labels[earlier[earlier_ptr[i]:earlier_ptr[i + 1]]].tolist())
+        k = 0
+        while k in taken:
+            k += 1
+        if k == len(topic_sizes):
+            topic_sizes.append(0)
+        labels[i] = k
+        topic_sizes[k] += 1
+
+        if set_progress_callback is not None:
+            set_progress_callback(i / size)
+
+    return _rank_topics(matrix, labels, topic_sizes)
+
+
+def topic_agreement(expected, actual):
+    """
+    Compares two lists of topics of the same terms by the pairs of terms they put in the same topic
+    :param expected: The reference topics, e.g. those of generate_topics
+    :param actual: The topics compared to them, e.g. those of generate_topics_approximate
+    :return: A dict with the fraction of the pairs of `expected` also paired by `actual` (recall), and the fraction of
+      the pairs of `actual` also paired by `expected` (precision). Both are 1 when there are no pairs
+    """
+    expected_topic = {t: k for k, topic in enumerate(expected) for t in topic}
+    pairs = np.array([(expected_topic[t], k) for k, topic in enumerate(actual) for t in topic if t in expected_topic],
+                     dtype=np.int64).reshape(-1, 2)
+
+    def pair_count(sizes):
+        sizes = np.asarray(sizes, dtype=np.float64)
+        return float(np.sum(sizes * (sizes - 1) / 2))
+
+    shared = pair_count(np.unique(pairs, axis=0, return_counts=True)[1]) if len(pairs) > 0 else 0.0
+    expected_pairs = pair_count(np.bincount(pairs[:, 0])) if len(pairs) > 0 else 0.0
+    actual_pairs = pair_count(np.bincount(pairs[:, 1])) if len(pairs) > 0 else 0.0
+    return {
+        'recall': shared / expected_pairs if expected_pairs > 0 else 1.0,
+        'precision': shared / actual_pairs if actual_pairs > 0 else 1.0,
+    }
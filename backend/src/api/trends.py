@@ -0,0 +1,214 @@
+"""
+Term trends, read from the `term_trend` rollup table.
+
+`term_trend` holds the total frequency of each term on each day at each level, where the day of an occurrence is the
+date of its document. It is maintained as documents come and go, so a trend query reads one row per day the term occurs
+on instead of one row per occurrence. Months and years are rolled up from the days at query time.
+"""
+
+from collections import Counter
+from datetime import datetime
+
+from api.sql import MYSQL, SQLITE, dialect, increment_on_conflict, insert_rows
+from api.terms import get_term_dictionary
+from api.tfidf import LEVELS
+
+BIN_DAY = 'day'
+BIN_MONTH = 'month'
+BIN_YEAR = 'year'
+
+"""
+The MySQL DATE_FORMAT format of each bin type. Bins are keyed by the formatted date
+"""
+BIN_FORMATS = {
+    BIN_DAY: '%Y-%m-%d',
+    BIN_MONTH: '%Y-%m',
+    BIN_YEAR: '%Y',
+}
+
+"""
+Joins the term table of a level to the document its units belong to
+"""
+_LEVEL_OCCURRENCES = '''
+{term_table} JOIN {unit_table} USING ({unit_key}) {document_join} {timestamp_join}
+'''
+_CLEAR_TREND_SQL = 'DELETE FROM term_trend WHERE level = %s'
+_REBUILD_TREND_SQL = '''
+INSERT INTO term_trend (level, term_id, day, frequency)
+SELECT %s, term_id, timestamp, SUM(frequency) FROM {occurrences}
+WHERE timestamp IS NOT NULL GROUP BY term_id, timestamp
+'''
+
+"""
+Removes the occurrences of one document from the rollup of a level. This must run before the document is deleted.
+Rows dropping to zero are kept, and left out of trends, until the next rebuild.
+"""
+_REMOVE_DOCUMENT_TREND_SQL = {
+    MYSQL: '''
+UPDATE term_trend
+JOIN (
+    SELECT term_id, timestamp AS day, SUM(frequency) AS frequency FROM {occurrences}
+    WHERE document_id = %s GROUP BY term_id, timestamp
+) AS document_trend USING (term_id, day)
+SET term_trend.frequency = term_trend.frequency - document_trend.frequency
+WHERE term_trend.level = %s
+''',
+    SQLITE: '''
+UPDATE term_trend SET frequency = term_trend.frequency - document_trend.frequency
+FROM (
+    SELECT term_id, timestamp AS day, SUM(frequency) AS frequency FROM {occurrences}
+    WHERE document_id = %s GROUP BY term_id, timestamp
+) AS document_trend
+WHERE term_trend.term_id = document_trend.term_id AND term_trend.day = document_trend.day
+    AND term_trend.level = %s
+''',
+}
+
+"""
+Formats `day` with the format of a bin type, passed as the first parameter
+"""
+_BIN_SQL = {
+    MYSQL: 'DATE_FORMAT(day, %s)',
+    SQLITE: 'strftime(%s, day)',
+}
+
+_TRENDS_SQL = '''
+SELECT term_id, {bin} AS bin, SUM(frequency) FROM term_trend
+WHERE level = %s AND term_id IN ({terms}) {date_range}
+GROUP BY term_id, bin HAVING SUM(frequency) > 0 ORDER BY term_id, bin
+'''
+
+
+def _format(sql, level, cursor=None):
+    if isinstance(sql, dict):
+        sql = sql[dialect(cursor)]
+    occurrences = _LEVEL_OCCURRENCES.format(
+        term_table=level.term_table,
+        unit_table=level.unit_table,
+        unit_key=level.unit_key,
+        document_join=level.document_join,
+        timestamp_join='' if level.unit_table == 'document' else 'JOIN document USING (document_id)',
+    )
+    return sql.format(occurrences=occurrences)
+
+
+def as_date(timestamp):
+    """
+    :param timestamp: A date or a datetime
+    :return: The date, as stored in DATE columns
+    """
+    return timestamp.date() if isinstance(timestamp, datetime) else timestamp
+
+
+def rebuild_trends(cursor, levels=LEVELS):
+    """
+    Recomputes the trend rollups from scratch
+    :param cursor: The database cursor
+    :param levels: The levels to rebuild
+    """
+    for level in levels:
+        cursor.execute(_CLEAR_TREND_SQL, (level.name,))
+        cursor.execute(_format(_REBUILD_TREND_SQL, level), (level.name,))
+
+
+def add_document_trends(cursor, dated_unit_term_counts):
+    """
+    Adds the occurrences of newly inserted documents to the trend rollups
+    :param cursor: The database cursor
+    :param dated_unit_term_counts: A dict mapping each Level to a list of (date, term counts) pairs, the dicts mapping
+      term ids to frequencies of the units at that level, along with the date of their document
+    """
+    totals = Counter()
+    for level, units in dated_unit_term_counts.items():
+        for timestamp, counts in units:
+            day = as_date(timestamp)
+            for t, f in counts.items():
+                totals[level.name, t, day] += f
+
+    insert_rows(cursor, 'INSERT INTO term_trend (level, term_id, day, frequency) VALUES', '(%s, %s, %s, %s)',
+                sorted((level, t, day, f) for (level, t, day), f in totals.items() if f > 0),
+                suffix=increment_on_conflict(cursor, ('level', 'term_id', 'day'), ('frequency',)))
+
+
+def update_document_trends(cursor, timestamp, removed_unit_term_counts, added_unit_term_counts):
+    """
+    Replaces the occurrences of some units of a document in the trend rollups by the ones of other units, for documents
+    updated in place. Rows dropping to zero are kept, as when documents are removed
+    :param cursor: The database cursor
+    :param timestamp: The date of the document
+    :param removed_unit_term_counts: A dict mapping Levels to the lists of the former term counts of the units removed
+      or changed at that level, as dicts mapping term ids to frequencies
+    :param added_unit_term_counts: The same for the new term counts of the units added or changed
+    """
+    totals = Counter()
+    for sign, unit_term_counts in ((-1, removed_unit_term_counts), (1, added_unit_term_counts)):
+        for level, units in unit_term_counts.items():
+            for counts in units:
+                for t, f in counts.items():
+                    totals[level.name, t] += sign * f
+
+    day = as_date(timestamp)
+    insert_rows(cursor, 'INSERT INTO term_trend (level, term_id, day, frequency) VALUES', '(%s, %s, %s, %s)',
+                sorted((level, t, day, f) for (level, t), f in totals.items() if f != 0),
+                suffix=increment_on_conflict(cursor, ('level', 'term_id', 'day'), ('frequency',)))
+
+
+def remove_document_trends(cursor, doc_uuid, levels=LEVELS):
+    """
+    Removes the occurrences of a document from the trend rollups.
+    This must be called before the document is deleted.
+    :param cursor: The database cursor
+    :param doc_uuid: The UUID of the document
+    :param levels: The levels to update
+    """
+    for level in levels:
+        cursor.execute(_format(_REMOVE_DOCUMENT_TREND_SQL, level, cursor), (str(doc_uuid), level.name))
+
+
+def get_trends(cursor, level, term_texts, bin_type=BIN_DAY, start=None, end=None):
+    """
+    Reads the trends of several terms at one level with a single grouped query
+    :param cursor: The database cursor
+    :param level: The Level at which occurrences are counted
+    :param term_texts: The stemmed terms
+    :param bin_type: One of BIN_DAY, BIN_MONTH or BIN_YEAR
+    :param start: The first date included, or None
+    :param end: The last date included, or None
+    :return: A dict mapping each term to a dict mapping each formatted date to the frequency of the term in that bin,
+      for bins where it occurs. Every term of `term_texts` is a key
+    """
+    trends = {t: {} for t in term_texts}
+    ids = get_term_dictionary(cursor).get_ids(cursor, trends)
+    if len(ids) == 0:
+        return trends
+    terms_by_id = {}
+    for t, term_id in ids.items():
+        terms_by_id.setdefault(term_id, []).append(t)
+
+    date_range = ''
+    args = [BIN_FORMATS[bin_type], level.name]
+    args.extend(terms_by_id)
+    if start is not None:
+        date_range += ' AND day >= %s'
+        args.append(as_date(start))
+    if end is not None:
+        date_range += ' AND day <= %s'
+        args.append(as_date(end))
+
+    cursor.execute(_TRENDS_SQL.format(bin=_BIN_SQL[dialect(cursor)], terms=','.join(['%s'] * len(terms_by_id)),
+                                      date_range=date_range), tuple(args))
+    for term_id, b, f in cursor.fetchall():
+        for t in terms_by_id[term_id]:
+            trends[t][b] = int(f)
+    return trends
+
+
+def get_trend(cursor, level, term_text, bin_type=BIN_DAY):
+    """
+    :param cursor: The database cursor
+    :param level: The Level at which occurrences are counted
+    :param term_text: The stemmed term
+    :param bin_type: One of BIN_DAY, BIN_MONTH or BIN_YEAR
+    :return: A dict mapping each formatted date to the frequency of the term in that bin, for bins where it occurs
+    """
+    return get_trends(cursor, level, [term_text], bin_type)[term_text]
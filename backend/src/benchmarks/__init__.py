@@ -0,0 +1,4 @@
+"""
+Benchmarks for the corpalizer backend.
+Run them from `backend/src`, e.g. `python -m benchmarks.tfidf`
+"""
@@ -0,0 +1,82 @@
+"""
+Compares two result files of benchmarks.suite, and lists the measurements that regressed by more than a threshold.
+
+Measurements in seconds regress when they grow, throughputs (per second) regress when they shrink. Runs are matched by
+corpus size. Exits with status 1 if any measurement regressed, so it can gate a CI job.
+
+Usage: python -m benchmarks.compare baseline.json candidate.json [--threshold 0.1]
+"""
+
+import argparse
+import json
+import sys
+
+
+def flatten(value, prefix=''):
+    """
+    :return: A dict of the numeric leaves of nested dicts, keyed by their dotted path
+    """
+    if isinstance(value, dict):
+        result = {}
+        for k, v in value.items():
+            result.update(flatten(v, '{}.{}'.format(prefix, k) if prefix else k))
+        return result
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def compare(baseline, candidate, threshold):
+    """
+    :param baseline: The results of the reference version
+    :param candidate: The results of the version compared
+    :param threshold: The relative change above which a measurement regressed, e.g. 0.1 for 10%
+    :return: A list of (name, baseline value, candidate value, relative change, regressed) tuples
+    """
+    baseline_runs = {run['documents']: run for run in baseline['runs']}
+    rows = []
+    for run in candidate['runs']:
+        if run['documents'] not in baseline_runs:
+            continue
+        before = flatten(baseline_runs[run['documents']]['stages'])
+        after = flatten(run['stages'])
+        for name in sorted(before.keys() & after.keys()):
+            if name.endswith('seconds'):
+                higher_is_better = False
+            elif name.endswith('per_second'):
+                higher_is_better = True
+            else:
+                continue
+            if before[name] == 0:
+                continue
+            change = (after[name] - before[name]) / before[name]
+            regressed = -change > threshold if higher_is_better else change > threshold
+            rows.append(('{}.{}'.format(run['documents'], name), before[name], after[name], change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as a regression')
+    parser.add_argument('--all', action='store_true', help='list every measurement, not only regressions')
+    args = parser.parse_args()
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.candidate, 'r') as f:
+        candidate = json.load(f)
+
+    rows = compare(baseline, candidate, args.threshold)
+    for name, before, after, change, regressed in rows:
+        if regressed or args.all:
+            print('{:<60} {:>12.6g} {:>12.6g} {:>+8.1%}{}'.format(name, before, after, change,
+                                                               '  REGRESSED' if regressed else ''))
+    regressions = sum(1 for row in rows if row[4])
+    print('{} of {} measurements regressed by more than {:.0%}'.format(regressions, len(rows), args.threshold))
+    sys.exit(1 if regressions > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Generates synthetic corpora for the benchmarks.
+
+Documents are made of paragraphs of sentences of made-up words drawn from a Zipf distribution, and dated uniformly over a
+range of days. The same seed always generates the same corpus. Run as a script, the corpus is written as JSONL, the
+format read by `import_corpus.py`.
+
+Usage: python -m benchmarks.corpus --documents 10000 [--vocabulary 20000 --zipf 1.1 --days 730] --output corpus.jsonl
+"""
+
+import argparse
+import json
+import random
+from datetime import date, timedelta
+from itertools import accumulate
+
+from api.importer import Source
+
+_ONSETS = ['b', 'c', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'r', 's', 't', 'v', 'w', 'z', 'br', 'cl', 'dr',
+           'fl', 'gr', 'pl', 'st', 'tr']
+_NUCLEI = ['a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'ou']
+_CODAS = ['', '', 'n', 'r', 's', 't', 'l', 'm', 'nd', 'rk']
+
+
+def make_vocabulary(size, rng):
+    """
+    :param size: The number of distinct words
+    :param rng: A random.Random
+    :return: A list of distinct made-up words, most frequent first
+    """
+    words = []
+    seen = set()
+    while len(words) < size:
+        word = ''.join(rng.choice(_ONSETS) + rng.choice(_NUCLEI) + rng.choice(_CODAS)
+                       for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+class CorpusGenerator:
+    """
+    The parameters of a synthetic corpus
+    """
+
+    def __init__(self, seed=0, vocabulary=20000, zipf=1.1, paragraphs=(2, 6), sentences=(2, 6), words=(6, 18),
+                 start=date(2020, 1, 1), days=730):
+        """
+        :param seed: The random seed
+        :param vocabulary: The number of distinct words
+        :param zipf: The exponent of the Zipf distribution of words. Higher values concentrate the corpus on fewer words
+        :param paragraphs: The (min, max) number of paragraphs per document
+        :param sentences: The (min, max) number of sentences per paragraph
+        :param words: The (min, max) number of words per sentence
+        :param start: The date of the oldest documents
+        :param days: The number of days documents are spread over
+        """
+        self.seed = seed
+        self.paragraphs = paragraphs
+        self.sentences = sentences
+        self.words = words
+        self.start = start
+        self.days = days
+        self.vocabulary = make_vocabulary(vocabulary, random.Random(seed))
+        self._cum_weights = list(accumulate(1 / (rank + 1) ** zipf for rank in range(vocabulary)))
+
+    def document(self, rng):
+        """
+        :return: The text of a random document
+        """
+        paragraphs = []
+        for _ in range(rng.randint(*self.paragraphs)):
+            sentences = []
+            for _ in range(rng.randint(*self.sentences)):
+                words = rng.choices(self.vocabulary, cum_weights=self._cum_weights, k=rng.randint(*self.words))
+                sentences.append(' '.join(words).capitalize() + '.')
+            paragraphs.append(' '.join(sentences))
+        return '\n'.join(paragraphs)
+
+    def sources(self, count, offset=0):
+        """
+        Generates documents. Document i is the same whatever the count, so smaller corpora are prefixes of larger ones
+        :param count: The number of documents
+        :param offset: The index of the first document
+        :return: A generator of Sources
+        """
+        for i in range(offset, offset + count):
+            rng = random.Random('{}-{}'.format(self.seed, i))
+            timestamp = self.start + timedelta(days=rng.randrange(self.days))
+            yield Source('synthetic-{}'.format(i), self.document(rng), timestamp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--days', type=int, default=730, help='number of days the documents are spread over')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    generator = CorpusGenerator(seed=args.seed, vocabulary=args.vocabulary, zipf=args.zipf, days=args.days)
+    with open(args.output, 'w') as f:
+        for source in generator.sources(args.documents):
+            f.write(json.dumps({'id': source.key, 'content': source.text,
+                                'date': source.timestamp.strftime('%Y-%m-%d')}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
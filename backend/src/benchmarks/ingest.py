@@ -0,0 +1,165 @@
+"""
+Times document ingestion stage by stage, and compares it with the per-unit round-trip path it replaced.
+
+Every file of a directory is ingested into the configured database inside a transaction that is rolled back at the end,
+once with `insert_document` and once with the former implementation, which read back the id of every paragraph and
+sentence and inserted terms once per unit. One JSON object is printed per path, with the number of SQL statements
+executed and the time spent in each stage.
+
+Usage: python -m benchmarks.ingest [--directory ../../test-notes] [--repeat 3]
+"""
+
+import argparse
+import json
+import os
+import time
+import uuid
+from collections import Counter
+from itertools import chain
+
+import pymysql
+
+from api.services import (
+    break_document_into_paragraphs,
+    break_paragraph_into_sentences,
+    insert_document,
+    process_raw_document_into_terms,
+)
+from api.terms import encode_term_counts
+from api.tfidf import DOCUMENT_LEVEL, PARAGRAPH_LEVEL, SENTENCE_LEVEL, add_document_statistics
+from config import PYMYSQL_CONNECT_ARGS
+
+
+class CountingCursor:
+    """
+    Wraps a cursor and counts the statements it executes
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = 0
+
+    def execute(self, query, args=None):
+        self.statements += 1
+        return self.cursor.execute(query, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def legacy_term_ids(cursor, terms):
+    cursor.execute('SELECT term_text, term_id FROM term WHERE term_text IN (' + ','.join(['%s'] * len(terms)) + ')',
+                   tuple(terms))
+    return dict(cursor.fetchall())
+
+
+def legacy_insert_document(doc_uuid, text, cursor, timings):
+    """
+    The ingestion path before batched writes, kept as a baseline. The ids of the terms of each unit are read back after
+    inserting them
+    """
+    start = time.perf_counter()
+    terms = process_raw_document_into_terms(text)
+    document_cnt = Counter(terms)
+    cursor.execute('INSERT INTO document (document_id, timestamp, term_count) VALUES (%s, CURDATE(), %s)',
+                   (doc_uuid, len(terms)))
+    if len(terms) > 0:
+        cursor.execute('INSERT IGNORE INTO term (term_text) VALUES ' + ','.join(['(%s)'] * len(terms)), tuple(terms))
+        ids = legacy_term_ids(cursor, document_cnt)
+        cursor.execute('INSERT INTO document_term (frequency, document_id, term_id) VALUES ' + ','.join(
+            ['(%s, %s, %s)'] * len(document_cnt)),
+                       tuple(chain.from_iterable((f, doc_uuid, ids[t]) for t, f in document_cnt.items())))
+
+    paragraphs = break_document_into_paragraphs(text)
+    paragraph_cnts = [Counter(process_raw_document_into_terms(p[2])) for p in paragraphs]
+    cursor.execute('INSERT INTO paragraph (document_id, position_in_fulltext, term_count) VALUES ' + ','.join(
+        ['(%s, %s, %s)'] * len(paragraphs)),
+                   tuple(chain.from_iterable((doc_uuid, p[0], sum(c.values()))
+                                             for p, c in zip(paragraphs, paragraph_cnts))))
+
+    sentence_cnts = []
+    for (start_offset, end_offset, paragraph_text), cnt in zip(paragraphs, paragraph_cnts):
+        cursor.execute('SELECT paragraph_id FROM paragraph WHERE document_id = %s AND position_in_fullText = %s',
+                       (doc_uuid, start_offset))
+        paragraph_id, = cursor.fetchone()
+        if len(cnt) > 0:
+            cursor.execute('INSERT IGNORE INTO term (term_text) VALUES ' + ','.join(['(%s)'] * len(cnt)), tuple(cnt))
+            ids = legacy_term_ids(cursor, cnt)
+            cursor.execute('INSERT INTO paragraph_term (frequency, paragraph_id, term_id) VALUES ' + ','.join(
+                ['(%s, %s, %s)'] * len(cnt)),
+                           tuple(chain.from_iterable((f, paragraph_id, ids[t]) for t, f in cnt.items())))
+
+        sentences = break_paragraph_into_sentences(paragraph_text)
+        cnts = [Counter(process_raw_document_into_terms(s[2])) for s in sentences]
+        sentence_cnts.extend(cnts)
+        if len(sentences) > 0:
+            cursor.execute('INSERT INTO sentence (paragraph_id, position_in_paragraph, term_count) VALUES ' + ','.join(
+                ['(%s, %s, %s)'] * len(sentences)),
+                           tuple(chain.from_iterable((paragraph_id, s[0], sum(c.values()))
+                                                     for s, c in zip(sentences, cnts))))
+        for (sentence_start, _, _), sentence_cnt in zip(sentences, cnts):
+            cursor.execute('SELECT sentence_id FROM sentence WHERE paragraph_id = %s AND position_in_paragraph = %s',
+                           (paragraph_id, sentence_start))
+            sentence_id, = cursor.fetchone()
+            if len(sentence_cnt) > 0:
+                cursor.execute('INSERT IGNORE INTO term (term_text) VALUES ' + ','.join(['(%s)'] * len(sentence_cnt)),
+                               tuple(sentence_cnt))
+                ids = legacy_term_ids(cursor, sentence_cnt)
+                cursor.execute('INSERT INTO sentence_term (frequency, sentence_id, term_id) VALUES ' + ','.join(
+                    ['(%s, %s, %s)'] * len(sentence_cnt)),
+                               tuple(chain.from_iterable((f, sentence_id, ids[t]) for t, f in sentence_cnt.items())))
+
+    ids = legacy_term_ids(cursor, set(document_cnt).union(*paragraph_cnts, *sentence_cnts)) if len(terms) > 0 else {}
+    add_document_statistics(cursor, {
+        DOCUMENT_LEVEL: [encode_term_counts(document_cnt, ids)],
+        PARAGRAPH_LEVEL: [encode_term_counts(c, ids) for c in paragraph_cnts],
+        SENTENCE_LEVEL: [encode_term_counts(c, ids) for c in sentence_cnts],
+    })
+    timings['total'] = timings.get('total', 0) + time.perf_counter() - start
+
+
+def run(conn, insert_fn, texts, repeat):
+    cur = CountingCursor(conn.cursor())
+    timings = {}
+    start = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            for text in texts:
+                insert_fn(str(uuid.uuid4()), text, cur, timings)
+        seconds = time.perf_counter() - start
+    finally:
+        cur.close()
+        conn.rollback()
+
+    return {
+        'documents': len(texts) * repeat,
+        'statements': cur.statements,
+        'seconds': seconds,
+        'documents_per_second': len(texts) * repeat / seconds,
+        'stages': timings,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--directory', default=os.path.join('..', '..', 'test-notes'))
+    parser.add_argument('--repeat', type=int, default=1, help='number of times each file is ingested')
+    args = parser.parse_args()
+
+    texts = []
+    for name in sorted(os.listdir(args.directory)):
+        with open(os.path.join(args.directory, name), 'r') as f:
+            texts.append(f.read())
+
+    conn = pymysql.connect(**PYMYSQL_CONNECT_ARGS)
+    try:
+        for path, insert_fn in (('bulk', insert_document), ('legacy', legacy_insert_document)):
+            result = run(conn, insert_fn, texts, args.repeat)
+            result['path'] = path
+            print(json.dumps(result), flush=True)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
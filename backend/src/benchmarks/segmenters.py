@@ -0,0 +1,114 @@
+"""
+Compares the sentence segmenters with pysbd, and measures the throughput of each one.
+
+The paragraphs of a directory of text files or of a JSONL file (as read by import_corpus.py), or of a synthetic corpus
+(see benchmarks.corpus) when no path is given, are segmented by every segmenter, --batch-size paragraphs at a time as
+analysis does, and the following are printed as JSON for each one:
+  * characters_per_second and paragraphs_per_second: the throughput, from the fastest of --repeat runs
+  * agreement with pysbd: the precision and recall of the sentence boundaries found within paragraphs, taking those of
+    pysbd as the truth, and the fraction of paragraphs split exactly like pysbd does
+Segmenters that cannot be built, such as spaCy when it is not installed, are reported with their error.
+
+Usage: python -m benchmarks.segmenters [../test-notes] [--documents 1000] [--segmenters pysbd rules spacy] [--repeat 3]
+"""
+
+import argparse
+import json
+import time
+
+from api.analysis import break_document_into_paragraphs
+from api.importer import iter_sources
+from api.segmenters import PYSBD, SEGMENTERS, check_segmenter, create_segmenter
+from benchmarks.corpus import CorpusGenerator
+
+
+def read_paragraphs(path, documents, seed):
+    """
+    :param path: A directory or JSONL file, or None for a synthetic corpus
+    :param documents: The maximum number of documents read
+    :return: The list of the texts of the paragraphs of the documents
+    """
+    sources = iter_sources(path) if path is not None else CorpusGenerator(seed=seed).sources(documents)
+    paragraphs = []
+    for i, source in enumerate(sources):
+        if i == documents:
+            break
+        if source.error is None:
+            paragraphs.extend(text for _, _, text in break_document_into_paragraphs(source.text))
+    return paragraphs
+
+
+def segment_all(segmenter, paragraphs, batch_size):
+    """
+    :return: The sentences of every paragraph, see Segmenter.segment_many
+    """
+    result = []
+    for i in range(0, len(paragraphs), batch_size):
+        result.extend(segmenter.segment_many(paragraphs[i:i + batch_size]))
+    return result
+
+
+def boundaries(segmented):
+    """
+    :param segmented: The sentences of every paragraph
+    :return: The set of (paragraph index, offset) pairs at which a sentence other than the first of its paragraph starts
+    """
+    return {(i, start) for i, sentences in enumerate(segmented) for start, _, _ in sentences[1:]}
+
+
+def agreement(expected, actual):
+    """
+    :param expected: The sentences of every paragraph according to pysbd
+    :param actual: The sentences of every paragraph according to another segmenter
+    :return: A dict of the precision and recall of the boundaries, and of the fraction of identical paragraphs
+    """
+    expected_boundaries, actual_boundaries = boundaries(expected), boundaries(actual)
+    shared = len(expected_boundaries & actual_boundaries)
+    return {
+        'boundary_precision': shared / len(actual_boundaries) if len(actual_boundaries) > 0 else 1.0,
+        'boundary_recall': shared / len(expected_boundaries) if len(expected_boundaries) > 0 else 1.0,
+        'paragraphs_identical': sum(1 for e, a in zip(expected, actual) if [s[:2] for s in e] == [s[:2] for s in a])
+        / max(len(expected), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='a directory of text files or a JSONL file, default: synthetic')
+    parser.add_argument('--documents', type=int, default=1000, help='maximum number of documents read')
+    parser.add_argument('--segmenters', type=check_segmenter, nargs='+', default=list(SEGMENTERS))
+    parser.add_argument('--batch-size', type=int, default=256, help='paragraphs segmented at once')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paragraphs = read_paragraphs(args.path, args.documents, args.seed)
+    characters = sum(len(p) for p in paragraphs)
+    result = {'paragraphs': len(paragraphs), 'characters': characters, 'segmenters': {}}
+    reference = segment_all(create_segmenter(PYSBD), paragraphs, args.batch_size)
+
+    for name in dict.fromkeys(args.segmenters):
+        try:
+            segmenter = create_segmenter(name)
+            # Also loads the models and modules of the segmenter before it is timed
+            segmented = segment_all(segmenter, paragraphs, args.batch_size)
+        except (ImportError, OSError) as e:
+            result['segmenters'][name] = {'error': str(e)}
+            continue
+        seconds = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            segment_all(segmenter, paragraphs, args.batch_size)
+            seconds.append(time.perf_counter() - start)
+        best = min(seconds)
+        result['segmenters'][name] = dict({
+            'sentences': sum(len(s) for s in segmented),
+            'seconds': best,
+            'characters_per_second': characters / best if best > 0 else None,
+            'paragraphs_per_second': len(paragraphs) / best if best > 0 else None,
+        }, **agreement(reference, segmented))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
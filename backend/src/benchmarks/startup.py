@@ -0,0 +1,67 @@
+"""
+Times the cold start of the API against its budget.
+
+Each run starts a fresh Python process, which imports the app and creates it (the cold start), then warms the text
+analyzer up, which loads NLTK, pysbd and the stopwords. The budget applies to the cold start: a process must be ready
+to serve requests within STARTUP_BUDGET_SECONDS, without any network access. The analyzer is loaded by the first request
+analyzing text, or before the workers are forked when serving with main.py --workers (see api/server.py), so its time
+is reported separately. Databases are only connected to by requests, so the configured database does not need to be up.
+One JSON object is printed with the median and maximum of each phase, and the exit status is 1 if the median cold
+start is over budget.
+
+Usage: python -m benchmarks.startup [--runs 5] [--budget 1.0]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+STARTUP_BUDGET_SECONDS = 1.0
+
+_PROBE = '''
+import json, time
+start = time.perf_counter()
+import api
+imported = time.perf_counter()
+api.create_app()
+created = time.perf_counter()
+from api.analysis import warm_up
+warm_up()
+warmed = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported, 'cold_start': created - start,
+                  'warm_up': warmed - created}))
+'''
+
+
+def probe():
+    """
+    :return: The seconds spent in each phase by a fresh process, along with its whole lifetime as `process`
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', _PROBE], check=True, stdout=subprocess.PIPE).stdout
+    seconds = time.perf_counter() - start
+    phases = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    phases['process'] = seconds
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='number of processes started')
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET_SECONDS, help='cold start budget in seconds')
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.runs)]
+    result = {phase: {'median_seconds': statistics.median(run[phase] for run in runs),
+                      'max_seconds': max(run[phase] for run in runs)} for phase in runs[0]}
+    result['budget_seconds'] = args.budget
+    result['within_budget'] = result['cold_start']['median_seconds'] <= args.budget
+    print(json.dumps(result))
+    sys.exit(0 if result['within_budget'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+Times the hot paths of the backend on synthetic corpora of increasing size, and records the results as JSON.
+
+For every corpus size, a fresh database is loaded with a synthetic corpus (see benchmarks.corpus), and the following
+are timed:
+  * ingest: analysis and batched writes, with the incremental statistics, committed per batch
+  * rescore_full: the full rebuild of the tfidf statistics and trend rollups
+  * rescore_incremental: inserting, editing one word of, then deleting, single documents with their statistics
+  * topics: loading the term x document matrix and generating topics, exactly and in the approximate mode, whose
+    agreement with the exact topics is recorded
+  * trends: single-term trend queries at every granularity and bin type, and batch queries
+  * search: building the in-memory search index, and BM25 queries of 1 to 3 terms at every level
+  * phrase: phrase queries of 2 or 3 consecutive words of random documents, with their keyword-in-context snippets
+  * fetch: reading random documents, and single paragraphs, back from the document store, and listing documents
+  * snapshot: writing a corpus snapshot, refreshing it after a few writes, and loading it back, along with the topics
+    matrix and the search index built from it
+By default the database is a SQLite file in a temporary directory, so the suite runs without a server. With
+--mysql-scratch, the MySQL database of config.py is used instead, and EMPTIED before each size: only point it at a
+scratch database.
+
+Use benchmarks.compare to compare the output files of two versions.
+
+Usage: python -m benchmarks.suite --documents 1000 10000 [--document-store packed] [--mysql-scratch]
+    [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from api.document_store import FILES, PACKED, ZLIB, create_document_store
+from api.services import (
+    analyze_document,
+    cleanup_terms,
+    delete_document,
+    get_unit_span,
+    insert_document,
+    recompute_tfidf_scores,
+    update_document,
+    write_documents,
+)
+from api.phrases import find_phrase
+from api.search import SearchIndex
+from api.snapshot import load_snapshot, refresh_snapshot
+from api.storage import MySQLStorage, SQLiteStorage
+from api.terms import get_term_dictionary
+from api.tfidf import LEVELS
+from api.topics import TermDocumentMatrix, generate_topics, generate_topics_approximate, topic_agreement
+from api.trends import BIN_FORMATS, get_trend, get_trends
+from benchmarks.corpus import CorpusGenerator
+
+
+def summarize(samples):
+    """
+    :param samples: A list of durations in seconds
+    :return: Their count, mean and percentiles
+    """
+    samples = sorted(samples)
+    if len(samples) == 0:
+        return {'count': 0}
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    return {
+        'count': len(samples),
+        'mean_seconds': sum(samples) / len(samples),
+        'p50_seconds': percentile(0.5),
+        'p95_seconds': percentile(0.95),
+        'max_seconds': samples[-1],
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def reset_mysql(cursor):
+    cursor.execute('DELETE FROM document')
+    cursor.execute('DELETE FROM term')
+    get_term_dictionary(cursor).clear()
+    cursor.execute('DELETE FROM imported_source')
+    cursor.execute("UPDATE unit_count SET n = 0")
+
+
+def bench_ingest(conn, generator, documents, document_store, batch_size):
+    timings = {}
+    document_ids = []
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        cur = conn.cursor()
+        write_documents([(doc_uuid, analysis, timestamp) for doc_uuid, _, analysis, timestamp in batch], cur, timings)
+        cur.close()
+        conn.commit()
+        document_store_start = time.perf_counter()
+        document_store.put_many([(doc_uuid, text) for doc_uuid, text, _, _ in batch])
+        timings['document_store'] = timings.get('document_store', 0) + time.perf_counter() - document_store_start
+        del batch[:]
+
+    for source in generator.sources(documents):
+        doc_uuid = str(uuid.uuid4())
+        batch.append((doc_uuid, source.text, analyze_document(source.text, timings), source.timestamp))
+        document_ids.append(doc_uuid)
+        if len(batch) == batch_size:
+            flush()
+    if len(batch) > 0:
+        flush()
+
+    seconds = time.perf_counter() - start
+    return document_ids, {
+        'seconds': seconds,
+        'documents_per_second': documents / seconds,
+        'stages': timings,
+    }
+
+
+def bench_rescore_full(conn):
+    cur = conn.cursor()
+    seconds = timed(recompute_tfidf_scores, cur)
+    cur.close()
+    conn.commit()
+    return {'seconds': seconds}
+
+
+def bench_rescore_incremental(conn, generator, documents, count):
+    inserts, updates, deletes = [], [], []
+    for source in generator.sources(count, offset=documents):
+        doc_uuid = str(uuid.uuid4())
+        cur = conn.cursor()
+        inserts.append(timed(insert_document, doc_uuid, source.text, cur) + timed(conn.commit))
+        # Doubles a letter in the middle of the document, as a typo would
+        middle = len(source.text) // 2
+        text = source.text[:middle + 1] + source.text[middle:]
+        start = time.perf_counter()
+        update_document(doc_uuid, source.text, text, cur)
+        cleanup_terms(cur)
+        conn.commit()
+        updates.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        delete_document(doc_uuid, cur)
+        cleanup_terms(cur)
+        conn.commit()
+        deletes.append(time.perf_counter() - start)
+        cur.close()
+    return {'insert': summarize(inserts), 'update': summarize(updates), 'delete': summarize(deletes)}
+
+
+def bench_topics(conn):
+    cur = conn.cursor()
+    start = time.perf_counter()
+    matrix = TermDocumentMatrix.load(cur)
+    load_seconds = time.perf_counter() - start
+    cur.close()
+    conn.commit()
+
+    start = time.perf_counter()
+    topics = generate_topics(matrix)
+    generate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    approximate = generate_topics_approximate(matrix)
+    return dict({
+        'terms': len(matrix),
+        'topics': len(topics),
+        'load_seconds': load_seconds,
+        'generate_seconds': generate_seconds,
+        'approximate_seconds': time.perf_counter() - start,
+    }, **topic_agreement(topics, approximate))
+
+
+def bench_trends(conn, rng, queries, batch_terms):
+    cur = conn.cursor()
+    cur.execute("SELECT term_text FROM term_df JOIN term USING (term_id) WHERE level = 'document' "
+                "ORDER BY df DESC, term_text")
+    terms = [row[0] for row in cur.fetchall()]
+    # Half the queries are for the most common terms, which are the slowest to aggregate, half for random terms
+    sample = terms[:queries // 2] + rng.sample(terms, min(len(terms), queries - queries // 2))
+
+    result = {}
+    for level in LEVELS:
+        for bin_type in BIN_FORMATS:
+            result['{}_{}'.format(level.name, bin_type)] = summarize(
+                [timed(get_trend, cur, level, t, bin_type) for t in sample])
+        result['{}_batch'.format(level.name)] = summarize(
+            [timed(get_trends, cur, level, rng.sample(terms, min(len(terms), batch_terms)), 'month')
+             for _ in range(max(1, queries // batch_terms))])
+    cur.close()
+    conn.commit()
+    return result
+
+
+def bench_search(conn, rng, queries):
+    cur = conn.cursor()
+    cur.execute("SELECT term_text FROM term_df JOIN term USING (term_id) WHERE level = 'document'")
+    terms = [row[0] for row in cur.fetchall()]
+    start = time.perf_counter()
+    index = SearchIndex.load(cur, 0)
+    load_seconds = time.perf_counter() - start
+    cur.close()
+    conn.commit()
+
+    result = {'load_seconds': load_seconds}
+    for level in LEVELS:
+        result[level.name] = summarize(
+            [timed(index.search, level, rng.sample(terms, min(len(terms), rng.randint(1, 3)))) for _ in range(queries)])
+    return result
+
+
+def bench_phrase(conn, rng, document_ids, document_store, queries):
+    phrases = []
+    for _ in range(queries):
+        words = re.findall(r'\w+', document_store.get(rng.choice(document_ids)))
+        i = rng.randrange(max(len(words) - 3, 1))
+        phrases.append(' '.join(words[i:i + rng.randint(2, 3)]))
+    cur = conn.cursor()
+    result = summarize([timed(find_phrase, cur, document_store, phrase) for phrase in phrases])
+    cur.close()
+    conn.commit()
+    return result
+
+
+def bench_fetch(conn, rng, document_ids, document_store, queries):
+    def fetch_paragraph(doc_uuid):
+        cur = conn.cursor()
+        span = get_unit_span(doc_uuid, cur, 0)
+        cur.close()
+        document_store.get_range(doc_uuid, *span)
+
+    def list_documents():
+        cur = conn.cursor()
+        cur.execute('SELECT document_id, timestamp FROM document LIMIT 1000')
+        cur.fetchall()
+        cur.close()
+
+    return {
+        'document': summarize([timed(document_store.get, rng.choice(document_ids)) for _ in range(queries)]),
+        'paragraph': summarize([timed(fetch_paragraph, rng.choice(document_ids)) for _ in range(queries)]),
+        'list': summarize([timed(list_documents) for _ in range(max(1, queries // 10))]),
+    }
+
+
+def bench_snapshot(conn, generator, documents, count):
+    directory = tempfile.mkdtemp(prefix='corpalizer-snapshot-')
+    try:
+        cur = conn.cursor()
+        full_seconds = timed(refresh_snapshot, cur, directory)
+        conn.commit()
+        for source in generator.sources(count, offset=documents + 1000000):
+            doc_uuid = str(uuid.uuid4())
+            insert_document(doc_uuid, source.text, cur)
+            update_document(doc_uuid, source.text, source.text + '\nOne more paragraph.', cur)
+        conn.commit()
+        incremental_seconds = timed(refresh_snapshot, cur, directory)
+        cur.close()
+        conn.commit()
+
+        start = time.perf_counter()
+        snapshot = load_snapshot(directory)
+        load_seconds = time.perf_counter() - start
+        return {
+            'full_seconds': full_seconds,
+            'incremental_seconds': incremental_seconds,
+            'load_seconds': load_seconds,
+            'topics_matrix_seconds': timed(TermDocumentMatrix.from_snapshot, snapshot),
+            'search_index_seconds': timed(SearchIndex.from_snapshot, snapshot),
+            'bytes': sum(os.path.getsize(os.path.join(snapshot.path, name)) for name in os.listdir(snapshot.path)),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def run(storage, args, documents, document_store):
+    generator = CorpusGenerator(seed=args.seed, vocabulary=args.vocabulary, zipf=args.zipf, days=args.days)
+    rng = random.Random(args.seed)
+    conn = storage.connect()
+    try:
+        if isinstance(storage, MySQLStorage):
+            cur = conn.cursor()
+            reset_mysql(cur)
+            cur.close()
+            conn.commit()
+
+        document_ids, ingest = bench_ingest(conn, generator, documents, document_store, args.batch_size)
+        stages = {'ingest': ingest}
+        stages['rescore_full'] = bench_rescore_full(conn)
+        stages['rescore_incremental'] = bench_rescore_incremental(conn, generator, documents, args.incremental)
+        if not args.skip_topics:
+            stages['topics'] = bench_topics(conn)
+        stages['trends'] = bench_trends(conn, rng, args.queries, args.batch_terms)
+        stages['search'] = bench_search(conn, rng, args.queries)
+        stages['phrase'] = bench_phrase(conn, rng, document_ids, document_store, args.queries)
+        stages['fetch'] = bench_fetch(conn, rng, document_ids, document_store, args.queries)
+        stages['snapshot'] = bench_snapshot(conn, generator, documents, args.incremental)
+
+        rows = {}
+        cur = conn.cursor()
+        for table in ('document', 'paragraph', 'sentence', 'term', 'document_term', 'paragraph_term',
+                      'sentence_term'):
+            cur.execute('SELECT COUNT(*) FROM {}'.format(table))
+            rows[table], = cur.fetchone()
+        cur.close()
+    finally:
+        conn.close()
+
+    return {
+        'documents': documents,
+        'rows': rows,
+        'stages': stages,
+    }
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': 'mysql' if args.mysql_scratch else 'sqlite',
+        'parameters': {k: v for k, v in vars(args).items() if k != 'output'},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the Zipf distribution of words')
+    parser.add_argument('--days', type=int, default=730, help='number of days the documents are spread over')
+    parser.add_argument('--batch-size', type=int, default=200, help='documents written per transaction')
+    parser.add_argument('--incremental', type=int, default=20, help='documents inserted and deleted one at a time')
+    parser.add_argument('--queries', type=int, default=100, help='trend queries and document fetches')
+    parser.add_argument('--batch-terms', type=int, default=30, help='terms per batch trend query')
+    parser.add_argument('--document-store', choices=(FILES, PACKED), default=FILES)
+    parser.add_argument('--compression', choices=(ZLIB,), help='compression of the packed document store')
+    parser.add_argument('--skip-topics', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mysql-scratch', action='store_true',
+                        help='use the MySQL database of config.py, which is emptied, instead of a temporary SQLite '
+                             'file')
+    parser.add_argument('--output', help='file the results are written to, in addition to stdout')
+    args = parser.parse_args()
+
+    results = {'meta': metadata(args), 'runs': []}
+    for documents in args.documents:
+        directory = tempfile.mkdtemp(prefix='corpalizer-bench-')
+        try:
+            document_store = create_document_store(args.document_store, os.path.join(directory, 'documents'),
+                                                   compression=args.compression)
+            if args.mysql_scratch:
+                from config import PYMYSQL_CONNECT_ARGS
+                storage = MySQLStorage(PYMYSQL_CONNECT_ARGS)
+            else:
+                storage = SQLiteStorage(os.path.join(directory, 'bench.db'))
+            result = run(storage, args, documents, document_store)
+            document_store.close()
+        finally:
+            shutil.rmtree(directory)
+        print(json.dumps(result), flush=True)
+        results['runs'].append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Measures how the full rebuild of the TF-IDF statistics scales with the number of term rows.
+
+For every requested corpus size, synthetic documents are inserted into the configured database inside a transaction,
+the statistics of each level are rebuilt and timed, and the transaction is rolled back, so the existing corpus is left
+untouched (its rows are however included in the rebuild). One JSON object is printed per corpus size.
+
+Usage: python -m benchmarks.tfidf --documents 10 100 1000 [--verify]
+"""
+
+import argparse
+import json
+import math
+import random
+import time
+from collections import Counter
+from itertools import chain
+
+import pymysql
+
+from api.tfidf import LEVELS, rebuild_level_statistics
+from config import PYMYSQL_CONNECT_ARGS
+
+
+def zipf_weights(vocabulary_size):
+    return [1 / (rank + 1) for rank in range(vocabulary_size)]
+
+
+def insert_synthetic_corpus(cursor, rng, documents, paragraphs_per_document, sentences_per_paragraph,
+                            terms_per_sentence, vocabulary_size):
+    """
+    Inserts a synthetic corpus whose term frequencies follow a Zipf distribution
+    :return: The list of synthetic document ids
+    """
+    vocabulary = ['benchterm{}'.format(i) for i in range(vocabulary_size)]
+    weights = zipf_weights(vocabulary_size)
+    cursor.executemany('INSERT IGNORE INTO term (term_text) VALUES (%s)', vocabulary)
+    cursor.execute("SELECT term_text, term_id FROM term WHERE term_text LIKE 'benchterm%%'")
+    term_ids = dict(cursor.fetchall())
+
+    document_ids = []
+    for d in range(documents):
+        document_id = 'bench-{}'.format(d)
+        document_ids.append(document_id)
+        cursor.execute('INSERT INTO document (document_id, timestamp) VALUES (%s, CURDATE())', (document_id,))
+        cursor.execute('INSERT INTO paragraph (document_id, position_in_fullText) VALUES ' + ','.join(
+            ['(%s, %s)'] * paragraphs_per_document),
+                       tuple(chain.from_iterable((document_id, p) for p in range(paragraphs_per_document))))
+        cursor.execute('SELECT paragraph_id FROM paragraph WHERE document_id = %s ORDER BY paragraph_id',
+                       (document_id,))
+        paragraph_ids = [row[0] for row in cursor.fetchall()]
+
+        document_counts = Counter()
+        for paragraph_id in paragraph_ids:
+            cursor.execute('INSERT INTO sentence (paragraph_id, position_in_paragraph) VALUES ' + ','.join(
+                ['(%s, %s)'] * sentences_per_paragraph),
+                           tuple(chain.from_iterable((paragraph_id, s) for s in range(sentences_per_paragraph))))
+            cursor.execute('SELECT sentence_id FROM sentence WHERE paragraph_id = %s ORDER BY sentence_id',
+                           (paragraph_id,))
+            sentence_ids = [row[0] for row in cursor.fetchall()]
+
+            paragraph_counts = Counter()
+            sentence_rows = []
+            for sentence_id in sentence_ids:
+                sentence_counts = Counter(rng.choices(vocabulary, weights, k=terms_per_sentence))
+                paragraph_counts.update(sentence_counts)
+                sentence_rows.extend((f, sentence_id, term_ids[t]) for t, f in sentence_counts.items())
+            document_counts.update(paragraph_counts)
+            cursor.executemany('INSERT INTO sentence_term (frequency, sentence_id, term_id) VALUES (%s, %s, %s)',
+                               sentence_rows)
+            cursor.executemany('INSERT INTO paragraph_term (frequency, paragraph_id, term_id) VALUES (%s, %s, %s)',
+                               [(f, paragraph_id, term_ids[t]) for t, f in paragraph_counts.items()])
+        cursor.executemany('INSERT INTO document_term (frequency, document_id, term_id) VALUES (%s, %s, %s)',
+                           [(f, document_id, term_ids[t]) for t, f in document_counts.items()])
+
+    return document_ids
+
+
+def max_score_error(cursor, level):
+    """
+    Recomputes the scores of a level in Python and compares them with the scores read from the level's view
+    :return: The largest absolute difference
+    """
+    cursor.execute('SELECT COUNT(*) FROM {}'.format(level.unit_table))
+    n, = cursor.fetchone()
+    cursor.execute('SELECT {}, term_id, frequency, score FROM {}'.format(level.unit_key, level.score_view))
+    rows = cursor.fetchall()
+
+    totals = Counter()
+    df = Counter()
+    for unit_id, term_id, frequency, _ in rows:
+        totals[unit_id] += frequency
+        if frequency > 0:
+            df[term_id] += 1
+
+    error = 0
+    for unit_id, term_id, frequency, score in rows:
+        expected = frequency / totals[unit_id] * math.log(n / df[term_id])
+        error = max(error, abs(expected - score))
+    return error
+
+
+def run(cursor, args, documents):
+    rng = random.Random(args.seed)
+    insert_synthetic_corpus(cursor, rng, documents, args.paragraphs, args.sentences, args.terms, args.vocabulary)
+
+    result = {
+        'documents': documents,
+        'rows': {},
+        'seconds': {},
+    }
+    for level in LEVELS:
+        cursor.execute('SELECT COUNT(*) FROM {}'.format(level.term_table))
+        result['rows'][level.name], = cursor.fetchone()
+
+        start = time.perf_counter()
+        rebuild_level_statistics(cursor, level)
+        result['seconds'][level.name] = time.perf_counter() - start
+
+        if args.verify:
+            result.setdefault('max_error', {})[level.name] = max_score_error(cursor, level)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--paragraphs', type=int, default=5, help='paragraphs per document')
+    parser.add_argument('--sentences', type=int, default=5, help='sentences per paragraph')
+    parser.add_argument('--terms', type=int, default=10, help='terms per sentence')
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verify', action='store_true', help='check the scores against a Python recompute')
+    args = parser.parse_args()
+
+    conn = pymysql.connect(**PYMYSQL_CONNECT_ARGS)
+    try:
+        for documents in args.documents:
+            cur = conn.cursor()
+            try:
+                print(json.dumps(run(cur, args, documents)), flush=True)
+            finally:
+                cur.close()
+                conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Times topic generation, and checks it against the per-pair SQL implementation it replaced.
+
+With --reference, topics are generated from the configured database both by api.topics and by the former
+implementation, which calls the `compute_similarity_score` SQL function for every pair of terms, and the two results
+are compared. Load the `test-notes/` corpus first to reproduce the reference check.
+With --synthetic, topics are generated from random in-memory matrices of the given vocabulary sizes, without a
+database.
+With --bands, every run also generates topics in the approximate mode with each number of LSH bands of --rows MinHash
+values, and reports:
+  * its time, and its speedup over the exact mode
+  * candidate_recall: the fraction of the pairs of terms sharing a document that LSH finds, which are the pairs whose
+    similarity scores are checked
+  * recall and precision: its agreement with the exact topics, by the pairs of terms put in the same topic. Since each
+    term joins the first topic it matches, a single pair missed can move every term after it, so the agreement is lower
+    than the candidate recall
+
+Usage: python -m benchmarks.topics [--reference] [--synthetic 2000 10000 20000 --documents 1000 --density 0.01]
+    [--bands 16 32 64 --rows 2]
+"""
+
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+
+from api.topics import (
+    LSH_ROWS,
+    SIMILARITY_THRESHOLD,
+    TermDocumentMatrix,
+    generate_topics,
+    generate_topics_approximate,
+    lsh_candidate_pairs,
+    topic_agreement,
+)
+
+
+def reference_topics(cursor, terms_list):
+    """
+    Generates topics the way they were generated before api.topics, with one SQL call per pair of terms
+    """
+    similarity_score_fn_memo = {}
+    cursor.execute('SELECT term_text, term_id FROM term')
+    term_ids = dict(cursor.fetchall())
+
+    def similarity_score_fn(t1, t2):
+        if (t1, t2) not in similarity_score_fn_memo:
+            cursor.execute('SELECT compute_similarity_score(%s, %s)', (term_ids[t1], term_ids[t2]))
+            similarity_score_fn_memo[t1, t2] = similarity_score_fn_memo[t2, t1] = cursor.fetchone()[0]
+        return similarity_score_fn_memo[t1, t2]
+
+    def geometric_mean_fn(term):
+        cursor.execute('SELECT score FROM document_term_score WHERE term_id = %s', (term_ids[term],))
+        scores = cursor.fetchall()
+        if len(scores) == 0:
+            return 0
+        product = 1
+        for score, in scores:
+            product *= score
+        return math.pow(product, 1 / len(scores))
+
+    topics = []
+    for t in terms_list:
+        for topic in topics:
+            if all(similarity_score_fn(t, u) is not None and similarity_score_fn(t, u) < SIMILARITY_THRESHOLD
+                   for u in topic):
+                topic.append(t)
+                break
+        else:
+            topics.append([t])
+
+    return sorted(topics, key=lambda l: sum(map(geometric_mean_fn, l)) / len(l), reverse=True)
+
+
+def cooccurring_pairs(matrix, budget=1 << 22):
+    """
+    :param budget: The maximum number of pairs of entries materialized at once
+    :return: The sorted array of the distinct pairs of terms sharing a document, encoded like those of
+      lsh_candidate_pairs
+    """
+    size = len(matrix)
+    lengths = np.diff(matrix.doc_ptr)
+    work = np.cumsum(lengths * (lengths - 1) // 2)
+    pairs = [np.zeros(0, dtype=np.int64)]
+    start = 0
+    while start < len(lengths):
+        end = int(np.searchsorted(work, (work[start - 1] if start > 0 else 0) + budget, side='right'))
+        end = max(end, start + 1)
+        # Each entry of the documents is paired with the entries after it in its document
+        lo, hi = matrix.doc_ptr[start], matrix.doc_ptr[end]
+        counts = np.repeat(matrix.doc_ptr[start + 1:end + 1], lengths[start:end]) - np.arange(lo, hi) - 1
+        first = np.repeat(np.arange(lo, hi), counts)
+        second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        terms, others = matrix.doc_terms[first], matrix.doc_terms[second]
+        pairs.append(np.minimum(terms, others) * size + np.maximum(terms, others))
+        start = end
+    pairs = np.sort(np.concatenate(pairs))
+    return pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) > 0 else pairs
+
+
+def run_approximate(matrix, topics, exact_seconds, bands, rows):
+    """
+    :param topics: The exact topics of the matrix
+    :param exact_seconds: The time taken to generate them
+    :return: The time, speedup and candidate recall of the approximate mode, and its agreement with the exact topics,
+      for each number of bands
+    """
+    runs = []
+    cooccurring = cooccurring_pairs(matrix) if len(bands) > 0 else None
+    for b in bands:
+        start = time.perf_counter()
+        approximate = generate_topics_approximate(matrix, bands=b, rows=rows)
+        seconds = time.perf_counter() - start
+        found = np.isin(cooccurring, lsh_candidate_pairs(matrix, b, rows), assume_unique=True)
+        runs.append(dict({
+            'bands': b,
+            'rows': rows,
+            'topics': len(approximate),
+            'seconds': seconds,
+            'speedup': exact_seconds / seconds if seconds > 0 else None,
+            'candidate_recall': float(found.mean()) if len(found) > 0 else 1.0,
+        }, **topic_agreement(topics, approximate)))
+    return runs
+
+
+def run_reference(bands, rows):
+    import pymysql
+    from config import PYMYSQL_CONNECT_ARGS
+
+    conn = pymysql.connect(**PYMYSQL_CONNECT_ARGS)
+    try:
+        cur = conn.cursor()
+        start = time.perf_counter()
+        matrix = TermDocumentMatrix.load(cur)
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        topics = generate_topics(matrix)
+        vectorized_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = reference_topics(cur, matrix.terms)
+        reference_seconds = time.perf_counter() - start
+    finally:
+        conn.close()
+
+    return {
+        'terms': len(matrix),
+        'topics': len(topics),
+        'load_seconds': load_seconds,
+        'vectorized_seconds': vectorized_seconds,
+        'reference_seconds': reference_seconds,
+        'matches_reference': topics == expected,
+        'approximate': run_approximate(matrix, topics, vectorized_seconds, bands, rows),
+    }
+
+
+def run_synthetic(vocabulary, documents, density, seed, bands, rows):
+    rng = np.random.default_rng(seed)
+    entries = np.unique(rng.integers(0, vocabulary * documents, int(vocabulary * documents * density)))
+    matrix = TermDocumentMatrix(['t{}'.format(i) for i in range(vocabulary)], entries // documents,
+                                entries % documents, rng.random(len(entries)), documents)
+
+    start = time.perf_counter()
+    topics = generate_topics(matrix)
+    vectorized_seconds = time.perf_counter() - start
+    return {
+        'terms': vocabulary,
+        'documents': documents,
+        'entries': len(entries),
+        'topics': len(topics),
+        'vectorized_seconds': vectorized_seconds,
+        'approximate': run_approximate(matrix, topics, vectorized_seconds, bands, rows),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reference', action='store_true', help='compare against the per-pair SQL implementation')
+    parser.add_argument('--synthetic', type=int, nargs='*', default=[], help='vocabulary sizes of synthetic runs')
+    parser.add_argument('--documents', type=int, default=1000, help='documents of synthetic runs')
+    parser.add_argument('--density', type=float, default=0.01, help='fraction of nonzero synthetic scores')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bands', type=int, nargs='*', default=[], help='LSH bands of approximate runs')
+    parser.add_argument('--rows', type=int, default=LSH_ROWS, help='MinHash values per LSH band')
+    args = parser.parse_args()
+
+    if args.reference:
+        print(json.dumps(run_reference(args.bands, args.rows)), flush=True)
+    for vocabulary in args.synthetic:
+        print(json.dumps(run_synthetic(vocabulary, args.documents, args.density, args.seed, args.bands, args.rows)),
+              flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
 """
+The database backend, 'mysql' or 'sqlite'. SQLite keeps the whole database in SQLITE_PATH and needs no server
+"""
+STORAGE = 'mysql'
+SQLITE_PATH = 'corpalizer.db'
+"""
 Credentials that the app will use to connect to to the database
 """
 PYMYSQL_CONNECT_ARGS = {'user': 'your-user-name',
@@ -6,3 +11,28 @@ PYMYSQL_CONNECT_ARGS = {'user': 'your-user-name',
                           'host': '127.0.0.1',
                           'database': 'corpalizer'}
 DOCUMENTS_DIR = 'documents'
+# How document texts are stored in DOCUMENTS_DIR: 'files' (one file per document) or 'packed' (large append-only
+# segments, optionally compressed with DOCUMENT_COMPRESSION = 'zlib'). Files left by 'files' are still read by 'packed'
+DOCUMENT_STORE = 'files'
+DOCUMENT_COMPRESSION = None
+# Where computed topics are cached, so they survive restarts and are shared by worker processes
+TOPICS_CACHE_DIR = 'topics_cache'
+# How often, in seconds, searches check whether the corpus changed outside of this process and the search index must be
+# rebuilt
+SEARCH_REFRESH_SECONDS = 5
+# Where columnar snapshots of the corpus are written by the `snapshot` job, from which topics and the search index are
+# loaded when they are up to date
+SNAPSHOT_DIR = 'snapshots'
+# How paragraphs are split into sentences: 'pysbd', 'rules' (faster), or 'spacy' (batched, or 'spacy:<model>' to use an
+# installed spaCy model). See backend/src/api/segmenters.py, and `python -m benchmarks.segmenters` to compare them
+SEGMENTER = 'pysbd'
+# Maximum number of database connections, and how many seconds a request waits for one before failing
+DB_POOL_SIZE = 10
+DB_POOL_TIMEOUT = 30
+# Where the state of background jobs is kept, and how many of them run at the same time
+JOBS_DIR = 'jobs'
+JOB_WORKERS = 2
+# Whether to record request, SQL, stage and job metrics, exposed at /metrics. With PROFILING, requests sending a
+# X-Profile header get a Server-Timing header breaking their time down by stage and SQL statement
+METRICS_ENABLED = True
+PROFILING = False
@@ -0,0 +1,45 @@
+"""
+Imports a directory of text files, or a JSONL file, into the corpus.
+Re-running the same command after an interruption resumes the import.
+
+Usage: python src/import_corpus.py ../test-notes [--workers 4] [--batch-size 200] [--segmenter rules]
+"""
+
+import argparse
+import sys
+
+from api import DOCUMENT_COMPRESSION, DOCUMENT_STORE, SEGMENTER, SQLITE_PATH, STORAGE
+from api.document_store import create_document_store
+from api.importer import import_corpus
+from api.pool import ConnectionPool
+from api.segmenters import check_segmenter
+from api.storage import create_storage
+from config import PYMYSQL_CONNECT_ARGS, DOCUMENTS_DIR
+
+
+def print_progress(progress):
+    print('imported {} skipped {} failed {} ({:.1f} documents/s)'.format(
+        progress.imported, progress.skipped, progress.failed, progress.documents_per_second), file=sys.stderr)
+    if progress.last_error is not None:
+        print('last error: {}'.format(progress.last_error), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='a directory of text files, or a JSONL file with a "content" field per line')
+    parser.add_argument('--workers', type=int, default=None, help='analysis processes, defaults to the CPU count')
+    parser.add_argument('--batch-size', type=int, default=200, help='documents written per transaction')
+    parser.add_argument('--segmenter', type=check_segmenter, default=SEGMENTER,
+                        help='sentence segmenter: pysbd, rules, spacy or spacy:<model>, defaults to SEGMENTER')
+    args = parser.parse_args()
+
+    pool = ConnectionPool(create_storage(STORAGE, PYMYSQL_CONNECT_ARGS, SQLITE_PATH), size=1)
+    document_store = create_document_store(DOCUMENT_STORE, DOCUMENTS_DIR, compression=DOCUMENT_COMPRESSION)
+    try:
+        result = import_corpus(args.path, pool, document_store, workers=args.workers, batch_size=args.batch_size,
+                               progress_callback=print_progress, segmenter=args.segmenter)
+    finally:
+        pool.close()
+        document_store.close()
+    print_progress(result)
+    print('done in {:.1f}s'.format(result.seconds), file=sys.stderr)
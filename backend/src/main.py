@@ -1,5 +1,19 @@
+import argparse
+
 from api import create_app
 
 if __name__ == '__main__':
-    app = create_app()
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description='Runs the API, with the Flask debug server unless --workers is given')
+    parser.add_argument('--workers', type=int, help='number of pre-forked worker processes serving requests, see '
+                                                    'api/server.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.workers is None:
+        app = create_app()
+        app.run(debug=True, host=args.host, port=args.port)
+    else:
+        from api.server import serve
+
+        serve(create_app, args.host, args.port, args.workers)
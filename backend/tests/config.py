@@ -0,0 +1,7 @@
+"""
+Settings of the api package during the tests, which create their storage and stores in temporary directories instead
+"""
+STORAGE = 'sqlite'
+SQLITE_PATH = 'corpalizer.db'
+PYMYSQL_CONNECT_ARGS = {}
+DOCUMENTS_DIR = 'documents'
@@ -0,0 +1,38 @@
+"""
+Fixtures shared by the tests, which run against SQLite databases in temporary directories, so they need no server.
+Run them from `backend/` with `python -m pytest tests`
+"""
+
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# The api package reads its settings from the config module when it is imported, here the one of the tests. Processes
+# spawned by the tests inherit this path
+sys.path[:0] = [TESTS_DIR, os.path.join(os.path.dirname(TESTS_DIR), 'src')]
+
+from api.storage import create_storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """
+    A SQLite storage backend, on an empty database
+    """
+    return create_storage('sqlite', sqlite_path=str(tmp_path / 'corpalizer.db'))
+
+
+@pytest.fixture
+def conn(storage):
+    conn = storage.connect()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def cursor(conn):
+    cur = conn.cursor()
+    yield cur
+    cur.close()
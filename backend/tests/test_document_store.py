@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+from api.document_store import FILES, PACKED, ZLIB, FileDocumentStore, PackedDocumentStore, create_document_store
+
+TEXT = 'The first paragraph.\nThe second paragraph, which is a little longer than the first one.\n'
+
+
+@pytest.fixture(params=[None, ZLIB])
+def open_store(request, tmp_path):
+    """
+    Opens packed stores on the same directory, with small segments and blocks so that documents span several of them
+    """
+    def open_store(**kwargs):
+        return PackedDocumentStore(str(tmp_path / 'documents'), **dict({
+            'segment_size': 256, 'compression': request.param, 'block_size': 16, 'compact_threshold': 0.5}, **kwargs))
+    return open_store
+
+
+def segment_files(store):
+    return sorted(name for name in os.listdir(store.directory) if name.endswith('.dat'))
+
+
+def test_put_and_get(open_store):
+    store = open_store()
+    store.put_many([('a', TEXT), ('b', 'Ünïcode text.')])
+    assert store.get('a') == TEXT
+    assert store.get('b') == 'Ünïcode text.'
+    assert store.get('missing') is None
+    assert store.get_range('missing', 0, 4) is None
+
+
+def test_get_range(open_store):
+    store = open_store()
+    store.put_many([('a', TEXT), ('b', 'Ünïcode text.')])
+    # Ranges within one block, across blocks, past the end, and to the end
+    for start, end in [(4, 9), (10, 50), (60, 1000), (21, None), (30, 10)]:
+        assert store.get_range('a', start, end) == TEXT[start:end]
+    assert store.get_range('b', 2, 7) == 'ïcode'
+
+
+def test_put_replaces_and_delete_removes(open_store):
+    store = open_store()
+    store.put_many([('a', 'First version.'), ('b', 'Kept.')])
+    store.put('a', 'Second version.')
+    store.delete('b')
+    assert store.get('a') == 'Second version.'
+    assert store.get('b') is None
+
+    reopened = open_store()
+    assert reopened.get('a') == 'Second version.'
+    assert reopened.get('b') is None
+
+
+def test_reopen_reads_sealed_and_active_segments(open_store):
+    store = open_store()
+    for i in range(20):
+        store.put('doc-{}'.format(i), '{} {}'.format(i, TEXT))
+    assert len(segment_files(store)) > 1
+
+    reopened = open_store()
+    assert [reopened.get('doc-{}'.format(i)) for i in range(20)] == ['{} {}'.format(i, TEXT) for i in range(20)]
+
+
+def test_writes_of_another_store_are_seen(open_store):
+    store, other = open_store(), open_store()
+    store.put('a', TEXT)
+    assert other.get('a') == TEXT
+    other.delete('a')
+    assert store.get('a') is None
+
+
+def test_compact_reclaims_deleted_documents(open_store):
+    store = open_store()
+    for i in range(20):
+        store.put('doc-{}'.format(i), '{} {}'.format(i, TEXT))
+    store.delete_many(['doc-{}'.format(i) for i in range(20) if i % 4 != 0])
+    before = segment_files(store)
+    assert store.needs_compaction()
+    garbage = store.garbage_ratio()
+    assert garbage > 0.5
+
+    assert store.compact() > 0
+    assert store.garbage_ratio() < garbage
+    assert segment_files(store) != before
+    # Deletion records are copied along while older segments may hold a record of their document, so the segments
+    # they are copied to are compacted by a later run
+    for _ in range(3):
+        store.compact()
+    assert not store.needs_compaction()
+    for s in (store, open_store()):
+        assert [s.get('doc-{}'.format(i)) for i in range(20)] == [
+            '{} {}'.format(i, TEXT) if i % 4 == 0 else None for i in range(20)]
+
+
+def test_compact_keeps_deletions_shadowing_older_segments(open_store):
+    store = open_store(compact_threshold=0.1)
+    store.put('a', TEXT)
+    store.put_many([('doc-{}'.format(i), TEXT) for i in range(4)])
+    # The deletion of `a` lands in a later segment than its record
+    store.delete('a')
+    store.put_many([('doc-{}'.format(i), TEXT) for i in range(4, 8)])
+    store.delete_many(['doc-{}'.format(i) for i in range(8)])
+    store.put('last', TEXT)
+
+    store.compact()
+    assert store.get('a') is None
+    assert open_store().get('a') is None
+    assert open_store().get('last') == TEXT
+
+
+def test_incomplete_record_is_ignored_then_repaired(open_store):
+    store = open_store(segment_size=1 << 20)
+    store.put_many([('a', TEXT), ('b', TEXT)])
+    path = os.path.join(store.directory, segment_files(store)[-1])
+    size = os.path.getsize(path)
+    # A writer stopped in the middle of a record
+    record = store._record('c', TEXT)
+    with open(path, 'ab') as f:
+        f.write(record[:len(record) // 2])
+
+    reopened = open_store(segment_size=1 << 20)
+    assert reopened.get('a') == TEXT
+    assert reopened.get('c') is None
+    # The next write truncates the incomplete record before appending
+    reopened.put('d', TEXT)
+    assert os.path.getsize(path) == size + len(reopened._record('d', TEXT))
+    for s in (reopened, open_store(segment_size=1 << 20)):
+        assert [s.get(k) for k in 'abcd'] == [TEXT, TEXT, None, TEXT]
+
+
+def test_corrupt_record_is_ignored_then_repaired(open_store):
+    store = open_store(segment_size=1 << 20)
+    store.put('a', TEXT)
+    path = os.path.join(store.directory, segment_files(store)[-1])
+    record = bytearray(store._record('b', TEXT))
+    record[-1] ^= 0xFF
+    with open(path, 'ab') as f:
+        f.write(record)
+
+    reopened = open_store(segment_size=1 << 20)
+    assert reopened.get('b') is None
+    reopened.put('c', TEXT)
+    assert [open_store(segment_size=1 << 20).get(k) for k in 'abc'] == [TEXT, None, TEXT]
+
+
+def test_packed_store_reads_and_replaces_files(tmp_path):
+    directory = str(tmp_path / 'documents')
+    FileDocumentStore(directory).put_many([('a', 'From a file.'), ('b', 'Also from a file.')])
+
+    store = create_document_store(PACKED, directory)
+    assert store.get('a') == 'From a file.'
+    store.put('a', 'Packed.')
+    store.delete('b')
+    assert not os.path.exists(os.path.join(directory, 'a.txt'))
+    assert create_document_store(FILES, directory).get('b') is None
+    assert create_document_store(PACKED, directory).get('a') == 'Packed.'
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+from api.document_store import FILES, create_document_store
+from api.importer import import_corpus, iter_directory_sources, iter_jsonl_sources
+from api.pool import ConnectionPool
+
+
+@pytest.fixture
+def pool(storage):
+    pool = ConnectionPool(storage, size=2)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def document_store(tmp_path):
+    return create_document_store(FILES, str(tmp_path / 'documents'))
+
+
+def write_files(directory, texts):
+    directory.mkdir(exist_ok=True)
+    for name, text in texts.items():
+        (directory / name).write_text(text)
+
+
+def write_jsonl(path, objects):
+    path.write_text(''.join(json.dumps(obj) + '\n' for obj in objects))
+
+
+def run_import(path, pool, document_store, **kwargs):
+    return import_corpus(str(path), pool, document_store, workers=1, batch_size=2, analyze_chunk_size=2,
+                         segmenter='rules', **kwargs)
+
+
+def imported_texts(pool, document_store):
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT document_id FROM document')
+        texts = sorted(document_store.get(doc_uuid) for doc_uuid, in cur.fetchall())
+        cur.close()
+    return texts
+
+
+def test_directory_sources_are_keyed_by_absolute_path(tmp_path, monkeypatch):
+    write_files(tmp_path / 'a', {'1.txt': 'First.', '2.txt': 'Second.'})
+    write_files(tmp_path / 'b', {'1.txt': 'Other first.'})
+    monkeypatch.chdir(tmp_path)
+
+    keys = [s.key for s in iter_directory_sources('a')] + [s.key for s in iter_directory_sources('b')]
+    assert keys == [str(tmp_path / 'a' / '1.txt'), str(tmp_path / 'a' / '2.txt'), str(tmp_path / 'b' / '1.txt')]
+
+
+def test_jsonl_sources_are_keyed_by_file_and_id(tmp_path):
+    write_jsonl(tmp_path / 'a.jsonl', [{'id': 'x', 'content': 'One.'}, {'content': 'Two.'}])
+    write_jsonl(tmp_path / 'b.jsonl', [{'id': 'x', 'content': 'Three.'}])
+    (tmp_path / 'b.jsonl').open('a').write('not json\n')
+
+    a, b = list(iter_jsonl_sources(str(tmp_path / 'a.jsonl'))), list(iter_jsonl_sources(str(tmp_path / 'b.jsonl')))
+    assert [s.key for s in a] == ['{}:x'.format(tmp_path / 'a.jsonl'), '{}:line-2'.format(tmp_path / 'a.jsonl')]
+    assert [s.key for s in b] == ['{}:x'.format(tmp_path / 'b.jsonl'), '{}:line-2'.format(tmp_path / 'b.jsonl')]
+    assert b[1].text is None and b[1].error is not None
+
+
+def test_import_skips_the_sources_already_imported(tmp_path, pool, document_store):
+    write_files(tmp_path / 'corpus', {'1.txt': 'The first note.', '2.txt': 'The second note.'})
+    progress = run_import(tmp_path / 'corpus', pool, document_store)
+    assert (progress.imported, progress.skipped, progress.failed) == (2, 0, 0)
+
+    write_files(tmp_path / 'corpus', {'3.txt': 'The third note.'})
+    progress = run_import(tmp_path / 'corpus', pool, document_store)
+    assert (progress.imported, progress.skipped, progress.failed) == (1, 2, 0)
+    assert imported_texts(pool, document_store) == ['The first note.', 'The second note.', 'The third note.']
+
+
+def test_import_tells_apart_files_of_the_same_name(tmp_path, pool, document_store):
+    write_files(tmp_path / 'a', {'1.txt': 'A note from the first directory.'})
+    write_files(tmp_path / 'b', {'1.txt': 'A note from the second directory.'})
+    run_import(tmp_path / 'a', pool, document_store)
+    progress = run_import(tmp_path / 'b', pool, document_store)
+    assert (progress.imported, progress.skipped) == (1, 0)
+    assert len(imported_texts(pool, document_store)) == 2
+
+
+def test_import_resumes_after_a_cancellation(tmp_path, pool, document_store):
+    write_jsonl(tmp_path / 'corpus.jsonl', [{'id': str(i), 'content': 'Note number {}.'.format(i)} for i in range(6)])
+    polls = []
+
+    def poll_cancel():
+        polls.append(None)
+        return len(polls) > 3
+
+    progress = run_import(tmp_path / 'corpus.jsonl', pool, document_store, poll_cancel=poll_cancel)
+    assert progress.imported == 3
+
+    progress = run_import(tmp_path / 'corpus.jsonl', pool, document_store)
+    assert (progress.imported, progress.skipped) == (3, 3)
+    assert imported_texts(pool, document_store) == ['Note number {}.'.format(i) for i in range(6)]
+
+
+def test_import_counts_unreadable_sources_as_failed(tmp_path, pool, document_store):
+    write_jsonl(tmp_path / 'corpus.jsonl', [{'id': 'a', 'content': 'A note.'}, {'id': 'b'}])
+    progress = run_import(tmp_path / 'corpus.jsonl', pool, document_store)
+    assert (progress.imported, progress.failed) == (1, 1)
+    assert progress.last_error is not None
+
+    # Failed sources are not recorded, so they are tried again
+    progress = run_import(tmp_path / 'corpus.jsonl', pool, document_store)
+    assert (progress.imported, progress.skipped, progress.failed) == (0, 1, 1)
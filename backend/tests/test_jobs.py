@@ -0,0 +1,140 @@
+import time
+from threading import Event
+
+import pytest
+
+from api.jobs import (
+    CANCELLED,
+    DONE,
+    INTERRUPTED,
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    JobScheduler,
+    JobStore,
+)
+
+TIMEOUT = 10
+
+
+@pytest.fixture
+def scheduler():
+    return JobScheduler(workers=1)
+
+
+def block(scheduler):
+    """
+    Occupies a worker until the returned event is set
+    """
+    started, release = Event(), Event()
+
+    def wait(job):
+        started.set()
+        release.wait(TIMEOUT)
+
+    scheduler.submit('block', wait)
+    assert started.wait(TIMEOUT)
+    return release
+
+
+def record(order):
+    def run(job, name):
+        order.append(name)
+        return name
+    return run
+
+
+def test_jobs_run_by_priority_then_in_submission_order(scheduler):
+    release = block(scheduler)
+    order = []
+    jobs = [scheduler.submit('work', record(order), {'name': name}, priority=priority)
+            for name, priority in [('low', PRIORITY_LOW), ('normal-1', PRIORITY_NORMAL), ('high', PRIORITY_HIGH),
+                                   ('normal-2', PRIORITY_NORMAL)]]
+    release.set()
+
+    assert all(job.wait(TIMEOUT) for job in jobs)
+    assert order == ['high', 'normal-1', 'normal-2', 'low']
+    assert [job.state for job in jobs] == [DONE] * 4
+
+
+def test_queued_jobs_with_the_same_key_coalesce(scheduler):
+    release = block(scheduler)
+    order = []
+    first = scheduler.submit('work', record(order), {'name': 'a'}, key='a')
+    again = scheduler.submit('work', record(order), {'name': 'a'}, key='a')
+    other = scheduler.submit('work', record(order), {'name': 'b'}, key='b')
+    release.set()
+
+    assert again is first
+    assert first.wait(TIMEOUT) and other.wait(TIMEOUT)
+    assert order == ['a', 'b']
+
+
+def test_coalescing_raises_the_priority_of_the_queued_job(scheduler):
+    release = block(scheduler)
+    order = []
+    low = scheduler.submit('work', record(order), {'name': 'a'}, priority=PRIORITY_LOW, key='a')
+    normal = scheduler.submit('work', record(order), {'name': 'b'})
+    raised = scheduler.submit('work', record(order), {'name': 'a'}, priority=PRIORITY_HIGH, key='a')
+    release.set()
+
+    assert raised is low and low.priority == PRIORITY_HIGH
+    assert low.wait(TIMEOUT) and normal.wait(TIMEOUT)
+    assert order == ['a', 'b']
+
+
+def test_jobs_with_the_same_key_do_not_run_at_the_same_time():
+    scheduler = JobScheduler(workers=2)
+    started, release = Event(), Event()
+    running = []
+    overlaps = []
+
+    def run(job):
+        running.append(job.id)
+        overlaps.append(len(running))
+        started.set()
+        release.wait(TIMEOUT)
+        running.remove(job.id)
+
+    first = scheduler.submit('work', run, key='a')
+    assert started.wait(TIMEOUT)
+    # The first job is running, so the second one is queued rather than coalesced, and held back until it finishes
+    second = scheduler.submit('work', run, key='a')
+    assert second is not first
+    time.sleep(0.1)
+    assert overlaps == [1]
+    release.set()
+
+    assert first.wait(TIMEOUT) and second.wait(TIMEOUT)
+    assert overlaps == [1, 1]
+
+
+def test_cancelled_queued_jobs_do_not_run(scheduler):
+    release = block(scheduler)
+    order = []
+    cancelled = scheduler.submit('work', record(order), {'name': 'a'}, key='a')
+    scheduler.cancel(cancelled.id)
+    # A job submitted with the same key afterwards is a new one
+    resubmitted = scheduler.submit('work', record(order), {'name': 'b'}, key='a')
+    release.set()
+
+    assert resubmitted is not cancelled
+    assert resubmitted.wait(TIMEOUT)
+    assert cancelled.state == CANCELLED
+    assert order == ['b']
+
+
+def test_unfinished_jobs_of_stopped_processes_are_interrupted(tmp_path):
+    store = JobStore(str(tmp_path))
+    scheduler = JobScheduler(workers=1, store=store)
+    job = scheduler.submit('work', lambda job: 'result')
+    assert job.wait(TIMEOUT)
+
+    # A job left running by a process that is gone
+    record = dict(job.to_dict(), id='stale', state='running', pid=None, finished=None)
+    store.save(record)
+    JobScheduler(workers=1, store=store)
+
+    assert store.load('stale')['state'] == INTERRUPTED
+    assert store.load(job.id)['state'] == DONE
+    assert store.load(job.id)['result'] == 'result'
@@ -0,0 +1,101 @@
+import re
+
+import pytest
+
+from api.document_store import FILES, PACKED, create_document_store
+from api.phrases import PhraseMatch, decode_positions, encode_positions, find_phrase
+from api.services import insert_document, update_document
+
+DOCUMENTS = {
+    'doc-1': 'The cat in the hat sat down.\nA CAT, in the HAT!\n',
+    'doc-2': 'Nobody saw the cat in the garden.\nThe cat and the hat.\n',
+    'doc-3': 'A cat\nin the hat, split across paragraphs.\n',
+}
+
+
+@pytest.mark.parametrize('positions', [[], [0], [0, 1, 2, 255], [3, 300, 70000], [5, 5 + (1 << 33)]])
+def test_positions_decode_to_what_was_encoded(positions):
+    assert decode_positions(encode_positions(positions)).tolist() == positions
+
+
+def test_positions_are_stored_in_the_narrowest_type():
+    assert encode_positions([1, 256])[0] == 1
+    assert encode_positions([1, 300])[0] == 2
+    assert encode_positions([70000])[0] == 4
+    assert len(encode_positions([10, 20, 30])) == 1 + 3
+
+
+@pytest.fixture(params=[FILES, PACKED])
+def document_store(request, tmp_path):
+    return create_document_store(request.param, str(tmp_path / 'documents'))
+
+
+@pytest.fixture
+def corpus(conn, cursor, document_store):
+    for doc_uuid, text in DOCUMENTS.items():
+        document_store.put(doc_uuid, text)
+        insert_document(doc_uuid, text, cursor)
+    conn.commit()
+    return cursor
+
+
+def expected_matches(phrase, context=40):
+    """
+    :return: The occurrences of the words of a phrase within the paragraphs of DOCUMENTS, whatever their case and the
+      characters between them, as find_phrase returns them
+    """
+    pattern = re.compile(r'\b' + r'[^\w\n]+'.join(re.findall(r'\w+', phrase)) + r'\b', re.IGNORECASE)
+    return [PhraseMatch(doc_uuid, m.start(), m.end(), text[max(m.start() - context, 0):m.start()], m.group(),
+                        text[m.end():m.end() + context])
+            for doc_uuid, text in sorted(DOCUMENTS.items()) for m in pattern.finditer(text)]
+
+
+def test_find_phrase_matches_in_document_and_offset_order(corpus, document_store):
+    assert find_phrase(corpus, document_store, 'cat in the hat') == expected_matches('cat in the hat')
+    assert find_phrase(corpus, document_store, 'the cat') == expected_matches('the cat')
+
+
+def test_find_phrase_ignores_case_and_punctuation_between_words(corpus, document_store):
+    matches = find_phrase(corpus, document_store, 'Cat in... the hat')
+    assert matches == expected_matches('cat in the hat')
+    assert [m.text for m in matches] == ['cat in the hat', 'CAT, in the HAT']
+
+
+def test_find_phrase_counts_stopwords_between_terms(corpus, document_store):
+    # 'cat' and 'hat' are two words apart in 'the cat and the hat', and three in the phrase
+    assert [m.document_id for m in find_phrase(corpus, document_store, 'cat in the hat')] == ['doc-1', 'doc-1']
+    assert find_phrase(corpus, document_store, 'cat and the hat') == expected_matches('cat and the hat')
+    assert find_phrase(corpus, document_store, 'cat the hat') == []
+
+
+def test_find_phrase_matches_words_exactly(corpus, document_store):
+    # 'cats' has the same term as 'cat', but not the same word
+    assert find_phrase(corpus, document_store, 'cats in the hat') == []
+
+
+def test_find_phrase_does_not_match_across_paragraphs(corpus, document_store):
+    assert 'doc-3' not in {m.document_id for m in find_phrase(corpus, document_store, 'cat in the hat', limit=100)}
+
+
+def test_find_phrase_context_and_limit(corpus, document_store):
+    assert find_phrase(corpus, document_store, 'garden', context=8) == expected_matches('garden', context=8)
+    assert find_phrase(corpus, document_store, 'the cat', limit=2) == expected_matches('the cat')[:2]
+
+
+@pytest.mark.parametrize('phrase', ['', 'in the', 'unknown words', 'cat unknown'])
+def test_find_phrase_without_matches(corpus, document_store, phrase):
+    assert find_phrase(corpus, document_store, phrase) == []
+
+
+def test_find_phrase_after_an_update(conn, corpus, document_store):
+    old_text = DOCUMENTS['doc-2']
+    text = 'Somebody put a hat on the dog.\n' + old_text
+    document_store.put('doc-2', text)
+    update_document('doc-2', old_text, text, corpus)
+    conn.commit()
+
+    shift = len('Somebody put a hat on the dog.\n')
+    assert find_phrase(corpus, document_store, 'the cat', limit=100) == [
+        m._replace(start=m.start + shift, end=m.end + shift, left=text[max(m.start + shift - 40, 0):m.start + shift])
+        if m.document_id == 'doc-2' else m for m in expected_matches('the cat')]
+    assert [m.text for m in find_phrase(corpus, document_store, 'hat on the dog')] == ['hat on the dog']
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from api.search import PostingList, SearchIndex
+from api.services import delete_document, insert_document, process_raw_document_into_terms, update_document
+from api.tfidf import DOCUMENT_LEVEL, LEVELS, PARAGRAPH_LEVEL
+
+DOCUMENTS = {
+    'doc-1': 'Cats purr when they are happy.\nDogs bark at the mail carrier.\n',
+    'doc-2': 'The cat chased the dog around the garden.\n',
+    'doc-3': 'Gardens need water and sunlight.\nSunlight makes plants grow.\n',
+}
+
+QUERIES = ['cat', 'dog', 'garden', 'sunlight', 'cat dog', 'water bark', 'unknown']
+
+
+def test_posting_list_decodes_what_it_was_given():
+    units, frequencies = PostingList([3, 7, 300], [1, 2, 5]).decode()
+    assert units.tolist() == [3, 7, 300]
+    assert frequencies.tolist() == [1, 2, 5]
+
+
+def test_posting_list_stores_deltas_in_the_narrowest_type():
+    assert PostingList([1, 2, 250], [1, 1, 1])._deltas.dtype == np.uint8
+    assert PostingList([1, 70000], [1, 1])._deltas.dtype == np.uint32
+    assert PostingList([1, 2], [1, 300])._frequencies.dtype == np.uint16
+
+
+def test_posting_list_appends():
+    postings = PostingList([1, 4], [2, 1])
+    postings.append(9, 3)
+    postings.append(1000, 1)
+    assert len(postings) == 4
+    units, frequencies = postings.decode()
+    assert units.tolist() == [1, 4, 9, 1000]
+    assert frequencies.tolist() == [2, 1, 3, 1]
+    # Decoding encodes the appended postings, and gives the same lists again
+    assert len(postings._tail) == 0
+    assert postings.decode()[0].tolist() == [1, 4, 9, 1000]
+
+
+def test_empty_posting_list():
+    postings = PostingList()
+    assert len(postings) == 0
+    assert postings.decode()[0].tolist() == []
+    postings.append(5, 2)
+    assert postings.decode()[0].tolist() == [5]
+
+
+@pytest.fixture
+def corpus(conn, cursor):
+    for doc_uuid, text in DOCUMENTS.items():
+        insert_document(doc_uuid, text, cursor)
+    conn.commit()
+    return cursor
+
+
+def search_all(index):
+    """
+    :return: The results of every query at every level. Units of equal scores, which are ranked by their internal ids,
+      are put in key order
+    """
+    return {(level.name, query): sorted(index.search(level, process_raw_document_into_terms(query), k=20),
+                                        key=lambda r: (-round(r[2], 9), r[0]))
+            for level in LEVELS for query in QUERIES}
+
+
+def assert_matches_rebuild(index, cursor):
+    """
+    Checks that an index kept up to date with writes ranks like one rebuilt from the database
+    """
+    rebuilt = SearchIndex.load(cursor, index.expected_version)
+    actual, expected = search_all(index), search_all(rebuilt)
+    for key in expected:
+        assert [(k, d) for k, d, _ in actual[key]] == [(k, d) for k, d, _ in expected[key]], key
+        assert [s for _, _, s in actual[key]] == pytest.approx([s for _, _, s in expected[key]]), key
+
+
+def test_load_and_search(corpus):
+    index = SearchIndex.load(corpus, 1)
+    results = index.search(DOCUMENT_LEVEL, process_raw_document_into_terms('cats'))
+    assert sorted(d for _, d, _ in results) == ['doc-1', 'doc-2']
+    results = index.search(PARAGRAPH_LEVEL, process_raw_document_into_terms('sunlight'))
+    assert [d for _, d, _ in results] == ['doc-3', 'doc-3']
+    assert index.search(DOCUMENT_LEVEL, process_raw_document_into_terms('unknown')) == []
+
+
+def test_add_document(conn, corpus):
+    index = SearchIndex.load(corpus, 1)
+    insert_document('doc-4', 'A cat sleeps in the sunlight.\n', corpus)
+    conn.commit()
+    index.add_document(corpus, 'doc-4')
+
+    assert index.expected_version == 2
+    assert 'doc-4' in [d for _, d, _ in index.search(DOCUMENT_LEVEL, process_raw_document_into_terms('sunlight'))]
+    assert_matches_rebuild(index, corpus)
+
+    # Adding a document already indexed only counts the write
+    index.add_document(corpus, 'doc-4')
+    assert index.expected_version == 3
+    assert_matches_rebuild(index, corpus)
+
+
+def test_remove_document(conn, corpus):
+    index = SearchIndex.load(corpus, 1)
+    delete_document('doc-2', corpus)
+    conn.commit()
+    index.remove_document('doc-2')
+
+    assert index.expected_version == 2
+    assert [d for _, d, _ in index.search(DOCUMENT_LEVEL, process_raw_document_into_terms('cat'))] == ['doc-1']
+    assert_matches_rebuild(index, corpus)
+
+
+def test_replace_document(conn, corpus):
+    index = SearchIndex.load(corpus, 1)
+    old_text = DOCUMENTS['doc-1']
+    text = 'Cats purr when they are happy.\nBirds sing in the garden at dawn.\nDogs bark at the mail carrier.\n'
+    update_document('doc-1', old_text, text, corpus)
+    conn.commit()
+    index.replace_document(corpus, 'doc-1')
+
+    assert index.expected_version == 2
+    assert [d for _, d, _ in index.search(DOCUMENT_LEVEL, process_raw_document_into_terms('birds'))] == ['doc-1']
+    assert_matches_rebuild(index, corpus)
+
+
+def test_needs_rebuild_once_enough_units_are_deleted(conn, corpus):
+    index = SearchIndex.load(corpus, 1)
+    assert not index.needs_rebuild()
+    delete_document('doc-3', corpus)
+    conn.commit()
+    index.remove_document('doc-3')
+    assert index.needs_rebuild()
@@ -0,0 +1,127 @@
+import pytest
+
+from api.services import get_corpus_version, insert_document, update_document
+from api.storage import create_storage
+
+TEXT = ('Cats purr when they are happy. They sleep most of the day.\n'
+        'Dogs bark at the mail carrier.\n'
+        'Gardens need water and sunlight. Sunlight makes plants grow.\n')
+
+OTHER = 'The cat chased the dog around the garden.\nBirds sing at dawn.\n'
+
+EDITS = {
+    'unchanged': TEXT,
+    'paragraph added': TEXT.replace('Dogs bark', 'Birds sing at dawn.\nDogs bark'),
+    'paragraph removed': TEXT.replace('Dogs bark at the mail carrier.\n', ''),
+    'sentence changed': TEXT.replace('They sleep most of the day.', 'They hunt mice at night.'),
+    'paragraphs swapped': ('Gardens need water and sunlight. Sunlight makes plants grow.\n'
+                           'Dogs bark at the mail carrier.\n'
+                           'Cats purr when they are happy. They sleep most of the day.\n'),
+    'paragraph repeated': TEXT + 'Dogs bark at the mail carrier.\n',
+    'everything replaced': 'A completely different text.\n',
+}
+
+
+def document_state(cursor, doc_uuid):
+    """
+    :return: What is stored about a document, with terms by text rather than by id, and units by position rather than
+      by id
+    """
+    cursor.execute('SELECT timestamp, term_count FROM document WHERE document_id = %s', (doc_uuid,))
+    state = {'document': cursor.fetchone()}
+    cursor.execute('SELECT term_text, frequency FROM document_term JOIN term USING (term_id) WHERE document_id = %s '
+                   'ORDER BY term_text', (doc_uuid,))
+    state['document_terms'] = cursor.fetchall()
+    cursor.execute('SELECT position_in_fullText, p.term_count, token_offsets, term_text, frequency, positions '
+                   'FROM paragraph p LEFT JOIN paragraph_term USING (paragraph_id) LEFT JOIN term USING (term_id) '
+                   'WHERE document_id = %s ORDER BY position_in_fullText, term_text', (doc_uuid,))
+    state['paragraphs'] = cursor.fetchall()
+    cursor.execute('SELECT position_in_fullText, position_in_paragraph, s.term_count, term_text, s_t.frequency '
+                   'FROM sentence s JOIN paragraph USING (paragraph_id) '
+                   'LEFT JOIN sentence_term s_t USING (sentence_id) LEFT JOIN term USING (term_id) '
+                   'WHERE document_id = %s ORDER BY position_in_fullText, position_in_paragraph, term_text',
+                   (doc_uuid,))
+    state['sentences'] = cursor.fetchall()
+    return state
+
+
+def statistics(cursor):
+    """
+    :return: The tfidf statistics and trend rollups, with terms by text
+    """
+    cursor.execute('SELECT level, term_text, df FROM term_df JOIN term USING (term_id) WHERE df > 0 '
+                   'ORDER BY level, term_text')
+    df = cursor.fetchall()
+    cursor.execute('SELECT level, n FROM unit_count ORDER BY level')
+    counts = cursor.fetchall()
+    cursor.execute('SELECT level, term_text, day, frequency FROM term_trend JOIN term USING (term_id) '
+                   'WHERE frequency > 0 ORDER BY level, term_text, day')
+    return {'df': df, 'unit_count': counts, 'trends': cursor.fetchall()}
+
+
+def paragraph_ids(cursor, doc_uuid):
+    cursor.execute('SELECT paragraph_id, position_in_fullText FROM paragraph WHERE document_id = %s', (doc_uuid,))
+    return dict(cursor.fetchall())
+
+
+@pytest.fixture
+def expected_cursor(tmp_path):
+    """
+    A cursor on a second database, where documents are written from scratch
+    """
+    conn = create_storage('sqlite', sqlite_path=str(tmp_path / 'expected.db')).connect()
+    cur = conn.cursor()
+    yield cur
+    cur.close()
+    conn.close()
+
+
+@pytest.mark.parametrize('edit', list(EDITS))
+def test_update_in_place_stores_what_an_insertion_would(cursor, expected_cursor, edit):
+    text = EDITS[edit]
+    for cur, document_text in ((cursor, TEXT), (expected_cursor, text)):
+        insert_document('other', OTHER, cur)
+        insert_document('doc', document_text, cur)
+
+    assert update_document('doc', TEXT, text, cursor) is True
+    assert document_state(cursor, 'doc') == document_state(expected_cursor, 'doc')
+    assert document_state(cursor, 'other') == document_state(expected_cursor, 'other')
+    assert statistics(cursor) == statistics(expected_cursor)
+
+
+def test_update_in_place_keeps_the_rows_of_unchanged_paragraphs(cursor):
+    insert_document('doc', TEXT, cursor)
+    before = paragraph_ids(cursor, 'doc')
+    update_document('doc', TEXT, EDITS['paragraph added'], cursor)
+    after = paragraph_ids(cursor, 'doc')
+
+    # Every former paragraph keeps its row, and those after the new one are moved by its length
+    shift = len('Birds sing at dawn.\n')
+    assert set(before) <= set(after)
+    assert {i: after[i] - before[i] for i in before} == {i: 0 if p < shift else shift for i, p in before.items()}
+
+
+@pytest.mark.parametrize('old_text', [None, 'Not the stored text.\n'])
+def test_update_rewrites_documents_whose_old_text_does_not_match(cursor, expected_cursor, old_text):
+    text = EDITS['sentence changed']
+    for cur, document_text in ((cursor, TEXT), (expected_cursor, text)):
+        insert_document('doc', document_text, cur)
+
+    assert update_document('doc', old_text, text, cursor) is False
+    assert document_state(cursor, 'doc') == document_state(expected_cursor, 'doc')
+    assert statistics(cursor) == statistics(expected_cursor)
+
+
+def test_update_inserts_missing_documents(cursor, expected_cursor):
+    insert_document('doc', TEXT, expected_cursor)
+    assert update_document('doc', None, TEXT, cursor) is False
+    assert document_state(cursor, 'doc') == document_state(expected_cursor, 'doc')
+
+
+@pytest.mark.parametrize('edit', ['unchanged', 'sentence changed'])
+@pytest.mark.parametrize('old_text', [TEXT, None])
+def test_update_bumps_the_corpus_version_once(cursor, edit, old_text):
+    insert_document('doc', TEXT, cursor)
+    version = get_corpus_version(cursor)
+    update_document('doc', old_text, EDITS[edit], cursor)
+    assert get_corpus_version(cursor) == version + 1
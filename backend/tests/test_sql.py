@@ -0,0 +1,74 @@
+import pytest
+
+from api import sql
+from api.sql import MAX_ROWS_PER_STATEMENT, insert_rows
+
+
+@pytest.fixture
+def items(cursor):
+    cursor.execute('CREATE TABLE item (item_id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL)')
+    return cursor
+
+
+def stored_ids(cursor, rows):
+    """
+    :return: The ids of the rows, as stored in the table
+    """
+    cursor.execute('SELECT name, item_id FROM item')
+    ids = dict(cursor.fetchall())
+    return [ids[name] for name, in rows]
+
+
+def test_insert_rows_returns_the_ids_of_the_rows(items):
+    rows = [('item-{}'.format(i),) for i in range(10)]
+    ids = insert_rows(items, 'INSERT INTO item (name) VALUES', '(%s)', rows, return_ids=True)
+    assert ids == stored_ids(items, rows)
+
+
+def test_insert_rows_returns_ids_across_statements(items):
+    # Ids that are not reused after deletions, and more rows than fit in one statement
+    insert_rows(items, 'INSERT INTO item (name) VALUES', '(%s)', [('old-{}'.format(i),) for i in range(5)])
+    items.execute('DELETE FROM item')
+    rows = [('item-{}'.format(i),) for i in range(2 * MAX_ROWS_PER_STATEMENT + 3)]
+    ids = insert_rows(items, 'INSERT INTO item (name) VALUES', '(%s)', rows, return_ids=True)
+
+    assert len(ids) == len(rows)
+    assert ids[0] == 6
+    assert ids == stored_ids(items, rows)
+
+
+def test_insert_rows_without_rows(items):
+    assert insert_rows(items, 'INSERT INTO item (name) VALUES', '(%s)', [], return_ids=True) == []
+    assert insert_rows(items, 'INSERT INTO item (name) VALUES', '(%s)', []) is None
+
+
+class MySQLCursor:
+    """
+    Stands for a PyMySQL cursor on a server with an AUTO_INCREMENT step of 2, which reports the id of the first row of
+    a multi-row INSERT
+    """
+
+    def __init__(self, next_id):
+        self.next_id = next_id
+        self.lastrowid = None
+        self.statements = []
+
+    def execute(self, query, args=None):
+        self.statements.append(query)
+        if query.startswith('INSERT'):
+            self.lastrowid = self.next_id
+            self.next_id += 2 * len(args)
+
+    def fetchone(self):
+        return 2,
+
+
+def test_insert_rows_derives_ids_from_the_first_row_on_mysql(monkeypatch):
+    monkeypatch.setattr(sql, '_auto_increment_step', None)
+    cursor = MySQLCursor(next_id=11)
+    rows = [(i,) for i in range(MAX_ROWS_PER_STATEMENT + 2)]
+    ids = insert_rows(cursor, 'INSERT INTO item (name) VALUES', '(%s)', rows, return_ids=True)
+
+    assert ids == list(range(11, 11 + 2 * len(rows), 2))
+    assert cursor.statements[0] == 'SELECT @@auto_increment_increment'
+    assert len(cursor.statements) == 3
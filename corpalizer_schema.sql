@@ -4,13 +4,25 @@ USE corpalizer;
 
 CREATE TABLE document (
 	document_id VARCHAR(100) PRIMARY KEY,
-    timestamp DATE
+    timestamp DATE,
+    term_count INT DEFAULT 0,
+    -- The corpus version of the last write to the document, from which snapshots are refreshed, see
+    -- backend/src/api/snapshot.py
+    corpus_version BIGINT,
+    -- Set on documents from an unfinished import, which are not counted in the tfidf statistics and trend rollups yet,
+    -- see backend/src/api/importer.py
+    statistics_pending BOOLEAN NOT NULL DEFAULT FALSE,
+    -- Serves the pages of GET /doc, ordered by date then id
+    INDEX document_timestamp (timestamp, document_id)
 );
 
 CREATE TABLE paragraph (
 	paragraph_id INT PRIMARY KEY AUTO_INCREMENT,
     document_id VARCHAR(100),
     position_in_fullText INT,
+    term_count INT DEFAULT 0,
+    -- The offsets of the words of the paragraph, see backend/src/api/phrases.py
+    token_offsets MEDIUMBLOB,
     CONSTRAINT paragraph_document_fk FOREIGN KEY (document_id) REFERENCES document(document_id) ON UPDATE RESTRICT ON DELETE CASCADE
 );
 
@@ -18,176 +30,134 @@ CREATE TABLE sentence (
 	sentence_id INT PRIMARY KEY AUTO_INCREMENT,
     paragraph_id INT,
     position_in_paragraph INT,
+    term_count INT DEFAULT 0,
     CONSTRAINT sentence_paragraph_fk FOREIGN KEY (paragraph_id) REFERENCES paragraph(paragraph_id) ON UPDATE RESTRICT ON DELETE CASCADE
 );
 
+-- The term dictionary. Other tables refer to terms by id, see backend/src/api/terms.py. Terms are never deleted, so
+-- that the ids cached by the app stay valid
 CREATE TABLE term (
-    term_text VARCHAR(100) PRIMARY KEY
+    term_id INT PRIMARY KEY AUTO_INCREMENT,
+    term_text VARCHAR(100) NOT NULL,
+    UNIQUE KEY term_text (term_text)
 );
 
 CREATE TABLE document_term (
-	score DOUBLE,
-	frequency INT,
     document_id VARCHAR(100),
-    term_text VARCHAR(100),
-    CONSTRAINT document_term_fk1 FOREIGN KEY (document_id) REFERENCES document(document_id) ON UPDATE RESTRICT ON DELETE CASCADE,
-    CONSTRAINT document_term_fk2 FOREIGN KEY (term_text) REFERENCES term(term_text) ON UPDATE RESTRICT ON DELETE CASCADE
+    term_id INT,
+    frequency INT,
+    PRIMARY KEY (document_id, term_id),
+    INDEX document_term_term (term_id),
+    CONSTRAINT document_term_document_fk FOREIGN KEY (document_id) REFERENCES document(document_id) ON UPDATE RESTRICT ON DELETE CASCADE,
+    CONSTRAINT document_term_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
 );
 
 CREATE TABLE paragraph_term (
-	score DOUBLE,
-    frequency INT,
     paragraph_id INT,
-    term_text VARCHAR(100),
-    CONSTRAINT paragraph_term_fk1 FOREIGN KEY (paragraph_id) REFERENCES paragraph(paragraph_id) ON UPDATE RESTRICT ON DELETE CASCADE,
-    CONSTRAINT paragraph_term_fk2 FOREIGN KEY (term_text) REFERENCES term(term_text) ON UPDATE RESTRICT ON DELETE CASCADE
+    term_id INT,
+    frequency INT,
+    -- The ordinals of the words of the paragraph that are occurrences of the term
+    positions MEDIUMBLOB,
+    PRIMARY KEY (paragraph_id, term_id),
+    INDEX paragraph_term_term (term_id),
+    CONSTRAINT paragraph_term_paragraph_fk FOREIGN KEY (paragraph_id) REFERENCES paragraph(paragraph_id) ON UPDATE RESTRICT ON DELETE CASCADE,
+    CONSTRAINT paragraph_term_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
 );
 
 CREATE TABLE sentence_term (
-	score DOUBLE,
-    frequency INT,
     sentence_id INT,
-    term_text VARCHAR(100),
-    CONSTRAINT sentence_term_fk1 FOREIGN KEY (sentence_id) REFERENCES sentence(sentence_id) ON UPDATE RESTRICT ON DELETE CASCADE,
-    CONSTRAINT sentence_term_fk2 FOREIGN KEY (term_text) REFERENCES term(term_text) ON UPDATE RESTRICT ON DELETE CASCADE
+    term_id INT,
+    frequency INT,
+    PRIMARY KEY (sentence_id, term_id),
+    INDEX sentence_term_term (term_id),
+    CONSTRAINT sentence_term_sentence_fk FOREIGN KEY (sentence_id) REFERENCES sentence(sentence_id) ON UPDATE RESTRICT ON DELETE CASCADE,
+    CONSTRAINT sentence_term_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+
+-- Number of units containing each term, per level ('document', 'paragraph' or 'sentence')
+CREATE TABLE term_df (
+    level VARCHAR(20),
+    term_id INT,
+    df INT,
+    PRIMARY KEY (level, term_id),
+    CONSTRAINT term_df_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+
+-- Number of units per level
+CREATE TABLE unit_count (
+    level VARCHAR(20) PRIMARY KEY,
+    n INT
+);
+
+INSERT INTO unit_count (level, n) VALUES ('document', 0), ('paragraph', 0), ('sentence', 0);
+
+-- Total frequency of each term on each day, per level, maintained by backend/src/api/trends.py
+CREATE TABLE term_trend (
+    level VARCHAR(20),
+    term_id INT,
+    day DATE,
+    frequency BIGINT NOT NULL,
+    PRIMARY KEY (level, term_id, day),
+    CONSTRAINT term_trend_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+
+-- Sources already imported by backend/src/import_corpus.py, so an interrupted import can resume.
+-- Rows are kept when their document is deleted, so that resuming an import does not bring it back.
+CREATE TABLE imported_source (
+    source_key VARCHAR(255) PRIMARY KEY,
+    document_id VARCHAR(100)
+);
+
+-- Incremented by every write to the corpus, used to key cached analyses such as topics
+CREATE TABLE corpus_version (
+    version BIGINT NOT NULL
 );
 
+INSERT INTO corpus_version (version) VALUES (0);
+
+-- tfidf scores, computed at read time from the statistics maintained by backend/src/api/tfidf.py
+CREATE OR REPLACE VIEW document_term_score AS
+SELECT dt.document_id, dt.term_id, dt.frequency,
+    (1e0 * dt.frequency / d.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM document_term AS dt
+JOIN document AS d ON d.document_id = dt.document_id
+JOIN unit_count AS c ON c.level = 'document'
+LEFT JOIN term_df AS df ON df.level = 'document' AND df.term_id = dt.term_id;
+
+CREATE OR REPLACE VIEW paragraph_term_score AS
+SELECT pt.paragraph_id, pt.term_id, pt.frequency,
+    (1e0 * pt.frequency / p.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM paragraph_term AS pt
+JOIN paragraph AS p ON p.paragraph_id = pt.paragraph_id
+JOIN unit_count AS c ON c.level = 'paragraph'
+LEFT JOIN term_df AS df ON df.level = 'paragraph' AND df.term_id = pt.term_id;
+
+CREATE OR REPLACE VIEW sentence_term_score AS
+SELECT st.sentence_id, st.term_id, st.frequency,
+    (1e0 * st.frequency / s.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM sentence_term AS st
+JOIN sentence AS s ON s.sentence_id = st.sentence_id
+JOIN unit_count AS c ON c.level = 'sentence'
+LEFT JOIN term_df AS df ON df.level = 'sentence' AND df.term_id = st.term_id;
+
 DROP PROCEDURE IF EXISTS cleanup_terms;
 DELIMITER //
 CREATE PROCEDURE cleanup_terms()
 BEGIN
-    DROP TABLE IF EXISTS terms_to_delete;
-    CREATE TEMPORARY TABLE terms_to_delete (t VARCHAR(100));
-    INSERT INTO terms_to_delete SELECT term.term_text FROM term LEFT JOIN document_term USING (term_text) WHERE document_id IS NULL;
-    DELETE FROM term WHERE term_text IN (SELECT t FROM terms_to_delete);
+    -- Terms stay in the dictionary, only the document frequencies of terms no unit contains anymore are deleted
+    DELETE FROM term_df WHERE df <= 0;
 END //
 DELIMITER ;
 
+-- The former row-by-row tfidf procedures are dropped when upgrading an existing database.
 DROP PROCEDURE IF EXISTS recompute_all_document_tfidf_scores;
-DELIMITER //
-CREATE PROCEDURE recompute_all_document_tfidf_scores()
-BEGIN
-	DECLARE more BOOLEAN DEFAULT TRUE;
-    DECLARE document_id_var VARCHAR(100);
-    DECLARE term_text_var VARCHAR(100);
-    DECLARE frequency_var INT;
-    
-    DECLARE tf_numerator DOUBLE;
-	DECLARE tf_denominator DOUBLE;
-    DECLARE tf DOUBLE;
-    DECLARE idf_numerator DOUBLE;
-    DECLARE idf_denominator DOUBLE;
-    DECLARE idf DOUBLE;
-    DECLARE tfidf DOUBLE;
-
-
-	DECLARE document_term_cursor CURSOR FOR
-		SELECT frequency, document_id, term_text FROM document_term;
-	DECLARE CONTINUE HANDLER FOR NOT FOUND SET more = FALSE;
-    
-    OPEN document_term_cursor;
-    WHILE more = TRUE AND EXISTS(SELECT * FROM document_term) DO 
-		FETCH document_term_cursor INTO frequency_var, document_id_var, term_text_var;
-
-		SET tf_numerator = frequency_var;
-		SELECT IFNULL(SUM(frequency), 0) INTO tf_denominator FROM document_term WHERE document_id = document_id_var;
-		SET tf = tf_numerator / tf_denominator;
-			 
-		SELECT COUNT(*) INTO idf_numerator FROM document;
-		SELECT COUNT(DISTINCT document_id) INTO idf_denominator FROM document_term WHERE term_text = term_text_var AND frequency > 0;
-		SET idf = LOG(idf_numerator / idf_denominator);
-		SET tfidf = tf * idf;
-			
-		UPDATE document_term SET score = tfidf WHERE document_id = document_id_var AND term_text = term_text_var;
-	END WHILE;
-END //
-DELIMITER ;
-
-
 DROP PROCEDURE IF EXISTS recompute_all_paragraph_tfidf_scores;
-DELIMITER //
-CREATE PROCEDURE recompute_all_paragraph_tfidf_scores()
-BEGIN
-	DECLARE more BOOLEAN DEFAULT TRUE;
-    DECLARE paragraph_id_var VARCHAR(100);
-    DECLARE term_text_var VARCHAR(100);
-    DECLARE frequency_var INT;
-    
-    DECLARE tf_numerator DOUBLE;
-	DECLARE tf_denominator DOUBLE;
-    DECLARE tf DOUBLE;
-    DECLARE idf_numerator DOUBLE;
-    DECLARE idf_denominator DOUBLE;
-    DECLARE idf DOUBLE;
-    DECLARE tfidf DOUBLE;
-
-
-	DECLARE document_term_cursor CURSOR FOR
-		SELECT frequency, paragraph_id, term_text FROM paragraph_term;
-	DECLARE CONTINUE HANDLER FOR NOT FOUND SET more = FALSE;
-    
-    OPEN document_term_cursor;
-    WHILE more = TRUE AND EXISTS(SELECT * FROM paragraph_term) DO 
-		FETCH document_term_cursor INTO frequency_var, paragraph_id_var, term_text_var;
-
-		SET tf_numerator = frequency_var;
-		SELECT IFNULL(SUM(frequency), 0) INTO tf_denominator FROM paragraph_term WHERE paragraph_id = paragraph_id_var;
-		SET tf = tf_numerator / tf_denominator;
-			 
-		SELECT COUNT(*) INTO idf_numerator FROM paragraph;
-		SELECT COUNT(DISTINCT paragraph_id) INTO idf_denominator FROM paragraph_term WHERE term_text = term_text_var AND frequency > 0;
-		SET idf = LOG(idf_numerator / idf_denominator);
-		SET tfidf = tf * idf;
-			
-		UPDATE paragraph_term SET score = tfidf WHERE paragraph_id = paragraph_id_var AND term_text = term_text_var;
-	END WHILE;
-END //
-DELIMITER ;
-
-
 DROP PROCEDURE IF EXISTS recompute_all_sentence_tfidf_scores;
-DELIMITER //
-CREATE PROCEDURE recompute_all_sentence_tfidf_scores()
-BEGIN
-	DECLARE more BOOLEAN DEFAULT TRUE;
-    DECLARE sentence_id_var VARCHAR(100);
-    DECLARE term_text_var VARCHAR(100);
-    DECLARE frequency_var INT;
-    
-    DECLARE tf_numerator DOUBLE;
-	DECLARE tf_denominator DOUBLE;
-    DECLARE tf DOUBLE;
-    DECLARE idf_numerator DOUBLE;
-    DECLARE idf_denominator DOUBLE;
-    DECLARE idf DOUBLE;
-    DECLARE tfidf DOUBLE;
-
-	DECLARE document_term_cursor CURSOR FOR
-		SELECT frequency, sentence_id, term_text FROM sentence_term;
-	DECLARE CONTINUE HANDLER FOR NOT FOUND SET more = FALSE;
-    
-    OPEN document_term_cursor;
-    WHILE more = TRUE AND EXISTS(SELECT * FROM sentence_term) DO 
-		FETCH document_term_cursor INTO frequency_var, sentence_id_var, term_text_var;
-
-		SET tf_numerator = frequency_var;
-		SELECT IFNULL(SUM(frequency), 0) INTO tf_denominator FROM sentence_term WHERE sentence_id = sentence_id_var;
-		SET tf = tf_numerator / tf_denominator;
-			 
-		SELECT COUNT(*) INTO idf_numerator FROM sentence;
-		SELECT COUNT(DISTINCT sentence_id) INTO idf_denominator FROM sentence_term WHERE term_text = term_text_var AND frequency > 0;
-		SET idf = LOG(idf_numerator / idf_denominator);
-		SET tfidf = tf * idf;
-			
-		UPDATE sentence_term SET score = tfidf WHERE sentence_id = sentence_id_var AND term_text = term_text_var;
-	END WHILE;
-END //
-DELIMITER ;
 
 
 DROP FUNCTION IF EXISTS compute_similarity_score;
 DELIMITER //
-CREATE FUNCTION compute_similarity_score(t1 VARCHAR(100), t2 VARCHAR(100))
+CREATE FUNCTION compute_similarity_score(t1 INT, t2 INT)
 RETURNS DOUBLE
 DETERMINISTIC
 READS SQL DATA
@@ -195,10 +165,10 @@ BEGIN
 	DECLARE ret DOUBLE;
     
 	SELECT SUM(ABS(dt1.score - dt2.score)) INTO ret FROM document 
-    JOIN document_term as dt1 
-    ON document.document_id = dt1.document_id AND (dt1.term_text = t2 OR dt1.term_text = t1)
-    LEFT JOIN document_term as dt2
-    ON document.document_id = dt2.document_id AND (dt2.term_text = t2 OR dt2.term_text = t1);
+    JOIN document_term_score as dt1 
+    ON document.document_id = dt1.document_id AND (dt1.term_id = t2 OR dt1.term_id = t1)
+    LEFT JOIN document_term_score as dt2
+    ON document.document_id = dt2.document_id AND (dt2.term_id = t2 OR dt2.term_id = t1);
     
     RETURN(ret);
 END // 
@@ -209,6 +179,6 @@ DROP PROCEDURE IF EXISTS compute_all_similarity_scores;
 DELIMITER //
 CREATE PROCEDURE compute_all_similarity_scores()
 BEGIN
-	SELECT DISTINCT t1.term_text, t2.term_text, compute_similarity_score(t1.term_text, t2.term_text) FROM term as t1 CROSS JOIN term as t2 WHERE t1.term_text < t2.term_text;
+	SELECT DISTINCT t1.term_text, t2.term_text, compute_similarity_score(t1.term_id, t2.term_id) FROM term as t1 CROSS JOIN term as t2 WHERE t1.term_text < t2.term_text;
 END //
 DELIMITER ;
@@ -0,0 +1,102 @@
+-- Upgrades a database created before the tfidf statistics were maintained incrementally.
+-- Scores are no longer stored in the *_term tables, they are read from the *_term_score views.
+-- The statistics are filled in from the existing term frequencies, as POST /rpc/recompute_tfidf_scores would.
+USE corpalizer;
+
+ALTER TABLE document ADD COLUMN term_count INT DEFAULT 0;
+ALTER TABLE paragraph ADD COLUMN term_count INT DEFAULT 0;
+ALTER TABLE sentence ADD COLUMN term_count INT DEFAULT 0;
+
+ALTER TABLE document_term DROP COLUMN score;
+ALTER TABLE paragraph_term DROP COLUMN score;
+ALTER TABLE sentence_term DROP COLUMN score;
+
+-- Number of units containing each term, per level ('document', 'paragraph' or 'sentence')
+CREATE TABLE term_df (
+    level VARCHAR(20),
+    term_text VARCHAR(100),
+    df INT,
+    PRIMARY KEY (level, term_text),
+    CONSTRAINT term_df_fk FOREIGN KEY (term_text) REFERENCES term(term_text) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+
+-- Number of units per level
+CREATE TABLE unit_count (
+    level VARCHAR(20) PRIMARY KEY,
+    n INT
+);
+
+-- Statistics of the existing documents
+UPDATE document
+LEFT JOIN (SELECT document_id, SUM(frequency) AS total FROM document_term GROUP BY document_id) AS unit_total
+USING (document_id)
+SET document.term_count = IFNULL(unit_total.total, 0);
+UPDATE paragraph
+LEFT JOIN (SELECT paragraph_id, SUM(frequency) AS total FROM paragraph_term GROUP BY paragraph_id) AS unit_total
+USING (paragraph_id)
+SET paragraph.term_count = IFNULL(unit_total.total, 0);
+UPDATE sentence
+LEFT JOIN (SELECT sentence_id, SUM(frequency) AS total FROM sentence_term GROUP BY sentence_id) AS unit_total
+USING (sentence_id)
+SET sentence.term_count = IFNULL(unit_total.total, 0);
+
+INSERT INTO term_df (level, term_text, df)
+SELECT 'document', term_text, COUNT(*) FROM document_term WHERE frequency > 0 GROUP BY term_text;
+INSERT INTO term_df (level, term_text, df)
+SELECT 'paragraph', term_text, COUNT(*) FROM paragraph_term WHERE frequency > 0 GROUP BY term_text;
+INSERT INTO term_df (level, term_text, df)
+SELECT 'sentence', term_text, COUNT(*) FROM sentence_term WHERE frequency > 0 GROUP BY term_text;
+
+INSERT INTO unit_count (level, n)
+SELECT 'document', COUNT(*) FROM document
+UNION ALL SELECT 'paragraph', COUNT(*) FROM paragraph
+UNION ALL SELECT 'sentence', COUNT(*) FROM sentence;
+
+-- tfidf scores, computed at read time from the statistics maintained by backend/src/api/tfidf.py
+CREATE OR REPLACE VIEW document_term_score AS
+SELECT dt.document_id, dt.term_text, dt.frequency,
+    (1e0 * dt.frequency / d.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM document_term AS dt
+JOIN document AS d ON d.document_id = dt.document_id
+JOIN unit_count AS c ON c.level = 'document'
+LEFT JOIN term_df AS df ON df.level = 'document' AND df.term_text = dt.term_text;
+
+CREATE OR REPLACE VIEW paragraph_term_score AS
+SELECT pt.paragraph_id, pt.term_text, pt.frequency,
+    (1e0 * pt.frequency / p.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM paragraph_term AS pt
+JOIN paragraph AS p ON p.paragraph_id = pt.paragraph_id
+JOIN unit_count AS c ON c.level = 'paragraph'
+LEFT JOIN term_df AS df ON df.level = 'paragraph' AND df.term_text = pt.term_text;
+
+CREATE OR REPLACE VIEW sentence_term_score AS
+SELECT st.sentence_id, st.term_text, st.frequency,
+    (1e0 * st.frequency / s.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM sentence_term AS st
+JOIN sentence AS s ON s.sentence_id = st.sentence_id
+JOIN unit_count AS c ON c.level = 'sentence'
+LEFT JOIN term_df AS df ON df.level = 'sentence' AND df.term_text = st.term_text;
+
+-- The scores are read from the views above rather than recomputed row by row
+DROP PROCEDURE IF EXISTS recompute_all_document_tfidf_scores;
+DROP PROCEDURE IF EXISTS recompute_all_paragraph_tfidf_scores;
+DROP PROCEDURE IF EXISTS recompute_all_sentence_tfidf_scores;
+
+DROP FUNCTION IF EXISTS compute_similarity_score;
+DELIMITER //
+CREATE FUNCTION compute_similarity_score(t1 VARCHAR(100), t2 VARCHAR(100))
+RETURNS DOUBLE
+DETERMINISTIC
+READS SQL DATA
+BEGIN
+	DECLARE ret DOUBLE;
+    
+	SELECT SUM(ABS(dt1.score - dt2.score)) INTO ret FROM document 
+    JOIN document_term_score as dt1 
+    ON document.document_id = dt1.document_id AND (dt1.term_text = t2 OR dt1.term_text = t1)
+    LEFT JOIN document_term_score as dt2
+    ON document.document_id = dt2.document_id AND (dt2.term_text = t2 OR dt2.term_text = t1);
+    
+    RETURN(ret);
+END // 
+DELIMITER ;
@@ -0,0 +1,9 @@
+-- Adds the corpus version used to key the topic cache.
+USE corpalizer;
+
+-- Incremented by every write to the corpus, used to key cached analyses such as topics
+CREATE TABLE corpus_version (
+    version BIGINT NOT NULL
+);
+
+INSERT INTO corpus_version (version) VALUES (0);
@@ -0,0 +1,9 @@
+-- Adds the table tracking bulk imported sources.
+USE corpalizer;
+
+-- Sources already imported by backend/src/import_corpus.py, so an interrupted import can resume.
+-- Rows are kept when their document is deleted, so that resuming an import does not bring it back.
+CREATE TABLE imported_source (
+    source_key VARCHAR(255) PRIMARY KEY,
+    document_id VARCHAR(100)
+);
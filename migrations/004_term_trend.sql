@@ -0,0 +1,13 @@
+-- Adds the per-day term trend rollups read by /trends.
+-- After running this script, POST /rpc/recompute_tfidf_scores once to fill them in.
+USE corpalizer;
+
+-- Total frequency of each term on each day, per level, maintained by backend/src/api/trends.py
+CREATE TABLE term_trend (
+    level VARCHAR(20),
+    term_text VARCHAR(100),
+    day DATE,
+    frequency BIGINT NOT NULL,
+    PRIMARY KEY (level, term_text, day),
+    CONSTRAINT term_trend_fk FOREIGN KEY (term_text) REFERENCES term(term_text) ON UPDATE RESTRICT ON DELETE CASCADE
+);
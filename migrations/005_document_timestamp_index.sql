@@ -0,0 +1,4 @@
+-- Adds the index serving the pages of GET /doc, ordered by date then id.
+USE corpalizer;
+
+CREATE INDEX document_timestamp ON document (timestamp, document_id);
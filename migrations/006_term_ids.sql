@@ -0,0 +1,149 @@
+-- Converts terms to integer ids: `term` becomes a dictionary mapping each term to a `term_id`, and the *_term, term_df
+-- and term_trend tables refer to terms by id, with composite primary keys.
+-- The tables referring to terms are copied into their new layout, then swapped with the former ones. Rows of a unit that
+-- the collation of term_text equated are merged. MySQL does not roll DDL back, so back the database up first, and stop
+-- the app while this runs. SQLite databases are converted by the app when it opens them.
+USE corpalizer;
+
+DROP VIEW IF EXISTS document_term_score;
+DROP VIEW IF EXISTS paragraph_term_score;
+DROP VIEW IF EXISTS sentence_term_score;
+
+ALTER TABLE document_term DROP FOREIGN KEY document_term_fk2;
+ALTER TABLE paragraph_term DROP FOREIGN KEY paragraph_term_fk2;
+ALTER TABLE sentence_term DROP FOREIGN KEY sentence_term_fk2;
+ALTER TABLE term_df DROP FOREIGN KEY term_df_fk;
+ALTER TABLE term_trend DROP FOREIGN KEY term_trend_fk;
+
+-- The term dictionary. Other tables refer to terms by id, see backend/src/api/terms.py. Terms are never deleted, so
+-- that the ids cached by the app stay valid
+ALTER TABLE term
+    DROP PRIMARY KEY,
+    ADD COLUMN term_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST,
+    ADD UNIQUE KEY term_text (term_text);
+
+CREATE TABLE document_term_new (
+    document_id VARCHAR(100),
+    term_id INT,
+    frequency INT,
+    PRIMARY KEY (document_id, term_id),
+    INDEX document_term_term (term_id),
+    CONSTRAINT document_term_document_fk FOREIGN KEY (document_id) REFERENCES document(document_id) ON UPDATE RESTRICT ON DELETE CASCADE,
+    CONSTRAINT document_term_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+INSERT INTO document_term_new (document_id, term_id, frequency)
+SELECT document_id, term_id, SUM(frequency) FROM document_term JOIN term USING (term_text) GROUP BY document_id, term_id;
+
+CREATE TABLE paragraph_term_new (
+    paragraph_id INT,
+    term_id INT,
+    frequency INT,
+    PRIMARY KEY (paragraph_id, term_id),
+    INDEX paragraph_term_term (term_id),
+    CONSTRAINT paragraph_term_paragraph_fk FOREIGN KEY (paragraph_id) REFERENCES paragraph(paragraph_id) ON UPDATE RESTRICT ON DELETE CASCADE,
+    CONSTRAINT paragraph_term_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+INSERT INTO paragraph_term_new (paragraph_id, term_id, frequency)
+SELECT paragraph_id, term_id, SUM(frequency) FROM paragraph_term JOIN term USING (term_text) GROUP BY paragraph_id, term_id;
+
+CREATE TABLE sentence_term_new (
+    sentence_id INT,
+    term_id INT,
+    frequency INT,
+    PRIMARY KEY (sentence_id, term_id),
+    INDEX sentence_term_term (term_id),
+    CONSTRAINT sentence_term_sentence_fk FOREIGN KEY (sentence_id) REFERENCES sentence(sentence_id) ON UPDATE RESTRICT ON DELETE CASCADE,
+    CONSTRAINT sentence_term_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+INSERT INTO sentence_term_new (sentence_id, term_id, frequency)
+SELECT sentence_id, term_id, SUM(frequency) FROM sentence_term JOIN term USING (term_text) GROUP BY sentence_id, term_id;
+
+CREATE TABLE term_df_new (
+    level VARCHAR(20),
+    term_id INT,
+    df INT,
+    PRIMARY KEY (level, term_id),
+    CONSTRAINT term_df_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+INSERT INTO term_df_new (level, term_id, df)
+SELECT level, term_id, SUM(df) FROM term_df JOIN term USING (term_text) GROUP BY level, term_id;
+
+CREATE TABLE term_trend_new (
+    level VARCHAR(20),
+    term_id INT,
+    day DATE,
+    frequency BIGINT NOT NULL,
+    PRIMARY KEY (level, term_id, day),
+    CONSTRAINT term_trend_term_fk FOREIGN KEY (term_id) REFERENCES term(term_id) ON UPDATE RESTRICT ON DELETE CASCADE
+);
+INSERT INTO term_trend_new (level, term_id, day, frequency)
+SELECT level, term_id, day, SUM(frequency) FROM term_trend JOIN term USING (term_text) GROUP BY level, term_id, day;
+
+DROP TABLE document_term, paragraph_term, sentence_term, term_df, term_trend;
+RENAME TABLE
+    document_term_new TO document_term,
+    paragraph_term_new TO paragraph_term,
+    sentence_term_new TO sentence_term,
+    term_df_new TO term_df,
+    term_trend_new TO term_trend;
+
+-- tfidf scores, computed at read time from the statistics maintained by backend/src/api/tfidf.py
+CREATE OR REPLACE VIEW document_term_score AS
+SELECT dt.document_id, dt.term_id, dt.frequency,
+    (1e0 * dt.frequency / d.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM document_term AS dt
+JOIN document AS d ON d.document_id = dt.document_id
+JOIN unit_count AS c ON c.level = 'document'
+LEFT JOIN term_df AS df ON df.level = 'document' AND df.term_id = dt.term_id;
+
+CREATE OR REPLACE VIEW paragraph_term_score AS
+SELECT pt.paragraph_id, pt.term_id, pt.frequency,
+    (1e0 * pt.frequency / p.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM paragraph_term AS pt
+JOIN paragraph AS p ON p.paragraph_id = pt.paragraph_id
+JOIN unit_count AS c ON c.level = 'paragraph'
+LEFT JOIN term_df AS df ON df.level = 'paragraph' AND df.term_id = pt.term_id;
+
+CREATE OR REPLACE VIEW sentence_term_score AS
+SELECT st.sentence_id, st.term_id, st.frequency,
+    (1e0 * st.frequency / s.term_count) * LOG(1e0 * c.n / df.df) AS score
+FROM sentence_term AS st
+JOIN sentence AS s ON s.sentence_id = st.sentence_id
+JOIN unit_count AS c ON c.level = 'sentence'
+LEFT JOIN term_df AS df ON df.level = 'sentence' AND df.term_id = st.term_id;
+
+DROP PROCEDURE IF EXISTS cleanup_terms;
+DELIMITER //
+CREATE PROCEDURE cleanup_terms()
+BEGIN
+    -- Terms stay in the dictionary, only the document frequencies of terms no unit contains anymore are deleted
+    DELETE FROM term_df WHERE df <= 0;
+END //
+DELIMITER ;
+
+DROP FUNCTION IF EXISTS compute_similarity_score;
+DELIMITER //
+CREATE FUNCTION compute_similarity_score(t1 INT, t2 INT)
+RETURNS DOUBLE
+DETERMINISTIC
+READS SQL DATA
+BEGIN
+    DECLARE ret DOUBLE;
+
+    SELECT SUM(ABS(dt1.score - dt2.score)) INTO ret FROM document
+    JOIN document_term_score as dt1
+    ON document.document_id = dt1.document_id AND (dt1.term_id = t2 OR dt1.term_id = t1)
+    LEFT JOIN document_term_score as dt2
+    ON document.document_id = dt2.document_id AND (dt2.term_id = t2 OR dt2.term_id = t1);
+
+    RETURN(ret);
+END //
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS compute_all_similarity_scores;
+DELIMITER //
+CREATE PROCEDURE compute_all_similarity_scores()
+BEGIN
+    SELECT DISTINCT t1.term_text, t2.term_text, compute_similarity_score(t1.term_id, t2.term_id) FROM term as t1 CROSS JOIN term as t2 WHERE t1.term_text < t2.term_text;
+END //
+DELIMITER ;
@@ -0,0 +1,7 @@
+-- Adds the positions of terms within paragraphs, which phrase queries (GET /phrase) are answered from, see
+-- backend/src/api/phrases.py. Paragraphs written earlier have no positions until the `index_positions` job
+-- (POST /rpc/index_positions) fills them in from the document store.
+USE corpalizer;
+
+ALTER TABLE paragraph ADD COLUMN token_offsets MEDIUMBLOB;
+ALTER TABLE paragraph_term ADD COLUMN positions MEDIUMBLOB;
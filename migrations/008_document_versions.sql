@@ -0,0 +1,6 @@
+-- Records the corpus version of the last write to each document, from which corpus snapshots are refreshed
+-- incrementally, see backend/src/api/snapshot.py. Documents written earlier have no version, and are taken as unchanged
+-- by any snapshot that already holds them.
+USE corpalizer;
+
+ALTER TABLE document ADD COLUMN corpus_version BIGINT;
@@ -0,0 +1,6 @@
+-- Flags the documents of unfinished imports, which are not counted in the tfidf statistics and trend rollups until
+-- the import rebuilds them, so that deleting or updating them does not subtract counts that were never added.
+-- Documents imported earlier are taken as counted.
+USE corpalizer;
+
+ALTER TABLE document ADD COLUMN statistics_pending BOOLEAN NOT NULL DEFAULT FALSE;